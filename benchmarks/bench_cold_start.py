@@ -0,0 +1,136 @@
+"""Benchmark: cold start of the API, as on a scale-up.
+
+Each run starts a fresh interpreter that imports `src.api.main` and runs the
+app's startup, and reports when it could serve (startup returned) and when
+it was ready (Gemini store found, Supabase client created). Listing File
+Search stores is simulated by the fake Gemini client with `--list-ms` of
+latency; nothing goes over the network.
+
+    python benchmarks/bench_cold_start.py [--runs N] [--list-ms MS] [--root DIR] [--json]
+
+`--root` measures another checkout, e.g. the previous commit in a worktree:
+
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/bench_cold_start.py --root /tmp/before
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FAKES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakes.py")
+
+# Run in the child. google.genai.Client is replaced by the fake as soon as the
+# SDK is imported, wherever that happens, so that deferred imports still count.
+CHILD = r"""
+import asyncio, importlib.abc, importlib.util, json, sys, time
+started = time.time()
+root, fakes_path, list_ms = sys.argv[1], sys.argv[2], float(sys.argv[3])
+sys.path.insert(0, root)
+
+spec = importlib.util.spec_from_file_location("cold_start_fakes", fakes_path)
+fakes = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fakes)
+
+
+class PatchGenai(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path, target=None):
+        if name != "google.genai":
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(name)
+        exec_module = spec.loader.exec_module
+
+        def patched(module):
+            exec_module(module)
+            module.Client = lambda *args, **kwargs: fakes.FakeGeminiClient(fakes.Latency(list_ms, sigma=0.0), stores=1)
+        spec.loader.exec_module = patched
+        return spec
+
+
+sys.meta_path.insert(0, PatchGenai())
+import src.api.main as main
+imported = time.time()
+
+
+def is_ready():
+    warmup = getattr(main, "warmup", None)
+    return warmup.ready if warmup is not None else main.gemini_service.initialized
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        serving = time.time()
+        while not is_ready():
+            await asyncio.sleep(0.001)
+        return serving, time.time()
+
+
+serving, ready = asyncio.run(run())
+print(json.dumps({"started": started, "imported": imported, "serving": serving, "ready": ready}))
+"""
+
+
+def run_once(root: str, list_ms: float, env: dict) -> dict:
+    spawned = time.time()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, root, FAKES_PATH, str(list_ms)],
+        cwd=root, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    times = json.loads(output.strip().splitlines()[-1])
+    return {
+        "interpreter_ms": (times["started"] - spawned) * 1000,
+        "import_ms": (times["imported"] - times["started"]) * 1000,
+        "serving_ms": (times["serving"] - spawned) * 1000,
+        "ready_ms": (times["ready"] - spawned) * 1000,
+    }
+
+
+def summarize(runs: list) -> dict:
+    return {
+        name: {"median": round(statistics.median(run[name] for run in runs), 1), "max": round(max(run[name] for run in runs), 1)}
+        for name in runs[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--list-ms", type=float, default=800.0, help="latency of listing File Search stores")
+    parser.add_argument("--root", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            SUPABASE_URL=os.environ.get("SUPABASE_URL", "https://cold-start.supabase.co"),
+            SUPABASE_KEY=os.environ.get("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.e30.x"),
+            GEMINI_API_KEY="cold-start",
+            TRACE_WRITE_BEHIND="false",
+            STORE_NAME_CACHE_PATH=os.path.join(tmp, "store_name"),
+        )
+        env.pop("GEMINI_STORE_NAME", None)
+        # The first start has to list stores; later ones can use the name it cached
+        first = run_once(args.root, args.list_ms, env)
+        results = {
+            "first_start": summarize([first]),
+            "restart": summarize([run_once(args.root, args.list_ms, env) for _ in range(args.runs)]),
+        }
+
+    results["config"] = {"root": args.root, "runs": args.runs, "list_ms": args.list_ms}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for scenario in ("first_start", "restart"):
+        timings = "  ".join(f"{name} {value['median']:.0f}" for name, value in results[scenario].items())
+        print(f"{scenario:12s} {timings}  (median ms)")
+
+
+if __name__ == "__main__":
+    main()
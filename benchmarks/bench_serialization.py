@@ -0,0 +1,162 @@
+"""Microbenchmark: serialization CPU per request, by wire format.
+
+Encodes and decodes realistic payloads the way the service handles one
+request: the client's body is decoded (decompressed, and MessagePack turned
+back into JSON, by WireMiddleware) and parsed, and the response body is
+rendered (and compressed). Payloads are a batch of traces for
+POST /traces/batch and a retrieval response with its relevant traces,
+built from seeded random words so that compression ratios are realistic.
+
+    python -m benchmarks.bench_serialization [--iterations N] [--traces T] [--output-kb K] [--json]
+
+Compression is applied as the client and WireMiddleware would: to the whole
+request, and to responses of at least --compress-min-bytes.
+
+"before" is the stdlib path the service used: json.loads and Starlette's
+JSONResponse (json.dumps). The other formats go through src/api/wire.py.
+Results per format: CPU microseconds per request (process time, so it is
+not skewed by other load), and request and response bytes on the wire.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from typing import Any, Dict
+
+# Settings are read at import; nothing here uses them
+os.environ.setdefault("SUPABASE_URL", "https://bench.supabase.co")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.e30.bench")
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+import msgpack
+import orjson
+from starlette.responses import JSONResponse
+
+from src.api import wire
+
+FORMATS = ("before", "orjson", "orjson+gzip", "orjson+zstd", "msgpack", "msgpack+zstd")
+
+_WORDS = (
+    "summarize explain translate refactor review classify extract draft outline compare "
+    "customer invoice ticket contract schema query report email release incident "
+    "python sql kubernetes pricing onboarding latency migration policy dashboard api "
+    "the a of to and for with in on from by is are was were be this that these"
+).split()
+
+
+def _text(rng: random.Random, chars: int) -> str:
+    words = []
+    size = 0
+    while size < chars:
+        words.append(rng.choice(_WORDS))
+        size += len(words[-1]) + 1
+    return " ".join(words)
+
+
+def make_batch(rng: random.Random, traces: int, output_kb: int) -> Dict[str, Any]:
+    """A POST /traces/batch body."""
+    return {"traces": [
+        {
+            "input": {
+                "prompt": _text(rng, 600),
+                "system_prompt": "You are a helpful assistant for the support team.",
+                "parameters": {"temperature": 0.2, "max_tokens": 1024},
+            },
+            "output": {"text": _text(rng, output_kb * 1024), "tokens_used": rng.randint(100, 2000), "finish_reason": "stop"},
+            "metadata": {"provider": "openai", "model": "gpt-4", "success": True, "latency_ms": rng.randint(200, 4000)},
+        }
+        for _ in range(traces)
+    ]}
+
+
+def make_retrieval(rng: random.Random, traces: int, output_kb: int) -> Dict[str, Any]:
+    """A POST /context/retrieve response."""
+    relevant = [
+        {"trace_id": f"{rng.getrandbits(128):032x}", "relevance_score": rng.random(), "output": _text(rng, output_kb * 1024)}
+        for _ in range(traces)
+    ]
+    return {
+        "enhanced_context": "\n\n".join(trace["output"] for trace in relevant),
+        "relevant_traces": relevant,
+        "suggestions": {"mode": "retrieve_only", "trace_count": traces, "cached": False},
+        "context": {"budget_tokens": 4000, "used_tokens": 3120, "synthesized": False, "truncated": False},
+    }
+
+
+def _codec(fmt: str, minimum_size: int):
+    """Functions for one format: client request encoding, and the service's decode and render."""
+    packed, _, coding = fmt.partition("+")
+
+    def encode_request(body):
+        data = msgpack.packb(body) if packed == "msgpack" else orjson.dumps(body)
+        return wire.compress(data, coding) if coding else data
+
+    def handle(data, response):
+        if coding:
+            data = wire.decompress(data, coding, 1 << 30)
+        if packed == "msgpack":
+            data = wire.msgpack_to_json(data)
+        if packed == "before":
+            json.loads(data)
+            body = JSONResponse(response).body
+        else:
+            orjson.loads(data)
+            token = wire._msgpack_response.set(packed == "msgpack")
+            try:
+                body = wire.WireResponse(response).body
+            finally:
+                wire._msgpack_response.reset(token)
+        # As WireMiddleware does, small responses are sent uncompressed
+        return wire.compress(body, coding) if coding and len(body) >= minimum_size else body
+
+    return encode_request, handle
+
+
+def run(fmt: str, request: Dict[str, Any], response: Dict[str, Any], iterations: int, minimum_size: int) -> Dict[str, Any]:
+    encode_request, handle = _codec(fmt, minimum_size)
+    data = encode_request(request)
+    start = time.process_time()
+    for _ in range(iterations):
+        body = handle(data, response)
+    cpu = time.process_time() - start
+    return {"cpu_us": cpu / iterations * 1e6, "request_bytes": len(data), "response_bytes": len(body)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--traces", type=int, default=10, help="traces per batch request and per retrieval response")
+    parser.add_argument("--output-kb", type=int, default=2, help="size of each trace's output text in KiB")
+    parser.add_argument("--compress-min-bytes", type=int, default=1024, help="smallest response compressed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    batch = make_batch(rng, args.traces, args.output_kb)
+    retrieval = make_retrieval(rng, args.traces, args.output_kb)
+    stored = {"trace_ids": [f"{rng.getrandbits(128):032x}" for _ in range(args.traces)], "stored": True, "status": "stored"}
+    retrieve_request = {"prompt": _text(rng, 600), "provider": "openai", "model": "gpt-4"}
+    payloads = {"traces_batch": (batch, stored), "context_retrieve": (retrieve_request, retrieval)}
+    results = {
+        endpoint: {fmt: run(fmt, request, response, args.iterations, args.compress_min_bytes) for fmt in FORMATS}
+        for endpoint, (request, response) in payloads.items()
+    }
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    for endpoint, by_format in results.items():
+        before = by_format["before"]["cpu_us"]
+        print(endpoint)
+        for fmt, r in by_format.items():
+            print(
+                f"  {fmt:>13}: {r['cpu_us']:8.1f} us cpu ({before / r['cpu_us']:4.1f}x)  "
+                f"request {r['request_bytes']:8d} B  response {r['response_bytes']:8d} B"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Microbenchmark: preparing a trace for File Search upload.
+
+Compares the old path (json.dumps -> NamedTemporaryFile -> re-read by the
+SDK -> unlink) with the in-memory path used by GeminiService (orjson ->
+BytesIO). The SDK upload is simulated by reading the stream to the end in
+8 MiB chunks, which is what the resumable upload does; no network is
+involved.
+
+    python benchmarks/bench_trace_upload.py [--iterations N] [--output-kb K] [--json]
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+
+import orjson
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def make_trace(output_kb: int) -> dict:
+    return {
+        "input": {
+            "prompt": "Summarize the following support conversation and list follow-up actions. " * 20,
+            "system_prompt": "You are a helpful assistant.",
+            "parameters": {"temperature": 0.2, "max_tokens": 1024},
+        },
+        "output": {"text": "x" * (output_kb * 1024), "tokens_used": 812, "finish_reason": "stop"},
+        "metadata": {"provider": "openai", "model": "gpt-4", "success": True, "latency_ms": 1830},
+    }
+
+
+def sdk_read(stream):
+    """Consume a stream the way the SDK's resumable upload does."""
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    while stream.read(CHUNK_SIZE):
+        pass
+    return size
+
+
+def temp_file_path(trace: dict) -> int:
+    trace = dict(trace, user_id="user-1", trace_id=str(uuid.uuid4()))
+    trace_json = json.dumps(trace, default=str)
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
+        f.write(trace_json)
+        temp_path = f.name
+    try:
+        with open(temp_path, "rb") as f:
+            return sdk_read(f)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def in_memory_path(trace: dict) -> int:
+    trace = dict(trace, user_id="user-1", trace_id=str(uuid.uuid4()))
+    content = orjson.dumps(trace, default=str)
+    with io.BytesIO(content) as buffer:
+        return sdk_read(buffer)
+
+
+def run(fn, trace: dict, iterations: int) -> dict:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(trace)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return {
+        "mean_us": statistics.fmean(timings),
+        "p50_us": timings[len(timings) // 2],
+        "p99_us": timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--output-kb", type=int, default=4, help="size of the trace output text in KiB")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    trace = make_trace(args.output_kb)
+    results = {
+        "temp_file": run(temp_file_path, trace, args.iterations),
+        "in_memory": run(in_memory_path, trace, args.iterations),
+    }
+    results["speedup"] = results["temp_file"]["mean_us"] / results["in_memory"]["mean_us"]
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    for name in ("temp_file", "in_memory"):
+        r = results[name]
+        print(f"{name:>10}: mean {r['mean_us']:8.1f} us  p50 {r['p50_us']:8.1f} us  p99 {r['p99_us']:8.1f} us")
+    print(f"   speedup: {results['speedup']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
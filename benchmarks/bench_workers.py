@@ -0,0 +1,164 @@
+"""Benchmark: /context/retrieve throughput against 1..N worker processes.
+
+For each worker count, starts the API as a real server through
+`src.api.serve` (with the fake upstreams of `benchmarks/fake_app.py`) and
+drives it over HTTP from several client processes, so that the client is not
+the bottleneck. Prompts come from a pool, and with a shared cache backend a
+result cached by one worker is a hit in the others; the report shows the
+fraction of cached answers. Upstream latency is kept low so that the
+service's own CPU time dominates.
+
+    python -m benchmarks.bench_workers [--workers 1 2 4] [--seconds 10] [--clients 4] [--cache-backend mmap] [--json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+from benchmarks.fake_app import bench_api_keys
+from benchmarks.load_test import percentile, random_prompt
+
+SERVE = "from src.api.serve import main; main('benchmarks.fake_app:app')"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _adrive(url: str, keys: List[str], prompts: List[str], seconds: float, concurrency: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    errors = 0
+    rejected = 0
+    cached = 0
+    deadline = time.perf_counter() + seconds
+
+    async with httpx.AsyncClient(base_url=url, timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            nonlocal errors, rejected, cached
+            while time.perf_counter() < deadline:
+                body = {"prompt": rng.choice(prompts), "provider": "openai", "model": "gpt-4", "mode": "retrieve_only"}
+                start = time.perf_counter()
+                try:
+                    response = await client.post("/api/v1/context/retrieve", json=body, headers={"X-API-Key": rng.choice(keys)})
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append((time.perf_counter() - start) * 1000)
+                if response.status_code == 503:
+                    # Shed by the adaptive concurrency limit
+                    rejected += 1
+                elif response.status_code != 200:
+                    errors += 1
+                elif response.json()["suggestions"].get("cached"):
+                    cached += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"latencies": latencies, "errors": errors, "rejected": rejected, "cached": cached}
+
+
+def _drive(job: tuple) -> Dict[str, Any]:
+    return asyncio.run(_adrive(*job))
+
+
+def _wait_ready(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not become ready")
+
+
+def run_workers(workers: int, args) -> Dict[str, Any]:
+    """Start a server with `workers` processes, load it for `args.seconds` and summarize."""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(
+            os.environ,
+            WEB_CONCURRENCY=str(workers),
+            PORT=str(port),
+            HOST="127.0.0.1",
+            CACHE_BACKEND=args.cache_backend,
+            CACHE_MMAP_DIR=cache_dir,
+            RATE_LIMIT_ENABLED="false",
+            BENCH_USERS=str(args.users),
+            BENCH_GEMINI_MS=str(args.gemini_ms),
+            BENCH_SUPABASE_MS=str(args.supabase_ms),
+        )
+        server = subprocess.Popen([sys.executable, "-c", SERVE], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_ready(url)
+            # Let every worker finish starting, not just the one that answered
+            time.sleep(1.0)
+            rng = random.Random(args.seed)
+            prompts = [random_prompt(rng) for _ in range(args.prompt_pool)]
+            keys = bench_api_keys(args.users)
+            jobs = [(url, keys, prompts, args.seconds, args.concurrency, args.seed + i) for i in range(args.clients)]
+            with multiprocessing.Pool(args.clients) as pool:
+                runs = pool.map(_drive, jobs)
+        finally:
+            server.terminate()
+            server.wait(30)
+
+    latencies = sorted(latency for run in runs for latency in run["latencies"])
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": sum(run["errors"] for run in runs),
+        "rejected": sum(run["rejected"] for run in runs),
+        "rps": round(len(latencies) / args.seconds, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "cached": round(sum(run["cached"] for run in runs) / len(latencies), 3) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent requests per client process")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--prompt-pool", type=int, default=50)
+    parser.add_argument("--gemini-ms", type=float, default=20.0)
+    parser.add_argument("--supabase-ms", type=float, default=2.0)
+    parser.add_argument("--cache-backend", choices=("memory", "mmap", "redis"), default="mmap")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    results = [run_workers(workers, args) for workers in args.workers]
+    base = results[0]["rps"] / results[0]["workers"]
+    for result in results:
+        result["scaling"] = round(result["rps"] / (base * result["workers"]), 2) if base else 0.0
+
+    if args.json:
+        print(json.dumps({"cpus": os.cpu_count(), "cache_backend": args.cache_backend, "results": results}, indent=2))
+        return
+    for r in results:
+        print(
+            f"{r['workers']:>2} worker(s): {r['rps']:8.1f} req/s  p50 {r['p50_ms']:7.1f} ms  p99 {r['p99_ms']:7.1f} ms  "
+            f"cached {r['cached']:.0%}  scaling {r['scaling']:.2f}  errors {r['errors']}  rejected {r['rejected']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""The API wired to the fake upstreams, for benchmarks that run it as a real server.
+
+    python -c "from src.api.serve import main; main('benchmarks.fake_app:app')"
+
+Each worker process imports this module and gets its own fakes, so every
+worker seeds the same API keys (`bench_api_keys`) and any of them can serve
+any key. Upstream latency comes from BENCH_SUPABASE_MS and BENCH_GEMINI_MS.
+"""
+import os
+from argparse import Namespace
+from typing import List
+
+from benchmarks.load_test import install_fakes
+
+
+def bench_api_keys(users: int) -> List[str]:
+    return [f"ctx_bench_{i}" for i in range(users)]
+
+
+def _build_app():
+    from src.api.database import hash_api_key
+
+    args = Namespace(
+        async_io=True,
+        rate_limit=False,
+        supabase_ms=float(os.environ.get("BENCH_SUPABASE_MS", "2")),
+        gemini_ms=float(os.environ.get("BENCH_GEMINI_MS", "20")),
+        upload_ms=0.0,
+        sigma=0.5,
+        supabase_error_rate=0.0,
+        gemini_error_rate=0.0,
+        seed=os.getpid()
+    )
+    services = install_fakes(args)
+    db = services["db"]
+    for i, api_key in enumerate(bench_api_keys(int(os.environ.get("BENCH_USERS", "20")))):
+        user = db.get_or_create_user(f"bench-user-{i}@example.com")
+        db.client.table("api_keys").insert({
+            "user_id": user["id"],
+            "key_hash": hash_api_key(api_key),
+            "key_prefix": api_key[:12]
+        }).execute()
+    return services["app"]
+
+
+app = _build_app()
@@ -0,0 +1,531 @@
+"""In-process fakes of the Supabase and Gemini clients for load testing.
+
+The fakes implement only the calls the service makes, keep their data in
+memory, and wait for a configurable latency (and fail at a configurable
+rate) on every network call, so the service's own overhead and concurrency
+behaviour can be measured without live upstreams.
+"""
+import asyncio
+import calendar
+import itertools
+import random
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+
+class UpstreamError(Exception):
+    """Injected upstream failure."""
+
+
+class NotFoundError(Exception):
+    """A File Search resource that does not exist, with the status code google.genai's errors carry."""
+
+    code = 404
+
+
+class Latency:
+    """Log-normal latency with a given median, plus an error rate.
+
+    `sigma` controls the tail: 0 gives a constant delay, 0.5 puts p99 at
+    about 3.2x the median.
+    """
+
+    def __init__(self, median_ms: float = 0.0, sigma: float = 0.5, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        with self._lock:
+            delay = self.median_ms * self._rng.lognormvariate(0.0, self.sigma) / 1000 if self.median_ms > 0 else 0.0
+            failed = self._rng.random() < self.error_rate
+        return delay, failed
+
+    def wait(self, operation: str):
+        delay, failed = self._draw()
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise UpstreamError(f"injected failure in {operation}")
+
+    async def await_(self, operation: str):
+        delay, failed = self._draw()
+        if delay:
+            await asyncio.sleep(delay)
+        if failed:
+            raise UpstreamError(f"injected failure in {operation}")
+
+
+# Supabase
+
+_TIMESTAMP = "%Y-%m-%dT%H:%M:%S+00:00"
+
+
+def _now() -> str:
+    return time.strftime(_TIMESTAMP, time.gmtime())
+
+
+def _seconds(timestamp: str) -> float:
+    return calendar.timegm(time.strptime(timestamp, _TIMESTAMP))
+
+
+def _interval(interval: Optional[str]) -> Optional[float]:
+    """Seconds in an interval given as "<n> seconds", as the service passes them."""
+    return float(interval.split()[0]) if interval else None
+
+
+# Column defaults, as in supabase_schema.sql; besides created_at, these columns default to NOW()
+_DEFAULTS = {"trace_metadata": {"status": "pending", "hit_count": 1, "document_name": None}}
+_NOW_DEFAULTS = {"trace_metadata": ("last_seen_at", "upload_started_at")}
+
+
+class FakeTables:
+    """In-memory tables shared by the sync and async fake Supabase clients."""
+
+    def __init__(self):
+        self.rows: Dict[str, List[Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def table(self, name: str) -> List[Dict[str, Any]]:
+        return self.rows.setdefault(name, [])
+
+    def new_row(self, values: Dict[str, Any], table: Optional[str] = None) -> Dict[str, Any]:
+        row = {"id": str(uuid.UUID(int=next(self._ids))), "created_at": _now(), **_DEFAULTS.get(table, {})}
+        row.update(values)
+        for column in _NOW_DEFAULTS.get(table, ()):
+            row.setdefault(column, row["created_at"])
+        return row
+
+    # Database functions, as in supabase_schema.sql (without the rollups)
+
+    def record_traces(self, p_user_id: str, p_traces: List[Dict[str, Any]], p_pending_lease: Optional[str]) -> List[Dict[str, Any]]:
+        rows = self.table("trace_metadata")
+        lease = _interval(p_pending_lease)
+        upload = []
+        for trace in p_traces:
+            existing = next((row for row in rows if row["trace_id"] == trace["trace_id"]), None)
+            if existing is None:
+                row = self.new_row(dict(trace, user_id=p_user_id), "trace_metadata")
+                rows.append(row)
+                upload.append({"trace_id": trace["trace_id"]})
+            elif existing["status"] == "failed" or (
+                existing["status"] == "pending" and lease is not None
+                and _seconds(existing["upload_started_at"]) < time.time() - lease
+            ):
+                existing.update(status="pending", last_seen_at=_now(), upload_started_at=_now())
+                upload.append({"trace_id": trace["trace_id"]})
+            else:
+                existing.update(hit_count=existing["hit_count"] + 1, last_seen_at=_now())
+        return upload
+
+    def list_traces(self, p_user_id: str, p_created_at: Optional[str], p_id: Optional[str], p_limit: int):
+        # created_at DESC NULLS LAST, id DESC
+        def position(created_at: Optional[str], row_id: str):
+            return (created_at is not None, created_at or "", row_id)
+
+        rows = sorted(
+            (row for row in self.table("trace_metadata") if row["user_id"] == p_user_id),
+            key=lambda row: position(row["created_at"], row["id"]),
+            reverse=True
+        )
+        if p_id is not None:
+            rows = [row for row in rows if position(row["created_at"], row["id"]) < position(p_created_at, p_id)]
+        return [dict(row) for row in rows[:p_limit]]
+
+    def expired_traces(
+        self,
+        p_max_age: Optional[str],
+        p_max_traces: Optional[int],
+        p_max_bytes: Optional[int],
+        p_limit: int,
+        p_pending_lease: Optional[str],
+        p_require_document: bool
+    ):
+        cutoff = time.time() - _interval(p_max_age) if p_max_age else None
+        lease = _interval(p_pending_lease)
+        by_user: Dict[str, List[Dict[str, Any]]] = {}
+        for row in self.table("trace_metadata"):
+            by_user.setdefault(row["user_id"], []).append(row)
+        expired = []
+        for user_rows in by_user.values():
+            user_rows.sort(key=lambda row: row["trace_id"])
+            user_rows.sort(key=lambda row: row["last_seen_at"], reverse=True)
+            retained_bytes = 0
+            for position, row in enumerate(user_rows, 1):
+                retained_bytes += row.get("size_bytes") or 0
+                if row["status"] == "pending" and (lease is None or _seconds(row["upload_started_at"]) >= time.time() - lease):
+                    continue
+                if p_require_document and row["status"] == "indexed" and row["document_name"] is None:
+                    continue
+                if (
+                    (cutoff is not None and _seconds(row["last_seen_at"]) < cutoff)
+                    or (p_max_traces is not None and position > p_max_traces)
+                    or (p_max_bytes is not None and retained_bytes > p_max_bytes)
+                ):
+                    expired.append(row)
+        expired.sort(key=lambda row: (row["last_seen_at"], row["trace_id"]))
+        return [
+            {"user_id": row["user_id"], "trace_id": row["trace_id"], "document_name": row["document_name"]}
+            for row in expired[:p_limit]
+        ]
+
+
+class FakeQuery:
+    """Chainable query builder covering the subset of postgrest the service uses."""
+
+    def __init__(self, tables: FakeTables, name: str, latency: Latency):
+        self._tables = tables
+        self._name = name
+        self._latency = latency
+        self._action = "select"
+        self._columns = "*"
+        self._values: Any = None
+        self._filters: List = []
+        self._on_conflict: Optional[str] = None
+        self._ignore_duplicates = False
+
+    def select(self, columns: str = "*"):
+        self._action, self._columns = "select", columns
+        return self
+
+    def insert(self, values):
+        self._action, self._values = "insert", values
+        return self
+
+    def upsert(self, values, on_conflict: Optional[str] = None, ignore_duplicates: bool = False, **kwargs):
+        self._action, self._values = "upsert", values
+        self._on_conflict, self._ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def update(self, values):
+        self._action, self._values = "update", values
+        return self
+
+    def delete(self):
+        self._action = "delete"
+        return self
+
+    def eq(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column: str, values):
+        values = set(values)
+        self._filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def _matches(self, row) -> bool:
+        return all(f(row) for f in self._filters)
+
+    def _project(self, row) -> Dict[str, Any]:
+        row = dict(row)
+        if "users(*)" in self._columns:
+            users = self._tables.table("users")
+            row["users"] = next((u for u in users if u["id"] == row.get("user_id")), None)
+        return row
+
+    def _run(self) -> SimpleNamespace:
+        with self._tables.lock:
+            rows = self._tables.table(self._name)
+            if self._action == "select":
+                data = [self._project(row) for row in rows if self._matches(row)]
+            elif self._action == "insert":
+                values = self._values if isinstance(self._values, list) else [self._values]
+                data = [self._tables.new_row(v, self._name) for v in values]
+                rows.extend(data)
+            elif self._action == "upsert":
+                values = self._values if isinstance(self._values, list) else [self._values]
+                key = self._on_conflict or "id"
+                data = []
+                for v in values:
+                    existing = next((row for row in rows if row.get(key) == v.get(key)), None)
+                    if existing is None:
+                        existing = self._tables.new_row(v, self._name)
+                        rows.append(existing)
+                    elif not self._ignore_duplicates:
+                        existing.update(v)
+                    data.append(dict(existing))
+            elif self._action == "update":
+                data = []
+                for row in rows:
+                    if self._matches(row):
+                        row.update(self._values)
+                        data.append(dict(row))
+            else:
+                data = [row for row in rows if self._matches(row)]
+                rows[:] = [row for row in rows if not self._matches(row)]
+        return SimpleNamespace(data=data)
+
+    def execute(self):
+        self._latency.wait(f"supabase.{self._name}.{self._action}")
+        return self._run()
+
+
+class FakeAsyncQuery(FakeQuery):
+    async def execute(self):
+        await self._latency.await_(f"supabase.{self._name}.{self._action}")
+        return self._run()
+
+
+class FakeRpc:
+    """A call to one of the database functions implemented by FakeTables."""
+
+    def __init__(self, tables: FakeTables, name: str, params: Dict[str, Any], latency: Latency):
+        self._tables = tables
+        self._name = name
+        self._params = params
+        self._latency = latency
+
+    def _run(self) -> SimpleNamespace:
+        with self._tables.lock:
+            return SimpleNamespace(data=getattr(self._tables, self._name)(**self._params))
+
+    def execute(self):
+        self._latency.wait(f"supabase.rpc.{self._name}")
+        return self._run()
+
+
+class FakeAsyncRpc(FakeRpc):
+    async def execute(self):
+        await self._latency.await_(f"supabase.rpc.{self._name}")
+        return self._run()
+
+
+class FakeSupabaseClient:
+    """Stands in for `supabase.Client`."""
+
+    query_class = FakeQuery
+    rpc_class = FakeRpc
+
+    def __init__(self, latency: Optional[Latency] = None, tables: Optional[FakeTables] = None):
+        self.latency = latency or Latency()
+        self.tables = tables or FakeTables()
+
+    def table(self, name: str):
+        return self.query_class(self.tables, name, self.latency)
+
+    def rpc(self, name: str, params: Dict[str, Any]):
+        return self.rpc_class(self.tables, name, params, self.latency)
+
+
+class FakeAsyncSupabaseClient(FakeSupabaseClient):
+    """Stands in for `supabase.AsyncClient`."""
+
+    query_class = FakeAsyncQuery
+    rpc_class = FakeAsyncRpc
+
+    def __init__(self, latency: Optional[Latency] = None, tables: Optional[FakeTables] = None):
+        super().__init__(latency, tables)
+
+        async def aclose():
+            pass
+        self.postgrest = SimpleNamespace(aclose=aclose)
+
+
+# Gemini
+
+def _operation(done: bool = True) -> SimpleNamespace:
+    return SimpleNamespace(name=f"operations/{uuid.uuid4().hex}", done=done, error=None)
+
+
+def _upload(gemini: "FakeGeminiClient", store_name: str) -> SimpleNamespace:
+    """Start an upload operation, and add the document it creates to the store."""
+    operation = _operation(done=False)
+    document_name = f"{store_name}/documents/{uuid.uuid4().hex[:12]}"
+    gemini.documents.append(document_name)
+    gemini.uploads[operation.name] = document_name
+    return operation
+
+
+def _generate_response(contents: str, chunks: int, chunk_chars: int) -> SimpleNamespace:
+    grounding_chunks = [
+        SimpleNamespace(retrieved_context=SimpleNamespace(
+            text=f'{{"trace_id": "fake-{i}", "output": {{"text": "{"x" * chunk_chars}"}}}}',
+            title=f"trace_fake-{i}"
+        ))
+        for i in range(chunks)
+    ]
+    supports = [
+        SimpleNamespace(grounding_chunk_indices=[i], confidence_scores=[1.0 - i / 10])
+        for i in range(chunks)
+    ]
+    grounding = SimpleNamespace(grounding_chunks=grounding_chunks, grounding_supports=supports, retrieval_queries=None)
+    return SimpleNamespace(
+        text=f"Patterns relevant to: {contents[-200:]}",
+        candidates=[SimpleNamespace(grounding_metadata=grounding)]
+    )
+
+
+def _stream_pieces(contents: str) -> List[str]:
+    """The text of a streamed response, a few words per chunk."""
+    words = f"Patterns relevant to: {contents[-200:]}".split(" ")
+    return [" ".join(words[i:i + 4]) + " " for i in range(0, len(words), 4)]
+
+
+def _store() -> SimpleNamespace:
+    return SimpleNamespace(name=f"fileSearchStores/{uuid.uuid4().hex[:12]}")
+
+
+class _Stores:
+    def __init__(self, gemini: "FakeGeminiClient"):
+        self._gemini = gemini
+        self.documents = _Documents(gemini)
+
+    def create(self, config=None):
+        self._gemini.generate_latency.wait("gemini.file_search_stores.create")
+        store = _store()
+        self._gemini.stores.append(store)
+        return store
+
+    def list(self):
+        self._gemini.generate_latency.wait("gemini.file_search_stores.list")
+        return list(self._gemini.stores)
+
+    def get(self, name: str, config=None):
+        self._gemini.generate_latency.wait("gemini.file_search_stores.get")
+        for store in self._gemini.stores:
+            if store.name == name:
+                return store
+        raise NotFoundError(f"{name} not found")
+
+    def delete(self, name: str, config=None):
+        pass
+
+    def upload_to_file_search_store(self, file, file_search_store_name: str, config=None):
+        file.read()
+        self._gemini.upload_latency.wait("gemini.upload_to_file_search_store")
+        return _upload(self._gemini, file_search_store_name)
+
+
+class _AsyncStores:
+    def __init__(self, gemini: "FakeGeminiClient"):
+        self._gemini = gemini
+        self.documents = _AsyncDocuments(gemini)
+
+    async def create(self, config=None):
+        await self._gemini.generate_latency.await_("gemini.file_search_stores.create")
+        store = _store()
+        self._gemini.stores.append(store)
+        return store
+
+    async def list(self):
+        await self._gemini.generate_latency.await_("gemini.file_search_stores.list")
+        return list(self._gemini.stores)
+
+    async def get(self, name: str, config=None):
+        await self._gemini.generate_latency.await_("gemini.file_search_stores.get")
+        for store in self._gemini.stores:
+            if store.name == name:
+                return store
+        raise NotFoundError(f"{name} not found")
+
+    async def delete(self, name: str, config=None):
+        pass
+
+    async def upload_to_file_search_store(self, file, file_search_store_name: str, config=None):
+        file.read()
+        await self._gemini.upload_latency.await_("gemini.upload_to_file_search_store")
+        return _upload(self._gemini, file_search_store_name)
+
+
+class _Models:
+    def __init__(self, gemini: "FakeGeminiClient"):
+        self._gemini = gemini
+
+    def generate_content(self, model: str, contents, config=None):
+        self._gemini.calls.append((model, config))
+        self._gemini.generate_latency.wait("gemini.generate_content")
+        return _generate_response(str(contents), self._gemini.chunks, self._gemini.chunk_chars)
+
+    def generate_content_stream(self, model: str, contents, config=None):
+        self._gemini.calls.append((model, config))
+        self._gemini.generate_latency.wait("gemini.generate_content_stream")
+        for piece in _stream_pieces(str(contents)):
+            yield SimpleNamespace(text=piece)
+
+
+class _AsyncModels:
+    def __init__(self, gemini: "FakeGeminiClient"):
+        self._gemini = gemini
+
+    async def generate_content(self, model: str, contents, config=None):
+        self._gemini.calls.append((model, config))
+        await self._gemini.generate_latency.await_("gemini.generate_content")
+        return _generate_response(str(contents), self._gemini.chunks, self._gemini.chunk_chars)
+
+    async def generate_content_stream(self, model: str, contents, config=None):
+        self._gemini.calls.append((model, config))
+        await self._gemini.generate_latency.await_("gemini.generate_content_stream")
+
+        async def stream():
+            for piece in _stream_pieces(str(contents)):
+                yield SimpleNamespace(text=piece)
+        return stream()
+
+
+class _Documents:
+    def __init__(self, gemini: "FakeGeminiClient"):
+        self._gemini = gemini
+
+    def delete(self, name: str, config=None):
+        self._gemini.generate_latency.wait("gemini.documents.delete")
+        self._gemini.documents.remove(name)
+
+
+class _AsyncDocuments:
+    def __init__(self, gemini: "FakeGeminiClient"):
+        self._gemini = gemini
+
+    async def delete(self, name: str, config=None):
+        await self._gemini.generate_latency.await_("gemini.documents.delete")
+        self._gemini.documents.remove(name)
+
+
+class _Operations:
+    def __init__(self, gemini: "FakeGeminiClient"):
+        self._gemini = gemini
+
+    def get(self, operation):
+        response = SimpleNamespace(document_name=self._gemini.uploads.get(operation.name))
+        return SimpleNamespace(name=operation.name, done=True, error=None, response=response)
+
+
+class FakeGeminiClient:
+    """Stands in for `genai.Client`, including its `aio` namespace."""
+
+    def __init__(
+        self,
+        generate_latency: Optional[Latency] = None,
+        upload_latency: Optional[Latency] = None,
+        chunks: int = 3,
+        chunk_chars: int = 400,
+        stores: int = 0
+    ):
+        self.generate_latency = generate_latency or Latency()
+        self.upload_latency = upload_latency or Latency()
+        self.chunks = chunks
+        self.chunk_chars = chunk_chars
+        # (model, config) of every generate_content call
+        self.calls: List[tuple] = []
+        # File Search stores that already exist
+        self.stores = [_store() for _ in range(stores)]
+        # Names of uploaded documents not yet deleted, and the document each upload operation creates
+        self.documents: List[str] = []
+        self.uploads: Dict[str, str] = {}
+        self.models = _Models(self)
+        self.file_search_stores = _Stores(self)
+        self.operations = _Operations(self)
+
+        async def aclose():
+            pass
+        self.aio = SimpleNamespace(
+            models=_AsyncModels(self),
+            file_search_stores=_AsyncStores(self),
+            aclose=aclose
+        )
@@ -0,0 +1,252 @@
+"""Load test: drive the API in-process against fake Supabase and Gemini upstreams.
+
+Requests go through the full ASGI app (middleware, auth, routing, models)
+over httpx's ASGI transport. The upstream clients are replaced by the fakes
+in `benchmarks/fakes.py`, which wait a log-normal latency and fail at a
+configurable rate, so throughput and tail latency of the service itself can
+be compared between revisions.
+
+    python -m benchmarks.load_test [--requests N] [--concurrency C] [--json] [--output results.json]
+
+Results per endpoint: requests, errors (HTTP >= 400), degraded (a 200 that
+reports a failed retrieval or store), requests per second and p50/p95/p99
+latency in ms.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.fakes import FakeAsyncSupabaseClient, FakeGeminiClient, FakeSupabaseClient, FakeTables, Latency
+
+ENDPOINTS = ("context_retrieve", "traces_store", "auth_create_key")
+
+_WORDS = (
+    "summarize explain translate refactor review classify extract draft outline compare "
+    "customer invoice ticket contract schema query report email release incident "
+    "python sql kubernetes pricing onboarding latency migration policy dashboard api "
+    "quickly briefly formally carefully in bullet points with examples for engineers"
+).split()
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def random_prompt(rng: random.Random) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(16))
+
+
+def install_fakes(args) -> Dict[str, Any]:
+    """Point the service singletons at fake upstreams. Returns the app and the fakes."""
+    from src.api.config import settings
+    from src.api.database import db
+    from src.api.gemini_service import gemini_service
+    from src.api.main import app
+
+    settings.async_io = args.async_io
+    settings.trace_write_behind = False
+    # Measure the service, not the per-key limits, unless asked to
+    settings.rate_limit_enabled = args.rate_limit
+
+    supabase_latency = Latency(args.supabase_ms, args.sigma, args.supabase_error_rate, seed=args.seed)
+    gemini_latency = Latency(args.gemini_ms, args.sigma, args.gemini_error_rate, seed=args.seed + 1)
+    upload_latency = Latency(args.upload_ms, args.sigma, args.gemini_error_rate, seed=args.seed + 2)
+
+    tables = FakeTables()
+    db.client = FakeSupabaseClient(supabase_latency, tables)
+    db.async_client = FakeAsyncSupabaseClient(supabase_latency, tables)
+    gemini_service.client = FakeGeminiClient(gemini_latency, upload_latency)
+    gemini_service.store_name = "fileSearchStores/load-test"
+    gemini_service.initialized = True
+
+    return {"app": app, "db": db, "gemini_service": gemini_service, "tables": tables}
+
+
+class Scenario:
+    """Builds the requests for one endpoint."""
+
+    def __init__(self, endpoint: str, api_keys: List[str], prompt_pool: List[str], seed: int, mode: Optional[str] = None):
+        self.endpoint = endpoint
+        self.mode = mode
+        self.api_keys = api_keys
+        self.prompt_pool = prompt_pool
+        self.rng = random.Random(seed)
+        self.counter = 0
+
+    def _prompt(self) -> str:
+        if self.prompt_pool:
+            return self.rng.choice(self.prompt_pool)
+        return random_prompt(self.rng)
+
+    def request(self) -> Dict[str, Any]:
+        self.counter += 1
+        headers = {"X-API-Key": self.rng.choice(self.api_keys)}
+        if self.endpoint == "context_retrieve":
+            body = {"prompt": self._prompt(), "provider": "openai", "model": "gpt-4"}
+            if self.mode:
+                body["mode"] = self.mode
+            return {"url": "/api/v1/context/retrieve", "headers": headers, "json": body}
+        if self.endpoint == "traces_store":
+            return {
+                "url": "/api/v1/traces/store",
+                "headers": headers,
+                "json": {
+                    "input": {"prompt": self._prompt()},
+                    "output": {"text": "x" * 2048, "tokens_used": 512},
+                    "metadata": {"provider": "openai", "model": "gpt-4", "latency_ms": 900}
+                }
+            }
+        return {
+            "url": "/api/v1/auth/create-key",
+            "json": {"email": f"load-{self.rng.randrange(10 ** 9)}-{self.counter}@example.com"}
+        }
+
+
+async def run_endpoint(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int, warmup: int) -> Dict[str, Any]:
+    """Send `requests` requests from `concurrency` concurrent workers and summarize latencies."""
+    for _ in range(warmup):
+        await client.post(**scenario.request())
+
+    latencies: List[float] = []
+    errors = 0
+    rejected = 0
+    degraded = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors, rejected, degraded
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            response = await client.post(**scenario.request())
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code in (429, 503):
+                # Rate limited or shed by the service rather than failed
+                rejected += 1
+            elif response.status_code >= 400:
+                errors += 1
+            elif scenario.endpoint == "context_retrieve" and {"error", "degraded"} & set(response.json().get("suggestions", {})):
+                degraded += 1
+            elif scenario.endpoint == "traces_store" and not response.json().get("stored", True):
+                degraded += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rejected": rejected,
+        "degraded": degraded,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(latencies[-1], 2) if latencies else 0.0,
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    services = install_fakes(args)
+    db = services["db"]
+    gemini_service = services["gemini_service"]
+
+    # API keys are created directly, outside the measured requests
+    api_keys = []
+    for i in range(args.users):
+        user = db.get_or_create_user(f"load-user-{i}@example.com")
+        api_key, _ = db.create_api_key(user["id"])
+        api_keys.append(api_key)
+
+    rng = random.Random(args.seed)
+    prompt_pool = [random_prompt(rng) for _ in range(args.prompt_pool)]
+
+    results = {}
+    transport = httpx.ASGITransport(app=services["app"])
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=None) as client:
+            for endpoint in args.endpoints:
+                scenario = Scenario(endpoint, api_keys, prompt_pool, args.seed, args.mode)
+                results[endpoint] = await run_endpoint(client, scenario, args.requests, args.concurrency, args.warmup)
+    finally:
+        gemini_service.tracker.stop()
+
+    return {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "async_io": args.async_io,
+            "supabase_ms": args.supabase_ms,
+            "gemini_ms": args.gemini_ms,
+            "upload_ms": args.upload_ms,
+            "sigma": args.sigma,
+            "supabase_error_rate": args.supabase_error_rate,
+            "gemini_error_rate": args.gemini_error_rate,
+            "users": args.users,
+            "prompt_pool": args.prompt_pool,
+            "mode": args.mode,
+            "rate_limit": args.rate_limit,
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=20, help="API keys to spread requests over")
+    parser.add_argument("--prompt-pool", type=int, default=0, help="reuse N prompts (exercises the retrieval cache); 0 = every prompt new")
+    parser.add_argument("--mode", choices=("retrieve_only", "synthesize", "auto"), help="context mode for /context/retrieve")
+    parser.add_argument("--supabase-ms", type=float, default=15.0, help="median Supabase latency")
+    parser.add_argument("--gemini-ms", type=float, default=400.0, help="median generate_content latency")
+    parser.add_argument("--upload-ms", type=float, default=150.0, help="median File Search upload latency")
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal spread of upstream latency")
+    parser.add_argument("--supabase-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", action="store_true", help="keep per-key and per-user rate limits on")
+    parser.add_argument("--sync-io", dest="async_io", action="store_false", help="use the thread-pool I/O path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        json.dump(report, sys.stdout)
+        print()
+        return
+
+    for endpoint, r in report["results"].items():
+        print(
+            f"{endpoint:>16}: {r['rps']:8.1f} req/s  p50 {r['p50_ms']:8.1f} ms  p95 {r['p95_ms']:8.1f} ms  "
+            f"p99 {r['p99_ms']:8.1f} ms  errors {r['errors']}  rejected {r['rejected']}  degraded {r['degraded']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
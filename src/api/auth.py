@@ -1,6 +1,11 @@
 from fastapi import Header, HTTPException, Depends
 from typing import Optional
-from .database import db
+from .config import settings
+from .database import db, hash_api_key
+from .metrics import RATE_LIMITED, stage
+from .rate_limit import rate_limiter, RateLimitedError
+import hmac
+import math
 
 
 async def verify_api_key(x_api_key: str = Header(..., alias="X-API-Key")) -> dict:
@@ -8,15 +13,39 @@ async def verify_api_key(x_api_key: str = Header(..., alias="X-API-Key")) -> dic
     if not x_api_key:
         raise HTTPException(status_code=401, detail="API key required")
     
-    user_info = db.verify_api_key(x_api_key)
-    
-    if not user_info:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    # Hashing, the key cache and the rate limits; a Supabase lookup is timed on its own
+    with stage("auth"):
+        user_info = await db.averify_api_key(x_api_key)
+        
+        if not user_info:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        
+        await check_rate_limit(x_api_key, user_info["user_id"])
     
     return user_info
 
 
+async def check_rate_limit(api_key: str, user_id: str, cost: float = 1.0):
+    """Count `cost` requests against the key's and user's rate limits. Raises a 429 when either is exhausted."""
+    try:
+        await rate_limiter.check(hash_api_key(api_key), user_id, cost)
+    except RateLimitedError as e:
+        RATE_LIMITED.labels(scope=e.scope).inc()
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+
+
 def get_user_id(user_info: dict = Depends(verify_api_key)) -> str:
     """Extract user_id from verified API key."""
     return user_info["user_id"]
 
+
+async def verify_admin_key(x_admin_key: Optional[str] = Header(None, alias="X-Admin-Key")):
+    """Allow only requests bearing ADMIN_API_KEY. Admin endpoints are hidden while it is unset."""
+    if not settings.admin_api_key:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_key or not hmac.compare_digest(x_admin_key.encode(), settings.admin_api_key.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin key")
@@ -0,0 +1,148 @@
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from .concurrency import OverloadedError
+from .config import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(OverloadedError):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+    def __init__(self, upstream: str, retry_after: int = 1):
+        super().__init__(upstream, retry_after)
+        self.args = (f"{upstream} is unavailable, retry later",)
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing or answering slowly.
+
+    Closed, it tracks the last `window` calls, and opens once at least
+    `min_calls` of them are in and the fraction that failed or took longer
+    than `slow_call_seconds` reaches `failure_threshold`. Open, it refuses
+    calls for `open_seconds`, then half-opens and lets `probes` calls through:
+    if they all succeed it closes, and any failure reopens it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        slow_call_seconds: float,
+        window: int = 20,
+        min_calls: int = 10,
+        failure_threshold: float = 0.5,
+        open_seconds: float = 30.0,
+        probes: int = 3,
+        clock=time.monotonic
+    ):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self._clock = clock
+        self.state = CLOSED
+        self.opens = 0
+        self.rejected = 0
+        # True for each recent call that failed or was slow
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._open_until = 0.0
+        self._probes_inflight = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opens += 1
+        self._open_until = now + self.open_seconds
+        self._outcomes.clear()
+
+    def acquire(self) -> Optional[str]:
+        """Admit a call. Returns the state it was admitted in, or None if refused."""
+        with self._lock:
+            if self.state == OPEN and self._clock() >= self._open_until:
+                self.state = HALF_OPEN
+                self._probes_inflight = 0
+                self._probe_successes = 0
+            if self.state == CLOSED:
+                return CLOSED
+            if self.state == HALF_OPEN and self._probes_inflight < self.probes:
+                self._probes_inflight += 1
+                return HALF_OPEN
+            self.rejected += 1
+            return None
+
+    def release(self, admitted: str, latency: float, error: Optional[BaseException] = None):
+        """Record the outcome of a call admitted in state `admitted`."""
+        if isinstance(error, OverloadedError) or (error is not None and not isinstance(error, Exception)):
+            # Shed by this service, or cancelled: says nothing about the upstream
+            failed = None
+        else:
+            failed = error is not None or latency > self.slow_call_seconds
+
+        with self._lock:
+            if admitted == HALF_OPEN:
+                self._probes_inflight -= 1
+                if self.state != HALF_OPEN or failed is None:
+                    return
+                if failed:
+                    self._open(self._clock())
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self.state = CLOSED
+                return
+
+            # Calls admitted before the breaker opened no longer count
+            if self.state != CLOSED or failed is None:
+                return
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls and sum(self._outcomes) / len(self._outcomes) >= self.failure_threshold:
+                self._open(self._clock())
+
+    def retry_after(self) -> int:
+        """Whole seconds until the breaker will let a probe through."""
+        return max(1, math.ceil(self._open_until - self._clock()))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the state, recent failure rate, times opened and calls refused."""
+        with self._lock:
+            outcomes = list(self._outcomes)
+        return {
+            "state": self.state,
+            "failure_rate": round(sum(outcomes) / len(outcomes), 3) if outcomes else 0.0,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
+
+
+def _breaker(name: str, slow_call_seconds: float) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        slow_call_seconds,
+        window=settings.breaker_window,
+        min_calls=settings.breaker_min_calls,
+        failure_threshold=settings.breaker_failure_threshold,
+        open_seconds=settings.breaker_open_seconds,
+        probes=settings.breaker_half_open_probes
+    )
+
+
+circuit_breakers: Dict[str, CircuitBreaker] = {
+    "gemini": _breaker("gemini", settings.gemini_slow_call_seconds),
+    "supabase": _breaker("supabase", settings.supabase_slow_call_seconds),
+}
+
+
+def breaker_for(upstream: str) -> Optional[CircuitBreaker]:
+    """The circuit breaker for an upstream, or None if it has none."""
+    if not settings.circuit_breakers:
+        return None
+    return circuit_breakers.get(upstream)
@@ -0,0 +1,124 @@
+import asyncio
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from .config import settings
+
+
+class OverloadedError(Exception):
+    """Raised when a call is shed because its upstream is at its concurrency limit."""
+
+    def __init__(self, upstream: str, retry_after: int = 1):
+        super().__init__(f"{upstream} is overloaded, retry later")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def is_overload(error: BaseException) -> bool:
+    """Whether an upstream error signals overload: a timeout, or an HTTP 429 or 503."""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    # Not imported here: an httpx error can only exist once something else has
+    httpx = sys.modules.get("httpx")
+    if httpx is not None and isinstance(error, httpx.TimeoutException):
+        return True
+    response = getattr(error, "response", None)
+    statuses = (getattr(error, "code", None), getattr(error, "status_code", None), getattr(response, "status_code", None))
+    return any(str(status) in ("429", "503") for status in statuses)
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit on calls to one upstream.
+
+    Calls over the limit are shed at once rather than queued. Each call that
+    finishes within `latency_target` raises the limit by 1/limit (about one per
+    limit's worth of calls); a slow call, a timeout or a 429/503 multiplies it
+    by `backoff`, at most once per `latency_target` so that one burst of slow
+    calls counts once.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        backoff: float = 0.5,
+        clock=time.monotonic
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._clock = clock
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.inflight = 0
+        self.shed = 0
+        self.decreases = 0
+        self._last_decrease = float("-inf")
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """Take a slot if one is free under the current limit."""
+        with self._lock:
+            if self.inflight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self, latency: float, error: Optional[BaseException] = None):
+        """Free a slot and adjust the limit from the call's latency and outcome."""
+        with self._lock:
+            self.inflight -= 1
+            if (error is not None and is_overload(error)) or latency > self.latency_target:
+                now = self._clock()
+                if now - self._last_decrease >= self.latency_target:
+                    self._last_decrease = now
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.decreases += 1
+            elif error is None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def cancel(self):
+        """Free a slot for a call that was never made, without adjusting the limit."""
+        with self._lock:
+            self.inflight -= 1
+
+    def stats(self) -> Dict[str, float]:
+        """Return the current limit, calls in flight, calls shed and limit decreases."""
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "shed": self.shed,
+            "decreases": self.decreases,
+        }
+
+
+upstream_limiters: Dict[str, AdaptiveLimiter] = {
+    "gemini": AdaptiveLimiter(
+        "gemini",
+        settings.gemini_concurrency_initial,
+        settings.gemini_concurrency_min,
+        settings.gemini_concurrency_max,
+        settings.gemini_latency_target
+    ),
+    "supabase": AdaptiveLimiter(
+        "supabase",
+        settings.supabase_concurrency_initial,
+        settings.supabase_concurrency_min,
+        settings.supabase_concurrency_max,
+        settings.supabase_latency_target
+    ),
+}
+
+
+def limiter_for(upstream: str) -> Optional[AdaptiveLimiter]:
+    """The concurrency limiter for an upstream, or None if it is not limited."""
+    if not settings.adaptive_concurrency:
+        return None
+    return upstream_limiters.get(upstream)
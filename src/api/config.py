@@ -5,18 +5,170 @@ from typing import Optional
 class Settings(BaseSettings):
     """Application settings loaded from environment variables."""
     
-    # Supabase
-    supabase_url: str
-    supabase_key: str
+    # Supabase (checked when the client is first used, so that importing the app needs no env)
+    supabase_url: Optional[str] = None
+    supabase_key: Optional[str] = None
     
-    # Gemini
-    gemini_api_key: str
+    # Gemini (optional with the local retrieval backend)
+    gemini_api_key: Optional[str] = None
+    # Global File Search store; set it to skip listing stores at startup. Otherwise the
+    # store found or created is remembered in `store_name_cache_path` for the next start
+    # with the same API key, and looked up again if it has been deleted since.
+    gemini_store_name: Optional[str] = None
+    store_name_cache_path: str = ".gemini_store_name"
+    
+    # File Search partitioning: "global" (one shared store) or "user" (one store per user)
+    store_partitioning: str = "global"
+    
+    # Retrieval backend: "gemini" (File Search) or "local" (on-disk vector index)
+    retrieval_backend: str = "gemini"
+    vector_index_path: str = ".vector_index"
+    embedder: str = "hashing"  # "hashing" (offline) or "gemini"
+    embedding_model: str = "gemini-embedding-001"
+    embedding_dim: int = 768
+    vector_index_ivf_min_size: int = 4096
+    vector_index_nprobe: int = 8
+    local_synthesize: bool = False  # Default to "synthesize" mode with the local backend
     
     # API Settings
     api_title: str = "Context API"
     api_version: str = "1.0.0"
     api_prefix: str = "/api/v1"
     
+    # Upstream I/O: use the async Supabase and Gemini clients, with per-call timeouts in seconds
+    async_io: bool = True
+    supabase_timeout: float = 10.0
+    gemini_timeout: float = 60.0
+    
+    # Cache backend for API keys, user stores and retrievals: "memory" (per process),
+    # "mmap" (a memory-mapped file shared by the workers on a host) or "redis" (shared by all)
+    cache_backend: str = "memory"
+    cache_mmap_dir: Optional[str] = None  # default: /dev/shm/context-api, else the temp dir
+    cache_redis_url: str = "redis://localhost:6379/1"
+    cache_redis_prefix: str = "cache:"
+    cache_redis_timeout: float = 0.25
+    
+    # API key verification cache
+    api_key_cache_size: int = 10000
+    api_key_cache_ttl: float = 300.0
+    api_key_negative_cache_ttl: float = 30.0
+    
+    # Rate limiting: token buckets per API key and per user (requests per second, burst size)
+    rate_limit_enabled: bool = True
+    rate_limit_backend: str = "memory"  # "memory" (per process) or "redis" (shared by all processes)
+    rate_limit_redis_url: str = "redis://localhost:6379/0"
+    rate_limit_max_keys: int = 100000  # buckets held in memory
+    api_key_rate_limit: float = 10.0
+    api_key_rate_burst: int = 20
+    user_rate_limit: float = 20.0
+    user_rate_burst: int = 40
+    
+    # Adaptive (AIMD) concurrency limits on upstream calls made while serving requests;
+    # calls over the limit are shed with a 503. Latency targets are in seconds.
+    adaptive_concurrency: bool = True
+    gemini_concurrency_initial: int = 32
+    gemini_concurrency_min: int = 4
+    gemini_concurrency_max: int = 256
+    gemini_latency_target: float = 10.0
+    supabase_concurrency_initial: int = 64
+    supabase_concurrency_min: int = 8
+    supabase_concurrency_max: int = 512
+    supabase_latency_target: float = 1.0
+    
+    # Circuit breakers on upstream calls made while serving requests: open once this fraction
+    # of the last `breaker_window` calls failed or were slow, then probe after `breaker_open_seconds`
+    circuit_breakers: bool = True
+    breaker_window: int = 20
+    breaker_min_calls: int = 10
+    breaker_failure_threshold: float = 0.5
+    breaker_open_seconds: float = 30.0
+    breaker_half_open_probes: int = 3
+    gemini_slow_call_seconds: float = 15.0
+    supabase_slow_call_seconds: float = 2.0
+    recent_traces_per_user: int = 50  # kept in memory to answer from while Gemini's breaker is open
+    recent_traces_max_users: int = 10000
+    
+    # Context retrieval cache
+    retrieval_cache_size: int = 10000
+    retrieval_cache_ttl: float = 600.0
+    retrieval_cache_near_duplicates: bool = False  # answer similar (not just equal) prompts from the cache
+    retrieval_cache_similarity_threshold: float = 0.9
+    retrieval_cache_slot_bytes: int = 16384  # largest result shared by the mmap backend
+    
+    # Context mode when a request does not choose one: "retrieve_only", "synthesize" or "auto"
+    context_mode: str = "auto"
+    retrieval_model: str = "gemini-2.5-flash"  # runs File Search; its own output is discarded
+    retrieval_max_output_tokens: int = 16
+    synthesis_model: str = "gemini-2.5-flash"  # writes context in synthesize and auto modes
+    synthesis_input_tokens: int = 8000  # retrieved traces given to the synthesis model
+    
+    # Context assembly: default token budget, and how much recency weighs against relevance
+    context_token_budget: int = 2000
+    context_recency_weight: float = 0.2
+    context_recency_half_life: float = 7 * 86400  # seconds
+    context_min_chunk_tokens: int = 32  # smallest truncated chunk worth including
+    
+    # Trace ingestion (write-behind queue)
+    trace_write_behind: bool = False
+    trace_queue_path: str = ".trace_queue.db"
+    trace_queue_max_size: int = 10000
+    trace_queue_workers: int = 4
+    trace_queue_max_attempts: int = 5
+    trace_queue_batch_size: int = 100
+    # Leased traces not written within this many seconds are handed to another worker
+    trace_queue_lease_seconds: float = 300.0
+    # Traces that ran out of attempts are kept this long for status lookups, then deleted
+    trace_queue_failed_retention_seconds: float = 7 * 86400
+    
+    # Polling of File Search upload operations (seconds, doubled per poll)
+    operation_poll_min_interval: float = 0.25
+    operation_poll_max_interval: float = 8.0
+    
+    # Batch retrieval: prompts per request, and how many of them are retrieved at once
+    context_batch_max_items: int = 50
+    context_batch_concurrency: int = 8
+    
+    # Batched uploads pack many traces into one JSONL document
+    trace_batch_max_items: int = 1000
+    trace_document_max_bytes: int = 1_000_000
+    
+    # Identical traces (same user, input and output) get the same content-derived trace_id;
+    # a repeat increments the stored trace's hit count instead of being uploaded again
+    trace_dedup: bool = True
+    
+    # Trace listing: largest page of GET /traces, and rows fetched per page by GET /traces/export
+    trace_list_max_limit: int = 1000
+    trace_export_page_size: int = 1000
+    
+    # Per-user trace retention, enforced by a background compaction job; 0 disables a limit.
+    # Traces are evicted least recently seen first, from the File Search store and trace_metadata.
+    trace_retention_days: float = 0
+    trace_retention_max_traces: int = 0
+    trace_retention_max_bytes: int = 0
+    trace_compaction_interval: float = 3600.0  # seconds between runs
+    trace_compaction_batch_size: int = 500  # traces evicted per user per round trip
+    trace_compaction_max_per_run: int = 1000  # the rest wait for the next run; PostgREST returns 1000 rows at most
+    # An upload still pending this long is taken for lost: storing the trace again uploads
+    # it anew, and retention may evict it
+    trace_pending_lease_seconds: float = 3600.0
+    
+    # Wire formats: responses at least this large are compressed (zstd, else gzip) when the client accepts it,
+    # and compressed or MessagePack request bodies are refused past this size once decoded
+    wire_compress_min_bytes: int = 1024
+    wire_max_request_bytes: int = 32 * 1024 * 1024
+    
+    # Admin endpoints (/admin/...) are enabled by setting a key, sent in the X-Admin-Key header
+    admin_api_key: Optional[str] = None
+    
+    # Sampling profiler started through /admin/profiler: seconds between stack samples, longest session
+    profiler_interval: float = 0.01
+    profiler_max_duration: float = 300.0
+    
+    # Requests slower than this get a per-stage breakdown kept in a ring buffer per process,
+    # served by /admin/slow-requests; 0 disables
+    slow_request_threshold_ms: float = 1000.0
+    slow_request_buffer_size: int = 200
+    
     # CORS
     cors_origins: list[str] = ["*"]
     
@@ -0,0 +1,204 @@
+import hashlib
+import math
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .retrieval_cache import normalize_prompt
+
+# Approximate characters per token of English text, by model family.
+# Matched by prefix against the lowercased model name; first match wins.
+_CHARS_PER_TOKEN: List[Tuple[str, float]] = [
+    ("gpt-4o", 4.2),
+    ("gpt-4.1", 4.2),
+    ("gpt-5", 4.2),
+    ("o1", 4.2),
+    ("o3", 4.2),
+    ("o4", 4.2),
+    ("gpt", 4.0),
+    ("claude", 3.5),
+    ("gemini", 4.0),
+    ("llama", 3.8),
+    ("mistral", 3.6),
+    ("mixtral", 3.6),
+]
+_DEFAULT_CHARS_PER_TOKEN = 3.8
+
+# Fields read out of serialized trace JSON inside File Search chunks
+_TRACE_ID = re.compile(r'"trace_id"\s*:\s*"([^"]+)"')
+_CREATED_AT = re.compile(r'"created_at"\s*:\s*([0-9]+(?:\.[0-9]+)?)')
+
+CHUNK_SEPARATOR = "\n\n"
+
+
+def chars_per_token(model: Optional[str]) -> float:
+    """Characters per token for a model family."""
+    name = (model or "").lower()
+    for prefix, ratio in _CHARS_PER_TOKEN:
+        if name.startswith(prefix):
+            return ratio
+    return _DEFAULT_CHARS_PER_TOKEN
+
+
+def estimate_tokens(text: str, model: Optional[str] = None) -> int:
+    """Estimate the token count of `text` for a model, without a tokenizer.
+
+    ASCII text is counted at the model family's characters-per-token ratio;
+    other characters (CJK, emoji, accents) are counted as a token each, which
+    errs on the side of overestimating.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / chars_per_token(model) + (len(text) - ascii_chars))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """Cut `text` at a word boundary so that it fits in `max_tokens`."""
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+    limit = int(max_tokens * chars_per_token(model)) - 1
+    cut = text[:max(limit, 0)]
+    while cut and estimate_tokens(cut + "…", model) > max_tokens:
+        cut = cut[:int(len(cut) * 0.9)]
+    space = cut.rfind(" ")
+    if space > len(cut) // 2:
+        cut = cut[:space]
+    return cut.rstrip() + "…" if cut else ""
+
+
+def chunk_text(chunk: Dict[str, Any]) -> str:
+    """The text a retrieved chunk contributes to the context."""
+    if chunk.get("text"):
+        return chunk["text"]
+    if chunk.get("prompt") is not None or chunk.get("output") is not None:
+        # A trace record from the local index
+        text = f"Prompt: {chunk.get('prompt')}\nOutput: {chunk.get('output')}"
+        if chunk.get("model"):
+            text += f"\nModel: {chunk.get('model')}"
+        return text
+    inner = chunk.get("chunk")
+    if isinstance(inner, dict):
+        return inner.get("text") or ""
+    return getattr(inner, "text", None) or (str(inner) if inner else "")
+
+
+def normalize_chunk(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """Give a retrieved chunk `text`, `relevance_score` and, where known, `trace_id` and `created_at`."""
+    text = chunk_text(chunk)
+    normalized = {key: value for key, value in chunk.items() if key != "chunk"}
+    normalized["text"] = text
+    normalized["relevance_score"] = float(chunk.get("relevance_score") or 0.0)
+    if not normalized.get("trace_id"):
+        match = _TRACE_ID.search(text)
+        if match:
+            normalized["trace_id"] = match.group(1)
+    if normalized.get("created_at") is None:
+        match = _CREATED_AT.search(text)
+        if match:
+            normalized["created_at"] = float(match.group(1))
+    return normalized
+
+
+def chunk_key(chunk: Dict[str, Any]) -> str:
+    """Identity of a chunk's content: a hash of its text, ignoring case and whitespace."""
+    return hashlib.sha256(normalize_prompt(chunk_text(chunk)).encode()).hexdigest()
+
+
+def dedupe_chunks(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop chunks whose text repeats another's (ignoring case and whitespace), keeping the most relevant."""
+    best: Dict[str, Dict[str, Any]] = {}
+    order: List[str] = []
+    for chunk in chunks:
+        key = chunk_key(chunk)
+        if key not in best:
+            order.append(key)
+            best[key] = chunk
+        elif chunk["relevance_score"] > best[key]["relevance_score"]:
+            best[key] = chunk
+    return [best[key] for key in order if best[key]["text"]]
+
+
+def rerank_chunks(
+    chunks: List[Dict[str, Any]],
+    recency_weight: float,
+    half_life: float,
+    now: Optional[float] = None
+) -> List[Dict[str, Any]]:
+    """Order chunks by a blend of relevance and recency, best first.
+
+    Recency decays by half every `half_life` seconds; chunks with no known
+    age get no recency credit.
+    """
+    now = time.time() if now is None else now
+    for chunk in chunks:
+        created_at = chunk.get("created_at")
+        recency = 0.5 ** (max(now - created_at, 0.0) / half_life) if isinstance(created_at, (int, float)) else 0.0
+        chunk["score"] = round((1 - recency_weight) * chunk["relevance_score"] + recency_weight * recency, 6)
+    return sorted(chunks, key=lambda chunk: chunk["score"], reverse=True)
+
+
+def pack_chunks(
+    chunks: List[Dict[str, Any]],
+    token_budget: int,
+    model: Optional[str],
+    max_chunks: int,
+    min_chunk_tokens: int = 32
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Greedily fit ranked chunks into a token budget.
+
+    A chunk that does not fit is truncated if at least `min_chunk_tokens`
+    remain, and packing stops there. Returns (chunks, tokens used).
+    """
+    separator_tokens = estimate_tokens(CHUNK_SEPARATOR, model)
+    packed: List[Dict[str, Any]] = []
+    used = 0
+    for chunk in chunks:
+        if len(packed) >= max_chunks:
+            break
+        cost = separator_tokens if packed else 0
+        remaining = token_budget - used - cost
+        tokens = estimate_tokens(chunk["text"], model)
+        if tokens <= remaining:
+            packed.append(dict(chunk, tokens=tokens, truncated=False))
+            used += cost + tokens
+            continue
+        if remaining >= min_chunk_tokens:
+            text = truncate_to_tokens(chunk["text"], remaining, model)
+            tokens = estimate_tokens(text, model)
+            packed.append(dict(chunk, text=text, tokens=tokens, truncated=True))
+            used += cost + tokens
+        break
+    return packed, used
+
+
+def assemble_context(
+    chunks: List[Dict[str, Any]],
+    model: Optional[str],
+    token_budget: int,
+    max_chunks: int,
+    recency_weight: float = 0.2,
+    half_life: float = 7 * 86400,
+    min_chunk_tokens: int = 32
+) -> Dict[str, Any]:
+    """Dedupe, rerank and pack retrieved chunks into a token budget.
+
+    Returns the packed chunks, the context text built from them, and
+    accounting for the response.
+    """
+    normalized = [normalize_chunk(chunk) for chunk in chunks]
+    unique = dedupe_chunks(normalized)
+    ranked = rerank_chunks(unique, recency_weight, half_life)
+    packed, used = pack_chunks(ranked, token_budget, model, max_chunks, min_chunk_tokens)
+    return {
+        "text": CHUNK_SEPARATOR.join(chunk["text"] for chunk in packed),
+        "chunks": packed,
+        "stats": {
+            "token_budget": token_budget,
+            "tokens_used": used,
+            "chunks_retrieved": len(chunks),
+            "chunks_unique": len(unique),
+            "chunks_included": len(packed),
+            "truncated": any(chunk["truncated"] for chunk in packed) or len(packed) < min(len(ranked), max_chunks),
+        },
+    }
@@ -1,16 +1,165 @@
-from supabase import create_client, Client
+from fastapi.concurrency import run_in_threadpool
 from .config import settings
+from .cache import MISSING
+from .shared_cache import make_cache
+from .metrics import caches, flights, span, timed
+from .singleflight import SingleFlight
+import asyncio
 import hashlib
+import importlib
 import secrets
-from typing import Optional, Dict, Any
+import threading
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, Tuple
+
+if TYPE_CHECKING:
+    from supabase import Client, AsyncClient
+
+
+def hash_api_key(api_key: str) -> str:
+    """Return the SHA-256 hex digest stored for an API key."""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def _trace_metadata_row(user_id: str, trace_id: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Build a trace_metadata row.
+
+    Leaves out `status`: new rows get the column default ('pending'), and a
+    retried write must not reset the status of a row already indexed.
+    """
+    return {
+        "user_id": user_id,
+        "trace_id": trace_id,
+        "provider": metadata.get("provider"),
+        "model": metadata.get("model"),
+        "success": metadata.get("success", True),
+        "tokens_used": metadata.get("tokens_used"),
+        "latency_ms": metadata.get("latency_ms"),
+        "size_bytes": metadata.get("size_bytes")
+    }
+
+
+def _pending_lease() -> str:
+    return f"{settings.trace_pending_lease_seconds} seconds"
+
+
+def _record_traces_params(user_id: str, rows: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    """Arguments of the record_traces function."""
+    return {
+        "p_user_id": user_id,
+        "p_traces": [_trace_metadata_row(user_id, trace_id, metadata) for trace_id, metadata in rows],
+        "p_pending_lease": _pending_lease()
+    }
+
+
+def _expired_traces_params(limit: int) -> Dict[str, Any]:
+    """Arguments of the expired_traces function for the configured retention limits."""
+    return {
+        "p_max_age": f"{settings.trace_retention_days * 86400} seconds" if settings.trace_retention_days else None,
+        "p_max_traces": settings.trace_retention_max_traces or None,
+        "p_max_bytes": settings.trace_retention_max_bytes or None,
+        "p_limit": limit,
+        "p_pending_lease": _pending_lease(),
+        # The local index drops traces by trace_id; File Search needs the document holding them
+        "p_require_document": settings.retrieval_backend != "local"
+    }
+
+
+_TRACE_STATS_COLUMNS = (
+    "bucket, provider, model, traces, successes, tokens_used, "
+    "latency_count, latency_sum_ms, latency_max_ms, latency_histogram"
+)
+# Rollup rows fetched per request; PostgREST caps responses at 1000 rows by default
+_TRACE_STATS_PAGE = 1000
+
+
+def _user_info(result) -> Optional[Dict[str, Any]]:
+    """Extract user info from an api_keys lookup joined with users."""
+    if result.data:
+        api_key_data = result.data[0]
+        return {
+            "user_id": api_key_data["user_id"],
+            "email": api_key_data["users"]["email"]
+        }
+    return None
 
 
 class Database:
-    """Supabase database client wrapper."""
+    """Supabase database client wrapper.
+    
+    Each method has an `a`-prefixed coroutine counterpart that uses the async
+    Supabase client, or runs the sync method in a worker thread when
+    `settings.async_io` is off. Both clients are created on first use.
+    """
     
     def __init__(self):
-        self.client: Client = create_client(settings.supabase_url, settings.supabase_key)
+        self._client: Optional["Client"] = None
+        self._client_lock = threading.Lock()
+        # Created on first use, since creating it needs a running event loop
+        self.async_client: Optional["AsyncClient"] = None
+        self._async_client_lock: Optional[asyncio.Lock] = None
+        # Verified keys (and misses, for a shorter time) keyed by key hash
+        self.api_key_cache = make_cache(
+            "api_keys",
+            max_size=settings.api_key_cache_size,
+            ttl=settings.api_key_cache_ttl,
+            slot_size=2048
+        )
+        caches.register("api_key", self.api_key_cache)
+        self.api_key_flight = SingleFlight("verify_api_key")
+        flights.register(self.api_key_flight)
+    
+    @staticmethod
+    def _credentials() -> Tuple[str, str]:
+        if not settings.supabase_url or not settings.supabase_key:
+            raise RuntimeError("SUPABASE_URL and SUPABASE_KEY are required")
+        return settings.supabase_url, settings.supabase_key
+    
+    @property
+    def client(self) -> "Client":
+        """The sync Supabase client, created on first use."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    # Deferred: importing supabase is a noticeable part of startup
+                    from supabase import create_client
+                    self._client = create_client(*self._credentials())
+        return self._client
+    
+    @client.setter
+    def client(self, client: "Client"):
+        self._client = client
+    
+    async def get_async_client(self) -> "AsyncClient":
+        """Return the shared async Supabase client, creating it on first use."""
+        if self.async_client is None:
+            if self._async_client_lock is None:
+                self._async_client_lock = asyncio.Lock()
+            async with self._async_client_lock:
+                if self.async_client is None:
+                    from supabase import acreate_client
+                    self.async_client = await acreate_client(*self._credentials())
+        return self.async_client
+    
+    async def awarmup(self):
+        """Create the client used for requests ahead of the first request."""
+        if settings.async_io:
+            # Import in a worker thread, so as not to stall requests already being served
+            await run_in_threadpool(importlib.import_module, "supabase")
+            await self.get_async_client()
+        else:
+            await run_in_threadpool(lambda: self.client)
+    
+    async def _execute(self, query):
+        """Execute an async query builder with the Supabase timeout."""
+        return await asyncio.wait_for(query.execute(), timeout=settings.supabase_timeout)
+    
+    async def aclose(self):
+        """Close the async client's connection pool."""
+        if self.async_client is not None:
+            await self.async_client.postgrest.aclose()
+            self.async_client = None
     
+    @timed("supabase", "get_or_create_user")
     def get_or_create_user(self, email: str) -> Dict[str, Any]:
         """Get existing user or create a new one."""
         # Try to get existing user
@@ -23,11 +172,27 @@ class Database:
         result = self.client.table("users").insert({"email": email}).execute()
         return result.data[0]
     
+    @timed("supabase", "get_or_create_user")
+    async def aget_or_create_user(self, email: str) -> Dict[str, Any]:
+        """Get existing user or create a new one."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.get_or_create_user, email)
+        
+        client = await self.get_async_client()
+        result = await self._execute(client.table("users").select("*").eq("email", email))
+        
+        if result.data:
+            return result.data[0]
+        
+        result = await self._execute(client.table("users").insert({"email": email}))
+        return result.data[0]
+    
+    @timed("supabase", "create_api_key")
     def create_api_key(self, user_id: str) -> tuple[str, str]:
         """Create a new API key for a user. Returns (api_key, key_hash)."""
         # Generate API key
         api_key = f"ctx_{secrets.token_urlsafe(32)}"
-        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        key_hash = hash_api_key(api_key)
         key_prefix = api_key[:12]  # First 12 chars for display
         
         # Store in database
@@ -37,37 +202,370 @@ class Database:
             "key_prefix": key_prefix
         }).execute()
         
+        # Drop any cached miss for this hash
+        self.api_key_cache.delete(key_hash)
+        
         return api_key, key_hash
     
+    @timed("supabase", "create_api_key")
+    async def acreate_api_key(self, user_id: str) -> tuple[str, str]:
+        """Create a new API key for a user. Returns (api_key, key_hash)."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.create_api_key, user_id)
+        
+        api_key = f"ctx_{secrets.token_urlsafe(32)}"
+        key_hash = hash_api_key(api_key)
+        
+        client = await self.get_async_client()
+        await self._execute(client.table("api_keys").insert({
+            "user_id": user_id,
+            "key_hash": key_hash,
+            "key_prefix": api_key[:12]
+        }))
+        
+        await self.api_key_cache.adelete(key_hash)
+        
+        return api_key, key_hash
+    
+    @timed("supabase", "revoke_api_key")
+    def revoke_api_key(self, api_key: str) -> bool:
+        """Delete an API key. Returns True if a key was removed."""
+        key_hash = hash_api_key(api_key)
+        
+        result = self.client.table("api_keys").delete().eq("key_hash", key_hash).execute()
+        
+        # Stop accepting the key immediately (in every process, with a shared cache)
+        self.api_key_cache.delete(key_hash)
+        
+        return bool(result.data)
+    
+    @timed("supabase", "revoke_api_key")
+    async def arevoke_api_key(self, api_key: str) -> bool:
+        """Delete an API key. Returns True if a key was removed."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.revoke_api_key, api_key)
+        
+        key_hash = hash_api_key(api_key)
+        
+        client = await self.get_async_client()
+        result = await self._execute(client.table("api_keys").delete().eq("key_hash", key_hash))
+        
+        await self.api_key_cache.adelete(key_hash)
+        
+        return bool(result.data)
+    
+    def _cache_user_info(self, key_hash: str, user_info: Optional[Dict[str, Any]]):
+        # Cache invalid keys too, for less time, so they are rejected without a round trip
+        self.api_key_cache.set(
+            key_hash,
+            user_info,
+            ttl=settings.api_key_cache_ttl if user_info else settings.api_key_negative_cache_ttl
+        )
+    
+    async def _acache_user_info(self, key_hash: str, user_info: Optional[Dict[str, Any]]):
+        await self.api_key_cache.aset(
+            key_hash,
+            user_info,
+            ttl=settings.api_key_cache_ttl if user_info else settings.api_key_negative_cache_ttl
+        )
+    
     def verify_api_key(self, api_key: str) -> Optional[Dict[str, Any]]:
         """Verify an API key and return user info if valid."""
-        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        key_hash = hash_api_key(api_key)
         
-        result = self.client.table("api_keys").select("*, users(*)").eq("key_hash", key_hash).execute()
+        cached = self.api_key_cache.get(key_hash)
+        if cached is not MISSING:
+            return cached
         
-        if result.data:
-            api_key_data = result.data[0]
-            return {
-                "user_id": api_key_data["user_id"],
-                "email": api_key_data["users"]["email"]
-            }
+        with span("supabase", "verify_api_key"):
+            result = self.client.table("api_keys").select("*, users(*)").eq("key_hash", key_hash).execute()
+        
+        user_info = _user_info(result)
+        self._cache_user_info(key_hash, user_info)
         
-        return None
+        return user_info
     
-    def store_trace_metadata(self, user_id: str, trace_id: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
-        """Store trace metadata in Supabase."""
-        result = self.client.table("trace_metadata").insert({
-            "user_id": user_id,
-            "trace_id": trace_id,
-            "provider": metadata.get("provider"),
-            "model": metadata.get("model"),
-            "success": metadata.get("success", True),
-            "tokens_used": metadata.get("tokens_used"),
-            "latency_ms": metadata.get("latency_ms")
+    async def averify_api_key(self, api_key: str) -> Optional[Dict[str, Any]]:
+        """Verify an API key and return user info if valid."""
+        key_hash = hash_api_key(api_key)
+        
+        cached = await self.api_key_cache.aget(key_hash)
+        if cached is not MISSING:
+            return cached
+        
+        # Concurrent lookups of the same key share one query
+        return await self.api_key_flight.do(key_hash, lambda: self._averify_api_key(api_key, key_hash))
+    
+    async def _averify_api_key(self, api_key: str, key_hash: str) -> Optional[Dict[str, Any]]:
+        if not settings.async_io:
+            return await run_in_threadpool(self.verify_api_key, api_key)
+        
+        client = await self.get_async_client()
+        with span("supabase", "verify_api_key"):
+            result = await self._execute(
+                client.table("api_keys").select("*, users(*)").eq("key_hash", key_hash)
+            )
+        
+        user_info = _user_info(result)
+        await self._acache_user_info(key_hash, user_info)
+        
+        return user_info
+    
+    @timed("supabase", "record_traces")
+    def record_traces(self, user_id: str, rows: List[Tuple[str, Dict[str, Any]]]) -> List[str]:
+        """Record metadata for traces, counting repeats of stored ones. Rows are (trace_id, metadata) pairs.
+        
+        Returns the trace_ids that need uploading: new traces, and earlier
+        copies whose upload failed or has been pending longer than
+        `trace_pending_lease_seconds`.
+        """
+        if not rows:
+            return []
+        
+        result = self.client.rpc("record_traces", _record_traces_params(user_id, rows)).execute()
+        
+        return [row["trace_id"] for row in result.data or []]
+    
+    @timed("supabase", "record_traces")
+    async def arecord_traces(self, user_id: str, rows: List[Tuple[str, Dict[str, Any]]]) -> List[str]:
+        """Record metadata for traces, counting repeats of stored ones. Rows are (trace_id, metadata) pairs."""
+        if not rows:
+            return []
+        
+        if not settings.async_io:
+            return await run_in_threadpool(self.record_traces, user_id, rows)
+        
+        client = await self.get_async_client()
+        result = await self._execute(client.rpc("record_traces", _record_traces_params(user_id, rows)))
+        
+        return [row["trace_id"] for row in result.data or []]
+    
+    @timed("supabase", "list_traces")
+    def list_traces(self, user_id: str, after: Optional[Tuple[str, str]], limit: int) -> List[Dict[str, Any]]:
+        """Return up to `limit` of the user's trace rows, newest first.
+        
+        `after` is the (created_at, id) of the last row of the previous page,
+        or None for the first page. Rows without a created_at come last.
+        """
+        created_at, row_id = after or (None, None)
+        result = self.client.rpc("list_traces", {
+            "p_user_id": user_id, "p_created_at": created_at, "p_id": row_id, "p_limit": limit
         }).execute()
         
-        return result.data[0] if result.data else {}
+        return result.data or []
+    
+    @timed("supabase", "list_traces")
+    async def alist_traces(self, user_id: str, after: Optional[Tuple[str, str]], limit: int) -> List[Dict[str, Any]]:
+        """Return up to `limit` of the user's trace rows, newest first."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.list_traces, user_id, after, limit)
+        
+        created_at, row_id = after or (None, None)
+        client = await self.get_async_client()
+        result = await self._execute(client.rpc("list_traces", {
+            "p_user_id": user_id, "p_created_at": created_at, "p_id": row_id, "p_limit": limit
+        }))
+        
+        return result.data or []
+    
+    @timed("supabase", "update_trace_status")
+    def update_trace_status(self, trace_ids: List[str], status: str, document_name: Optional[str] = None):
+        """Set the indexing status ("pending", "indexed" or "failed") of traces, and the document holding them."""
+        if not trace_ids:
+            return
+        
+        values = {"status": status}
+        if document_name:
+            values["document_name"] = document_name
+        self.client.table("trace_metadata").update(values).in_("trace_id", trace_ids).execute()
+    
+    @timed("supabase", "update_trace_status")
+    async def aupdate_trace_status(self, trace_ids: List[str], status: str, document_name: Optional[str] = None):
+        """Set the indexing status ("pending", "indexed" or "failed") of traces, and the document holding them."""
+        if not trace_ids:
+            return
+        
+        if not settings.async_io:
+            return await run_in_threadpool(self.update_trace_status, trace_ids, status, document_name)
+        
+        values = {"status": status}
+        if document_name:
+            values["document_name"] = document_name
+        client = await self.get_async_client()
+        await self._execute(client.table("trace_metadata").update(values).in_("trace_id", trace_ids))
+    
+    @timed("supabase", "expired_traces")
+    def expired_traces(self, limit: int) -> List[Dict[str, Any]]:
+        """Return up to `limit` traces past the retention limits, least recently seen first.
+        
+        Rows have user_id, trace_id and document_name. Uploads pending for less
+        than `trace_pending_lease_seconds` are not returned, nor, with File
+        Search, indexed traces whose document is not known.
+        """
+        result = self.client.rpc("expired_traces", _expired_traces_params(limit)).execute()
+        
+        return result.data or []
+    
+    @timed("supabase", "expired_traces")
+    async def aexpired_traces(self, limit: int) -> List[Dict[str, Any]]:
+        """Return up to `limit` traces past the retention limits, least recently seen first."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.expired_traces, limit)
+        
+        client = await self.get_async_client()
+        result = await self._execute(client.rpc("expired_traces", _expired_traces_params(limit)))
+        
+        return result.data or []
+    
+    @timed("supabase", "get_document_traces")
+    def get_document_traces(self, document_names: List[str]) -> List[Dict[str, Any]]:
+        """Return the trace_id and document_name of every trace held in the given documents."""
+        if not document_names:
+            return []
+        
+        result = self.client.table("trace_metadata").select("trace_id, document_name").in_(
+            "document_name", document_names
+        ).execute()
+        
+        return result.data or []
+    
+    @timed("supabase", "get_document_traces")
+    async def aget_document_traces(self, document_names: List[str]) -> List[Dict[str, Any]]:
+        """Return the trace_id and document_name of every trace held in the given documents."""
+        if not document_names:
+            return []
+        
+        if not settings.async_io:
+            return await run_in_threadpool(self.get_document_traces, document_names)
+        
+        client = await self.get_async_client()
+        result = await self._execute(
+            client.table("trace_metadata").select("trace_id, document_name").in_("document_name", document_names)
+        )
+        
+        return result.data or []
+    
+    @timed("supabase", "delete_traces")
+    def delete_traces(self, trace_ids: List[str]):
+        """Delete the metadata rows of traces. Their rollups are kept."""
+        if not trace_ids:
+            return
+        
+        self.client.table("trace_metadata").delete().in_("trace_id", trace_ids).execute()
+    
+    @timed("supabase", "delete_traces")
+    async def adelete_traces(self, trace_ids: List[str]):
+        """Delete the metadata rows of traces. Their rollups are kept."""
+        if not trace_ids:
+            return
+        
+        if not settings.async_io:
+            return await run_in_threadpool(self.delete_traces, trace_ids)
+        
+        client = await self.get_async_client()
+        await self._execute(client.table("trace_metadata").delete().in_("trace_id", trace_ids))
+    
+    @timed("supabase", "get_trace_status")
+    def get_trace_status(self, user_id: str, trace_id: str) -> Optional[Dict[str, Any]]:
+        """Return the status row of one of the user's traces."""
+        result = self.client.table("trace_metadata").select("trace_id, status, created_at").eq(
+            "user_id", user_id
+        ).eq("trace_id", trace_id).execute()
+        
+        return result.data[0] if result.data else None
+    
+    @timed("supabase", "get_trace_status")
+    async def aget_trace_status(self, user_id: str, trace_id: str) -> Optional[Dict[str, Any]]:
+        """Return the status row of one of the user's traces."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.get_trace_status, user_id, trace_id)
+        
+        client = await self.get_async_client()
+        result = await self._execute(
+            client.table("trace_metadata").select("trace_id, status, created_at").eq(
+                "user_id", user_id
+            ).eq("trace_id", trace_id)
+        )
+        
+        return result.data[0] if result.data else None
+    
+    def _trace_stats_query(self, client, user_id: str, granularity: str, start: str, offset: int):
+        table = "trace_stats_hourly" if granularity == "hour" else "trace_stats_daily"
+        return client.table(table).select(_TRACE_STATS_COLUMNS).eq("user_id", user_id).gte(
+            "bucket", start
+        ).order("bucket").range(offset, offset + _TRACE_STATS_PAGE - 1)
+    
+    @timed("supabase", "get_trace_stats")
+    def get_trace_stats(self, user_id: str, granularity: str, start: str) -> List[Dict[str, Any]]:
+        """Return the user's hourly or daily trace rollup rows from `start` (ISO timestamp) on."""
+        rows: List[Dict[str, Any]] = []
+        while True:
+            result = self._trace_stats_query(self.client, user_id, granularity, start, len(rows)).execute()
+            rows.extend(result.data)
+            if len(result.data) < _TRACE_STATS_PAGE:
+                return rows
+    
+    @timed("supabase", "get_trace_stats")
+    async def aget_trace_stats(self, user_id: str, granularity: str, start: str) -> List[Dict[str, Any]]:
+        """Return the user's hourly or daily trace rollup rows from `start` (ISO timestamp) on."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.get_trace_stats, user_id, granularity, start)
+        
+        client = await self.get_async_client()
+        rows: List[Dict[str, Any]] = []
+        while True:
+            result = await self._execute(self._trace_stats_query(client, user_id, granularity, start, len(rows)))
+            rows.extend(result.data)
+            if len(result.data) < _TRACE_STATS_PAGE:
+                return rows
+    
+    @timed("supabase", "get_user_store")
+    def get_user_store(self, user_id: str) -> Optional[str]:
+        """Return the name of the user's File Search store, if one was assigned."""
+        result = self.client.table("user_stores").select("store_name").eq("user_id", user_id).execute()
+        
+        return result.data[0]["store_name"] if result.data else None
+    
+    @timed("supabase", "get_user_store")
+    async def aget_user_store(self, user_id: str) -> Optional[str]:
+        """Return the name of the user's File Search store, if one was assigned."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.get_user_store, user_id)
+        
+        client = await self.get_async_client()
+        result = await self._execute(client.table("user_stores").select("store_name").eq("user_id", user_id))
+        
+        return result.data[0]["store_name"] if result.data else None
+    
+    @timed("supabase", "set_user_store")
+    def set_user_store(self, user_id: str, store_name: str) -> str:
+        """Assign a File Search store to a user unless one is already assigned.
+        
+        Returns the store that ended up assigned, which is an existing one if
+        another process assigned it first.
+        """
+        self.client.table("user_stores").upsert(
+            {"user_id": user_id, "store_name": store_name},
+            on_conflict="user_id",
+            ignore_duplicates=True
+        ).execute()
+        
+        return self.get_user_store(user_id) or store_name
+    
+    @timed("supabase", "set_user_store")
+    async def aset_user_store(self, user_id: str, store_name: str) -> str:
+        """Assign a File Search store to a user unless one is already assigned."""
+        if not settings.async_io:
+            return await run_in_threadpool(self.set_user_store, user_id, store_name)
+        
+        client = await self.get_async_client()
+        await self._execute(client.table("user_stores").upsert(
+            {"user_id": user_id, "store_name": store_name},
+            on_conflict="user_id",
+            ignore_duplicates=True
+        ))
+        
+        return await self.aget_user_store(user_id) or store_name
 
 
 db = Database()
-
@@ -1,26 +1,162 @@
-from google import genai
-from google.genai import types
-import json
-import uuid
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
+import asyncio
+import hashlib
+import io
+import os
+import threading
 import time
-from typing import Dict, Any, List, Optional
+import uuid
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Any, AsyncIterator, Callable, List, Optional, Tuple
 from .config import settings
+from .retrieval_cache import RetrievalCache, normalize_prompt
+from .singleflight import SingleFlight
+from .concurrency import OverloadedError
+from .circuit_breaker import CircuitOpenError
+from .recent_traces import RecentTraces
+from .cache import MISSING
+from .shared_cache import make_cache
+from .database import db
+from .operation_tracker import OperationTracker
+from .metrics import caches, flights, mark_degraded, span, timed
+from .wire import dumps_json
+from .context_assembly import assemble_context, estimate_tokens, truncate_to_tokens
+from concurrent.futures import Future
+import logging
+
+if TYPE_CHECKING:
+    from google import genai
+    from .vector_index import VectorIndex
+
+logger = logging.getLogger(__name__)
+
+# Called with (trace_ids, error, document_name) once uploaded traces are indexed; error is
+# None on success, and document_name the File Search document holding them, when known
+IndexedCallback = Callable[[List[str], Optional[BaseException], Optional[str]], None]
+
+
+def _document_name(operation: Any) -> Optional[str]:
+    """The document a finished upload operation created."""
+    return getattr(getattr(operation, "response", None), "document_name", None)
+
+
+def _is_not_found(error: Exception) -> bool:
+    return getattr(error, "code", None) == 404
+
+
+def format_traces(traces: List[Dict[str, Any]]) -> str:
+    """Render retrieved traces as compact context text."""
+    blocks = []
+    for trace in traces:
+        block = f"Prompt: {trace.get('prompt')}\nOutput: {trace.get('output')}"
+        if trace.get("model"):
+            block += f"\nModel: {trace.get('model')}"
+        blocks.append(block)
+    return "\n\n".join(blocks)
 
 
 class GeminiService:
     """Service for managing Gemini File Search store."""
     
     def __init__(self):
-        self.client: Optional[genai.Client] = None
+        self.client: Optional["genai.Client"] = None
         self.store_name: Optional[str] = None
+        # Set when traces are indexed locally instead of in File Search
+        self.local_index: Optional["VectorIndex"] = None
+        # user_id -> File Search store name (None while the user has none), when partitioned by user
+        self.user_stores = make_cache("user_stores", max_size=100000, ttl=86400, slot_size=256)
+        # Store lookups and creation are serialized per user, so one slow create blocks no one else
+        self._user_store_locks: Dict[str, List[Any]] = {}
+        self._user_store_locks_guard = threading.Lock()
+        self.user_store_flight = SingleFlight("user_store")
+        # Polls upload operations until their documents are indexed
+        self.tracker = OperationTracker(
+            poll=timed("gemini", "operations.get")(lambda operation: self.client.operations.get(operation)),
+            min_interval=settings.operation_poll_min_interval,
+            max_interval=settings.operation_poll_max_interval
+        )
         self.initialized = False
+        self._init_lock = threading.Lock()
+        # Requests arriving before initialization share one worker thread doing it
+        self._init_flight = SingleFlight("initialize")
+        self.retrieval_cache = RetrievalCache(
+            max_size=settings.retrieval_cache_size,
+            ttl=settings.retrieval_cache_ttl,
+            near_duplicate_threshold=(
+                settings.retrieval_cache_similarity_threshold
+                if settings.retrieval_cache_near_duplicates else None
+            ),
+            results=make_cache(
+                "retrieval",
+                max_size=settings.retrieval_cache_size,
+                ttl=settings.retrieval_cache_ttl,
+                slot_size=settings.retrieval_cache_slot_bytes
+            ),
+            generations=make_cache(
+                "retrieval_generations",
+                max_size=settings.retrieval_cache_size,
+                ttl=settings.retrieval_cache_ttl * 2,
+                slot_size=128
+            )
+        )
+        caches.register("retrieval", self.retrieval_cache)
+        # Identical concurrent retrievals share one upstream call
+        self.retrieval_flight = SingleFlight("retrieval")
+        flights.register(self.retrieval_flight)
+        flights.register(self.user_store_flight)
+        # Answered from while Gemini's circuit breaker is open
+        self.recent_traces = RecentTraces(settings.recent_traces_per_user, settings.recent_traces_max_users)
     
     def initialize(self):
-        """Initialize Gemini client and create/get File Search store."""
+        """Initialize Gemini client and create/get File Search store.
+        
+        Called by the startup warmup, or by the first request if that comes
+        first; concurrent callers wait for the one doing the work.
+        """
         if self.initialized:
             return
+        with self._init_lock:
+            if not self.initialized:
+                self._initialize()
+    
+    async def ainitialize(self):
+        """Initialize in a worker thread, off the event loop."""
+        if not self.initialized:
+            await self._init_flight.do("initialize", lambda: run_in_threadpool(self.initialize))
+    
+    def _initialize(self):
+        # Gemini is optional with the local backend
+        if settings.gemini_api_key:
+            # Deferred, like numpy for the local index: the SDK is slow to import
+            from google import genai
+            self.client = genai.Client(api_key=settings.gemini_api_key)
+        
+        if settings.retrieval_backend == "local":
+            from .vector_index import VectorIndex
+            self.local_index = VectorIndex(
+                settings.vector_index_path,
+                self._make_embedder(),
+                ivf_min_size=settings.vector_index_ivf_min_size,
+                nprobe=settings.vector_index_nprobe
+            )
+            self.initialized = True
+            return
         
-        self.client = genai.Client(api_key=settings.gemini_api_key)
+        if not self.client:
+            raise RuntimeError("GEMINI_API_KEY is required for the gemini retrieval backend")
+        
+        # Per-user stores are looked up or created lazily
+        if settings.store_partitioning == "user":
+            self.initialized = True
+            return
+        
+        # A known store saves listing them, which is most of the startup time
+        self.store_name = settings.gemini_store_name or self._cached_store_name()
+        if self.store_name:
+            self.initialized = True
+            return
+        # Listing below replaces a remembered store that no longer exists
+        self._forget_store_name()
         
         # Create or get the global File Search store
         try:
@@ -46,114 +182,1080 @@ class GeminiService:
                 # If creation fails, we'll handle it on first use
                 pass
         
+        if self.store_name:
+            self._remember_store_name(self.store_name)
         self.initialized = True
     
-    def store_trace(self, user_id: str, trace_data: Dict[str, Any]) -> str:
-        """Store a trace in Gemini File Search with user_id namespacing."""
-        if not self.initialized or not self.client:
+    def _store_name_cache_key(self) -> str:
+        """Identifies the API key (and so the project) a remembered store belongs to."""
+        return hashlib.sha256(settings.gemini_api_key.encode()).hexdigest()[:16]
+    
+    def _cached_store_name(self) -> Optional[str]:
+        """The global store found at an earlier start with the same API key, if remembered and still there."""
+        try:
+            with open(settings.store_name_cache_path) as f:
+                key, _, store_name = f.read().strip().partition("\n")
+        except OSError:
+            return None
+        if key != self._store_name_cache_key() or not store_name:
+            return None
+        
+        # Cheaper than listing stores, and catches a store deleted since
+        try:
+            self.client.file_search_stores.get(name=store_name)
+        except Exception as e:
+            if _is_not_found(e):
+                logger.warning("Remembered File Search store %s no longer exists", store_name)
+                return None
+            # Other errors are left to the first request that uses the store
+        return store_name
+    
+    def _remember_store_name(self, store_name: str):
+        try:
+            with open(settings.store_name_cache_path, "w") as f:
+                f.write(f"{self._store_name_cache_key()}\n{store_name}\n")
+        except OSError:
+            logger.warning("Could not cache the File Search store name; set GEMINI_STORE_NAME=%s", store_name)
+    
+    def _forget_store_name(self):
+        try:
+            os.remove(settings.store_name_cache_path)
+        except OSError:
+            pass
+    
+    def _make_embedder(self):
+        """Build the embedder configured for the local vector index."""
+        from .vector_index import GeminiEmbedder, HashingEmbedder
+        if settings.embedder == "gemini":
+            if not self.client:
+                raise RuntimeError("GEMINI_API_KEY is required for the gemini embedder")
+            return GeminiEmbedder(self.client, settings.embedding_model, settings.embedding_dim)
+        return HashingEmbedder(settings.embedding_dim)
+    
+    def _check_initialized(self):
+        """Initialize on first use if startup has not yet, then check a backend is available."""
+        self.initialize()
+        if not self.client and not self.local_index:
             raise RuntimeError("Gemini service not initialized")
+    
+    async def _acheck_initialized(self):
+        await self.ainitialize()
+        if not self.client and not self.local_index:
+            raise RuntimeError("Gemini service not initialized")
+    
+    def _cache_user_store(self, user_id: str, store_name: Optional[str]):
+        # Users without a store are remembered briefly, since their first trace will create one
+        self.user_stores.set(user_id, store_name, ttl=None if store_name else 30)
+    
+    async def _acache_user_store(self, user_id: str, store_name: Optional[str]):
+        await self.user_stores.aset(user_id, store_name, ttl=None if store_name else 30)
+    
+    @contextmanager
+    def _user_store_lock(self, user_id: str):
+        """Hold a user's store lock; locks are dropped once no thread holds or waits for them."""
+        with self._user_store_locks_guard:
+            entry = self._user_store_locks.setdefault(user_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._user_store_locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_store_locks[user_id]
+    
+    def store_for_user(self, user_id: str, create: bool = True) -> Optional[str]:
+        """Return the File Search store holding a user's traces.
         
-        # Add user_id to trace data for namespacing
-        trace_data["user_id"] = user_id
-        trace_id = str(uuid.uuid4())
-        trace_data["trace_id"] = trace_id
+        With per-user partitioning the store is looked up in Supabase and, if
+        `create` is set, created on first use. Returns None if the user has no
+        store and `create` is not set.
+        """
+        if settings.store_partitioning != "user":
+            return self.store_name
         
-        # Convert to JSON string
-        trace_json = json.dumps(trace_data, default=str)
+        store_name = self.user_stores.get(user_id)
+        if store_name is not MISSING and (store_name or not create):
+            return store_name
         
-        # Create a temporary file
-        import tempfile
-        import os
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            f.write(trace_json)
-            temp_path = f.name
+        with self._user_store_lock(user_id):
+            store_name = self.user_stores.get(user_id)
+            if store_name is not MISSING and (store_name or not create):
+                return store_name
+            
+            store_name = db.get_user_store(user_id)
+            if not store_name and create:
+                with span("gemini", "create_store"):
+                    created = self.client.file_search_stores.create(
+                        config={'display_name': f'context-api-user-{user_id}'}
+                    ).name
+                store_name = db.set_user_store(user_id, created)
+                if store_name != created:
+                    # Another process assigned a store first
+                    self.client.file_search_stores.delete(name=created, config={'force': True})
+            
+            self._cache_user_store(user_id, store_name)
+            return store_name
+    
+    async def astore_for_user(self, user_id: str, create: bool = True) -> Optional[str]:
+        """Return the File Search store holding a user's traces."""
+        if settings.store_partitioning != "user":
+            return self.store_name
         
-        try:
+        store_name = await self.user_stores.aget(user_id)
+        if store_name is not MISSING and (store_name or not create):
+            return store_name
+        
+        # Concurrent requests of one user share the lookup (and creation)
+        return await self.user_store_flight.do((user_id, create), lambda: self._aresolve_user_store(user_id, create))
+    
+    async def _aresolve_user_store(self, user_id: str, create: bool) -> Optional[str]:
+        store_name = await self.user_stores.aget(user_id)
+        if store_name is not MISSING and (store_name or not create):
+            return store_name
+        
+        store_name = await db.aget_user_store(user_id)
+        if not store_name and create:
+            with span("gemini", "create_store"):
+                created = (await self.client.aio.file_search_stores.create(
+                    config={'display_name': f'context-api-user-{user_id}'}
+                )).name
+            store_name = await db.aset_user_store(user_id, created)
+            if store_name != created:
+                await self.client.aio.file_search_stores.delete(name=created, config={'force': True})
+        
+        await self._acache_user_store(user_id, store_name)
+        return store_name
+    
+    def _upload_config(self, display_name: str, mime_type: str) -> Dict[str, Any]:
+        return {'display_name': display_name, 'mime_type': mime_type}
+    
+    def _upload_document(self, store_name: str, content: bytes, display_name: str, mime_type: str = 'application/json') -> Future:
+        """Upload a document to the File Search store. Returns a Future resolved once it is indexed."""
+        with io.BytesIO(content) as buffer, span("gemini", "upload"):
             # Upload to File Search store
             operation = self.client.file_search_stores.upload_to_file_search_store(
-                file=temp_path,
-                file_search_store_name=self.store_name,
-                config={
-                    'display_name': f'trace_{user_id}_{trace_id}',
-                }
+                file=buffer,
+                file_search_store_name=store_name,
+                config=self._upload_config(display_name, mime_type)
             )
-            
-            # Wait for operation to complete
-            while not operation.done:
-                time.sleep(1)
-                operation = self.client.operations.get(operation)
-        finally:
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+        
+        # Indexing completes in the background
+        return self.tracker.track(operation)
+    
+    async def _aupload_document(self, store_name: str, content: bytes, display_name: str, mime_type: str = 'application/json') -> Future:
+        """Upload a document through the async client. Returns a Future resolved once it is indexed."""
+        with io.BytesIO(content) as buffer, span("gemini", "upload"):
+            operation = await asyncio.wait_for(
+                self.client.aio.file_search_stores.upload_to_file_search_store(
+                    file=buffer,
+                    file_search_store_name=store_name,
+                    config=self._upload_config(display_name, mime_type)
+                ),
+                timeout=settings.gemini_timeout
+            )
+        
+        return self.tracker.track(operation)
+    
+    def _when_indexed(self, future: Future, user_id: str, trace_ids: List[str], on_indexed: Optional[IndexedCallback]):
+        """Invalidate cached retrievals and report status once an upload has been indexed."""
+        def done(future: Future):
+            error = future.exception()
+            document_name = None
+            if error is None:
+                # The new traces are searchable now
+                self.retrieval_cache.invalidate_user(user_id)
+                document_name = _document_name(future.result())
+            else:
+                logger.warning("Indexing traces %s failed: %s", trace_ids, error)
+            if on_indexed:
+                try:
+                    on_indexed(trace_ids, error, document_name)
+                except Exception:
+                    logger.exception("Indexing callback for traces %s failed", trace_ids)
+        
+        future.add_done_callback(done)
+    
+    def _indexed_now(self) -> Future:
+        """A Future that is already resolved, for traces indexed synchronously."""
+        future: Future = Future()
+        future.set_result(None)
+        return future
+    
+    def _prepare_trace(self, user_id: str, trace_data: Dict[str, Any], trace_id: Optional[str]) -> Tuple[str, bytes]:
+        """Namespace a trace by user and serialize it. Returns (trace_id, JSON bytes)."""
+        # Add user_id to trace data for namespacing
+        trace_data["user_id"] = user_id
+        trace_id = trace_id or str(uuid.uuid4())
+        trace_data["trace_id"] = trace_id
+        # Lets retrieval rank chunks of this trace by recency
+        trace_data.setdefault("created_at", time.time())
+        
+        # Convert to JSON bytes
+        return trace_id, dumps_json(trace_data)
+    
+    def store_trace(
+        self,
+        user_id: str,
+        trace_data: Dict[str, Any],
+        trace_id: Optional[str] = None,
+        on_indexed: Optional[IndexedCallback] = None
+    ) -> str:
+        """Store a trace in Gemini File Search with user_id namespacing.
+        
+        Returns once the upload is accepted. `on_indexed(trace_ids, error)` is
+        called when indexing finishes.
+        """
+        self._check_initialized()
+        
+        if self.local_index is not None:
+            trace_id = trace_id or str(uuid.uuid4())
+            self.local_index.add_traces(user_id, [trace_id], [trace_data])
+            future = self._indexed_now()
+        else:
+            trace_id, trace_json = self._prepare_trace(user_id, trace_data, trace_id)
+            future = self._upload_document(self.store_for_user(user_id), trace_json, f'trace_{user_id}_{trace_id}')
+            self.recent_traces.add(user_id, [trace_id], [trace_data])
+        
+        self._when_indexed(future, user_id, [trace_id], on_indexed)
         
         return trace_id
     
-    def retrieve_context(self, user_id: str, prompt: str, model: str, max_results: int = 5) -> Dict[str, Any]:
-        """Retrieve relevant context from traces for a given prompt."""
-        if not self.initialized or not self.client:
-            raise RuntimeError("Gemini service not initialized")
+    async def astore_trace(
+        self,
+        user_id: str,
+        trace_data: Dict[str, Any],
+        trace_id: Optional[str] = None,
+        on_indexed: Optional[IndexedCallback] = None
+    ) -> str:
+        """Store a trace in Gemini File Search with user_id namespacing."""
+        if not settings.async_io or self.local_index is not None:
+            return await run_in_threadpool(self.store_trace, user_id, trace_data, trace_id, on_indexed)
         
-        # Create a query that includes user_id filtering
-        query = f"user_id: {user_id}\n\nFind similar prompts and successful patterns for: {prompt}"
+        await self._acheck_initialized()
         
-        try:
-            # Query the File Search store
-            response = self.client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=query,
-                config=types.GenerateContentConfig(
-                    tools=[{
-                        "file_search": {
-                            "file_search_store_names": [self.store_name]
-                        }
-                    }]
-                )
-            )
-            
-            # Extract relevant traces from grounding metadata
-            relevant_traces = []
-            if hasattr(response, 'candidates') and response.candidates:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'grounding_metadata'):
-                    grounding = candidate.grounding_metadata
-                    if hasattr(grounding, 'retrieval_queries'):
-                        # Extract file references
-                        for query_result in getattr(grounding, 'retrieval_queries', []):
-                            if hasattr(query_result, 'relevant_chunks'):
-                                for chunk in query_result.relevant_chunks:
-                                    relevant_traces.append({
-                                        "chunk": getattr(chunk, 'chunk', {}),
-                                        "relevance_score": getattr(chunk, 'relevance_score', 0.0)
-                                    })
+        trace_id, trace_json = self._prepare_trace(user_id, trace_data, trace_id)
+        
+        future = await self._aupload_document(
+            await self.astore_for_user(user_id), trace_json, f'trace_{user_id}_{trace_id}'
+        )
+        self.recent_traces.add(user_id, [trace_id], [trace_data])
+        self._when_indexed(future, user_id, [trace_id], on_indexed)
+        
+        return trace_id
+    
+    def pack_traces(self, user_id: str, traces: List[Dict[str, Any]], trace_ids: List[str]) -> List[Tuple[List[str], bytes]]:
+        """Serialize traces into as few JSONL documents as fit under the document size limit.
+        
+        Returns (trace_ids, content) pairs, one per document.
+        """
+        documents = []
+        doc_ids: List[str] = []
+        lines: List[bytes] = []
+        size = 0
+        for trace_data, trace_id in zip(traces, trace_ids):
+            trace_id, line = self._prepare_trace(user_id, trace_data, trace_id)
+            line_size = len(line) + 1
             
-            # Get the enhanced context from the response
-            enhanced_context = response.text if hasattr(response, 'text') else ""
+            # Start a new document once the current one is full
+            if lines and size + line_size > settings.trace_document_max_bytes:
+                documents.append((doc_ids, b"\n".join(lines) + b"\n"))
+                doc_ids, lines, size = [], [], 0
             
-            # Generate suggestions based on retrieved traces
-            suggestions = {
+            doc_ids.append(trace_id)
+            lines.append(line)
+            size += line_size
+        
+        if lines:
+            documents.append((doc_ids, b"\n".join(lines) + b"\n"))
+        return documents
+    
+    def store_traces(
+        self,
+        user_id: str,
+        traces: List[Dict[str, Any]],
+        trace_ids: Optional[List[str]] = None,
+        on_indexed: Optional[IndexedCallback] = None
+    ) -> List[str]:
+        """Store many traces for one user as multi-trace JSONL documents.
+        
+        `on_indexed(trace_ids, error)` is called once per document, with the
+        traces it holds, when indexing finishes.
+        """
+        self._check_initialized()
+        
+        trace_ids = trace_ids or [str(uuid.uuid4()) for _ in traces]
+        
+        if self.local_index is not None:
+            # Embed the whole batch at once
+            self.local_index.add_traces(user_id, trace_ids, traces)
+            self._when_indexed(self._indexed_now(), user_id, trace_ids, on_indexed)
+            return trace_ids
+        
+        store_name = self.store_for_user(user_id)
+        for doc_trace_ids, content in self.pack_traces(user_id, traces, trace_ids):
+            # Name each document after its first trace
+            future = self._upload_document(
+                store_name,
+                content,
+                f'traces_{user_id}_{doc_trace_ids[0]}',
+                mime_type='text/plain'
+            )
+            self._when_indexed(future, user_id, doc_trace_ids, on_indexed)
+        self.recent_traces.add(user_id, trace_ids, traces)
+        
+        return trace_ids
+    
+    async def astore_traces(
+        self,
+        user_id: str,
+        traces: List[Dict[str, Any]],
+        trace_ids: Optional[List[str]] = None,
+        on_indexed: Optional[IndexedCallback] = None
+    ) -> List[str]:
+        """Store many traces for one user as multi-trace JSONL documents, uploading them concurrently."""
+        if not settings.async_io or self.local_index is not None:
+            return await run_in_threadpool(self.store_traces, user_id, traces, trace_ids, on_indexed)
+        
+        await self._acheck_initialized()
+        
+        trace_ids = trace_ids or [str(uuid.uuid4()) for _ in traces]
+        
+        store_name = await self.astore_for_user(user_id)
+        documents = self.pack_traces(user_id, traces, trace_ids)
+        futures = await asyncio.gather(*(
+            self._aupload_document(
+                store_name,
+                content,
+                f'traces_{user_id}_{doc_trace_ids[0]}',
+                mime_type='text/plain'
+            )
+            for doc_trace_ids, content in documents
+        ))
+        for (doc_trace_ids, _), future in zip(documents, futures):
+            self._when_indexed(future, user_id, doc_trace_ids, on_indexed)
+        self.recent_traces.add(user_id, trace_ids, traces)
+        
+        return trace_ids
+    
+    def delete_traces(self, user_id: str, trace_ids: List[str], document_names: List[str]):
+        """Remove a user's traces from retrieval, deleting the File Search documents that held them.
+        
+        A document already gone counts as deleted. Callers must only pass
+        documents none of whose traces are kept.
+        """
+        self._check_initialized()
+        
+        if self.local_index is not None:
+            self.local_index.remove_traces(user_id, trace_ids)
+        else:
+            for name in document_names:
+                try:
+                    with span("gemini", "delete_document"):
+                        self.client.file_search_stores.documents.delete(name=name, config={'force': True})
+                except Exception as e:
+                    if not _is_not_found(e):
+                        raise
+        
+        self.retrieval_cache.invalidate_user(user_id)
+    
+    async def adelete_traces(self, user_id: str, trace_ids: List[str], document_names: List[str]):
+        """Remove a user's traces from retrieval, deleting the File Search documents that held them."""
+        if not settings.async_io or self.local_index is not None:
+            return await run_in_threadpool(self.delete_traces, user_id, trace_ids, document_names)
+        
+        await self._acheck_initialized()
+        
+        async def delete(name: str):
+            try:
+                with span("gemini", "delete_document"):
+                    await asyncio.wait_for(
+                        self.client.aio.file_search_stores.documents.delete(name=name, config={'force': True}),
+                        timeout=settings.gemini_timeout
+                    )
+            except Exception as e:
+                if not _is_not_found(e):
+                    raise
+        
+        await asyncio.gather(*(delete(name) for name in document_names))
+        self.retrieval_cache.invalidate_user(user_id)
+    
+    def _retrieval_request(self, user_id: str, prompt: str, store_name: str, synthesize: bool) -> Dict[str, Any]:
+        """Build the generate_content arguments for a File Search retrieval.
+        
+        File Search only runs as a tool of a generation call. Without
+        `synthesize`, the call runs on `settings.retrieval_model` with thinking off
+        and output capped, and only its grounding chunks are used.
+        """
+        query = f"Find similar prompts and successful patterns for: {prompt}"
+        if settings.store_partitioning != "user":
+            # The global store holds every user's traces; ask for this user's only
+            query = f"user_id: {user_id}\n\n{query}"
+        
+        from google.genai import types
+        
+        tools = [{
+            "file_search": {
+                "file_search_store_names": [store_name]
+            }
+        }]
+        if synthesize:
+            return {
+                "model": settings.synthesis_model,
+                "contents": query,
+                "config": types.GenerateContentConfig(tools=tools)
+            }
+        return {
+            "model": settings.retrieval_model,
+            "contents": query,
+            "config": types.GenerateContentConfig(
+                tools=tools,
+                max_output_tokens=settings.retrieval_max_output_tokens,
+                thinking_config=types.ThinkingConfig(thinking_budget=0)
+            )
+        }
+    
+    def _synthesis_request(self, prompt: str, context: str, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """Build the generate_content arguments for writing context from retrieved traces."""
+        from google.genai import types
+        
+        return {
+            "model": settings.synthesis_model,
+            "contents": (
+                f"Past traces:\n{context}\n\n"
+                f"Summarize the patterns from these traces that are useful for: {prompt}"
+            ),
+            "config": types.GenerateContentConfig(max_output_tokens=max_tokens) if max_tokens else None
+        }
+    
+    def _grounding_chunks(self, response) -> List[Dict[str, Any]]:
+        """Collect the File Search chunks a response was grounded on, with a relevance score each."""
+        chunks = []
+        candidates = getattr(response, 'candidates', None)
+        if not candidates:
+            return chunks
+        grounding = getattr(candidates[0], 'grounding_metadata', None)
+        if grounding is None:
+            return chunks
+        
+        # Score each grounding chunk by the highest confidence of the supports citing it
+        scores: Dict[int, float] = {}
+        for support in getattr(grounding, 'grounding_supports', None) or []:
+            indices = support.grounding_chunk_indices or []
+            confidences = support.confidence_scores or []
+            for position, index in enumerate(indices):
+                confidence = confidences[position] if position < len(confidences) else 0.0
+                scores[index] = max(scores.get(index, 0.0), confidence)
+        for index, grounding_chunk in enumerate(getattr(grounding, 'grounding_chunks', None) or []):
+            context = getattr(grounding_chunk, 'retrieved_context', None)
+            if context is not None and context.text:
+                chunks.append({
+                    "text": context.text,
+                    "source": context.title,
+                    "relevance_score": scores.get(index, 0.0)
+                })
+        
+        # Older responses list chunks under their retrieval queries
+        for query_result in getattr(grounding, 'retrieval_queries', None) or []:
+            if hasattr(query_result, 'relevant_chunks'):
+                for chunk in query_result.relevant_chunks:
+                    chunks.append({
+                        "chunk": getattr(chunk, 'chunk', {}),
+                        "relevance_score": getattr(chunk, 'relevance_score', 0.0)
+                    })
+        return chunks
+    
+    def _retrieval_result(self, response, model: str, synthesized: bool) -> Dict[str, Any]:
+        """Turn a generate_content response into a raw retrieval result, before context assembly."""
+        relevant_traces = self._grounding_chunks(response)
+        
+        # Only a synthesizing call's text is worth returning
+        enhanced_context = (response.text if hasattr(response, 'text') else "") if synthesized else ""
+        
+        # Generate suggestions based on retrieved traces
+        suggestions = {
+            "similar_prompts_found": len(relevant_traces),
+            "model": model,
+            "recommendations": []
+        }
+        
+        return {
+            "enhanced_context": enhanced_context or "",
+            "relevant_traces": relevant_traces,
+            "synthesized": synthesized,
+            "suggestions": suggestions
+        }
+    
+    def _empty_result(self, model: str) -> Dict[str, Any]:
+        """Result for a user with no stored traces."""
+        return {
+            "enhanced_context": "",
+            "relevant_traces": [],
+            "suggestions": {
+                "similar_prompts_found": 0,
+                "model": model,
+                "recommendations": []
+            }
+        }
+    
+    def _fallback_result(self, prompt: str, model: str, error: Exception) -> Dict[str, Any]:
+        """Result returned when retrieval fails: the prompt itself, with the error."""
+        mark_degraded("retrieval_error")
+        return {
+            "enhanced_context": prompt,
+            "relevant_traces": [],
+            "suggestions": {
+                "error": str(error) or type(error).__name__,
+                "model": model
+            }
+        }
+    
+    def _degraded_result(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        error: Exception
+    ) -> Dict[str, Any]:
+        """Result returned at once while an upstream's circuit breaker is open.
+        
+        This is the prompt's cached result from any mode if there is one, else
+        the user's recent traces that share words with the prompt, else the
+        prompt itself.
+        """
+        mark_degraded("circuit_open")
+        for variant in ("", "synthesize"):
+            cached = self._cached_result(user_id, prompt, system_prompt, model, max_results, variant)
+            if cached is not None:
+                cached["suggestions"]["degraded"] = "circuit_open"
+                return cached
+        return self._recent_traces_result(user_id, prompt, system_prompt, model, max_results, error)
+    
+    async def _adegraded_result(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        error: Exception
+    ) -> Dict[str, Any]:
+        mark_degraded("circuit_open")
+        for variant in ("", "synthesize"):
+            cached = await self._acached_result(user_id, prompt, system_prompt, model, max_results, variant)
+            if cached is not None:
+                cached["suggestions"]["degraded"] = "circuit_open"
+                return cached
+        return self._recent_traces_result(user_id, prompt, system_prompt, model, max_results, error)
+    
+    def _recent_traces_result(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        error: Exception
+    ) -> Dict[str, Any]:
+        query = "\n".join(part for part in (system_prompt, prompt) if part)
+        relevant_traces = self.recent_traces.search(user_id, query, max_results * 2)
+        suggestions = {
+            "similar_prompts_found": len(relevant_traces),
+            "model": model,
+            "recommendations": [],
+            "degraded": "circuit_open"
+        }
+        if not relevant_traces:
+            suggestions["error"] = str(error)
+        return {
+            "enhanced_context": "" if relevant_traces else prompt,
+            "relevant_traces": relevant_traces,
+            "suggestions": suggestions
+        }
+    
+    def _cached_result(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        variant: str,
+        generation: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        cached = self.retrieval_cache.get(
+            user_id, prompt, system_prompt, model, max_results, variant=variant, generation=generation
+        )
+        if cached is not None:
+            cached["suggestions"]["cached"] = True
+        return cached
+    
+    async def _acached_result(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        variant: str,
+        generation: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        cached = await self.retrieval_cache.aget(
+            user_id, prompt, system_prompt, model, max_results, variant=variant, generation=generation
+        )
+        if cached is not None:
+            cached["suggestions"]["cached"] = True
+        return cached
+    
+    def _flight_key(
+        self,
+        user_id: str,
+        generation: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        variant: str
+    ) -> tuple:
+        """Key under which identical in-flight retrievals are coalesced."""
+        return (
+            user_id, generation, normalize_prompt(prompt), normalize_prompt(system_prompt),
+            model, max_results, variant
+        )
+    
+    def _resolve_mode(self, mode: Optional[str]) -> str:
+        """The context mode a request runs in.
+        
+        Synthesis needs Gemini, so without a client every mode is retrieve-only.
+        """
+        if mode is None:
+            mode = "synthesize" if self.local_index is not None and settings.local_synthesize else settings.context_mode
+        if not self.client:
+            return "retrieve_only"
+        return mode
+    
+    def _assemble(self, result: Dict[str, Any], model: str, max_results: int, budget: int, mode: str) -> Dict[str, Any]:
+        """Pack a raw retrieval result into the caller's token budget for `model`."""
+        assembled = assemble_context(
+            result["relevant_traces"],
+            model,
+            budget,
+            max_results,
+            recency_weight=settings.context_recency_weight,
+            half_life=settings.context_recency_half_life,
+            min_chunk_tokens=settings.context_min_chunk_tokens
+        )
+        
+        synthesized = result.pop("synthesized", False)
+        if synthesized or not assembled["chunks"]:
+            # Keep the model's own text, within the budget
+            enhanced_context = truncate_to_tokens(result["enhanced_context"], budget, model)
+        else:
+            enhanced_context = assembled["text"]
+        
+        result["enhanced_context"] = enhanced_context
+        result["relevant_traces"] = assembled["chunks"]
+        result["context"] = dict(assembled["stats"], synthesized=synthesized)
+        result["suggestions"]["mode"] = mode
+        return result
+    
+    def _needs_synthesis(self, result: Dict[str, Any], mode: str) -> bool:
+        """In auto mode, synthesize only when the retrieved traces overflow the budget."""
+        return mode == "auto" and bool(result.get("context", {}).get("truncated"))
+    
+    def _synthesis_input(self, chunks: List[Dict[str, Any]]) -> str:
+        """The retrieved chunks, best first, within the synthesis model's input budget."""
+        return assemble_context(
+            chunks,
+            settings.synthesis_model,
+            settings.synthesis_input_tokens,
+            len(chunks),
+            recency_weight=settings.context_recency_weight,
+            half_life=settings.context_recency_half_life
+        )["text"]
+    
+    def _with_synthesis(self, result: Dict[str, Any], text: str, model: str, budget: int) -> Dict[str, Any]:
+        result["enhanced_context"] = truncate_to_tokens(text, budget, model)
+        result["context"]["synthesized"] = True
+        return result
+    
+    def _synthesize(self, prompt: str, chunks: List[Dict[str, Any]], budget: int) -> str:
+        """Have Gemini condense retrieved traces into at most about `budget` tokens of prose."""
+        with span("gemini", "synthesize"):
+            response = self.client.models.generate_content(
+                **self._synthesis_request(prompt, self._synthesis_input(chunks), budget)
+            )
+        return response.text or ""
+    
+    async def _asynthesize(self, prompt: str, chunks: List[Dict[str, Any]], budget: int) -> str:
+        """Have Gemini condense retrieved traces into at most about `budget` tokens of prose."""
+        if not settings.async_io:
+            return await run_in_threadpool(self._synthesize, prompt, chunks, budget)
+        
+        with span("gemini", "synthesize"):
+            response = await asyncio.wait_for(
+                self.client.aio.models.generate_content(
+                    **self._synthesis_request(prompt, self._synthesis_input(chunks), budget)
+                ),
+                timeout=settings.gemini_timeout
+            )
+        return response.text or ""
+    
+    def _local_retrieval(
+        self,
+        user_id: str,
+        prompt: str,
+        model: str,
+        max_results: int,
+        system_prompt: Optional[str],
+        synthesize: bool
+    ) -> Dict[str, Any]:
+        """Retrieve the user's most similar traces from the local vector index."""
+        query = "\n".join(part for part in (system_prompt, prompt) if part)
+        # Fetch extra candidates so that context assembly can rerank by recency
+        with span("local_index", "search"):
+            relevant_traces = self.local_index.search(user_id, query, max_results * 2)
+        
+        enhanced_context = ""
+        if synthesize and relevant_traces:
+            # Let Gemini turn the retrieved traces into prose
+            with span("gemini", "synthesize"):
+                response = self.client.models.generate_content(
+                    **self._synthesis_request(prompt, format_traces(relevant_traces))
+                )
+            enhanced_context = response.text or ""
+        
+        return {
+            "enhanced_context": enhanced_context,
+            "relevant_traces": relevant_traces,
+            # Synthesized prose is kept as the context instead of the packed traces
+            "synthesized": bool(enhanced_context),
+            "suggestions": {
                 "similar_prompts_found": len(relevant_traces),
                 "model": model,
                 "recommendations": []
             }
-            
-            return {
-                "enhanced_context": enhanced_context,
-                "relevant_traces": relevant_traces[:max_results],
-                "suggestions": suggestions
+        }
+    
+    def _retrieve(
+        self,
+        user_id: str,
+        prompt: str,
+        model: str,
+        max_results: int,
+        system_prompt: Optional[str],
+        synthesize: bool = False
+    ) -> Dict[str, Any]:
+        """Run a retrieval against the configured backend, bypassing the cache."""
+        if self.local_index is not None:
+            return self._local_retrieval(user_id, prompt, model, max_results, system_prompt, synthesize)
+        
+        store_name = self.store_for_user(user_id, create=False)
+        if not store_name:
+            return self._empty_result(model)
+        
+        # Query the File Search store
+        with span("gemini", "generate_content"):
+            response = self.client.models.generate_content(
+                **self._retrieval_request(user_id, prompt, store_name, synthesize)
+            )
+        return self._retrieval_result(response, model, synthesize)
+    
+    async def _aretrieve(
+        self,
+        user_id: str,
+        prompt: str,
+        model: str,
+        max_results: int,
+        system_prompt: Optional[str],
+        synthesize: bool = False
+    ) -> Dict[str, Any]:
+        """Run a retrieval against the configured backend, bypassing the cache."""
+        if not settings.async_io or self.local_index is not None:
+            # The local index is CPU-bound; keep it off the event loop
+            return await run_in_threadpool(
+                self._retrieve, user_id, prompt, model, max_results, system_prompt, synthesize
+            )
+        
+        store_name = await self.astore_for_user(user_id, create=False)
+        if not store_name:
+            return self._empty_result(model)
+        
+        with span("gemini", "generate_content"):
+            response = await asyncio.wait_for(
+                self.client.aio.models.generate_content(
+                    **self._retrieval_request(user_id, prompt, store_name, synthesize)
+                ),
+                timeout=settings.gemini_timeout
+            )
+        return self._retrieval_result(response, model, synthesize)
+    
+    def retrieve_context(
+        self,
+        user_id: str,
+        prompt: str,
+        model: str,
+        max_results: int = 5,
+        system_prompt: Optional[str] = None,
+        max_context_tokens: Optional[int] = None,
+        mode: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Retrieve relevant context from traces for a given prompt, packed into `max_context_tokens`.
+        
+        `mode` is "retrieve_only" (search only), "synthesize" (Gemini writes
+        the context) or "auto" (search, and synthesize only if the traces do
+        not fit the budget); it defaults to `settings.context_mode`.
+        """
+        self._check_initialized()
+        mode = self._resolve_mode(mode)
+        budget = max_context_tokens or settings.context_token_budget
+        synthesize = mode == "synthesize"
+        
+        # Serve repeated and near-duplicate prompts from the cache
+        generation = self.retrieval_cache.generation(user_id)
+        if mode == "auto":
+            cached = self._cached_result(user_id, prompt, system_prompt, model, max_results, f"auto:{budget}", generation)
+            if cached is not None:
+                return cached
+        
+        variant = "synthesize" if synthesize else ""
+        result = self._cached_result(user_id, prompt, system_prompt, model, max_results, variant, generation)
+        if result is None:
+            try:
+                result = self._retrieve(user_id, prompt, model, max_results, system_prompt, synthesize)
+            except CircuitOpenError as e:
+                # Answer at once from what is at hand instead of waiting on a failing upstream
+                result = self._degraded_result(user_id, prompt, system_prompt, model, max_results, e)
+            except OverloadedError:
+                # Shed requests get a 503, not an empty context
+                raise
+            except Exception as e:
+                # Fallback if retrieval fails
+                return self._fallback_result(prompt, model, e)
+            else:
+                self.retrieval_cache.set(
+                    user_id, prompt, system_prompt, model, max_results, result,
+                    generation=generation, variant=variant
+                )
+        
+        chunks = result["relevant_traces"]
+        result = self._assemble(result, model, max_results, budget, mode)
+        if "degraded" in result["suggestions"] or not self._needs_synthesis(result, mode):
+            return result
+        
+        try:
+            text = self._synthesize(prompt, chunks, budget)
+        except Exception:
+            # The packed traces are still a usable answer
+            mark_degraded("synthesis_error")
+            return result
+        
+        result = self._with_synthesis(result, text, model, budget)
+        self.retrieval_cache.set(
+            user_id, prompt, system_prompt, model, max_results, result,
+            generation=generation, variant=f"auto:{budget}"
+        )
+        return result
+    
+    async def aretrieve_context(
+        self,
+        user_id: str,
+        prompt: str,
+        model: str,
+        max_results: int = 5,
+        system_prompt: Optional[str] = None,
+        max_context_tokens: Optional[int] = None,
+        mode: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Retrieve relevant context from traces for a given prompt, packed into `max_context_tokens`."""
+        await self._acheck_initialized()
+        mode = self._resolve_mode(mode)
+        budget = max_context_tokens or settings.context_token_budget
+        synthesize = mode == "synthesize"
+        
+        generation = await self.retrieval_cache.ageneration(user_id)
+        if mode == "auto":
+            cached = await self._acached_result(user_id, prompt, system_prompt, model, max_results, f"auto:{budget}", generation)
+            if cached is not None:
+                return cached
+        
+        variant = "synthesize" if synthesize else ""
+        result = await self._acached_result(user_id, prompt, system_prompt, model, max_results, variant, generation)
+        if result is None:
+            try:
+                result = await self.retrieval_flight.do(
+                    self._flight_key(user_id, generation, prompt, system_prompt, model, max_results, variant),
+                    lambda: self._aretrieve(user_id, prompt, model, max_results, system_prompt, synthesize)
+                )
+            except CircuitOpenError as e:
+                result = await self._adegraded_result(user_id, prompt, system_prompt, model, max_results, e)
+            except OverloadedError:
+                raise
+            except Exception as e:
+                return self._fallback_result(prompt, model, e)
+            else:
+                await self.retrieval_cache.aset(
+                    user_id, prompt, system_prompt, model, max_results, result,
+                    generation=generation, variant=variant
+                )
+        
+        chunks = result["relevant_traces"]
+        result = self._assemble(result, model, max_results, budget, mode)
+        if "degraded" in result["suggestions"] or not self._needs_synthesis(result, mode):
+            return result
+        
+        try:
+            text = await self.retrieval_flight.do(
+                self._flight_key(user_id, generation, prompt, system_prompt, model, max_results, f"auto:{budget}"),
+                lambda: self._asynthesize(prompt, chunks, budget)
+            )
+        except Exception:
+            mark_degraded("synthesis_error")
+            return result
+        
+        result = self._with_synthesis(result, text, model, budget)
+        await self.retrieval_cache.aset(
+            user_id, prompt, system_prompt, model, max_results, result,
+            generation=generation, variant=f"auto:{budget}"
+        )
+        return result
+    
+    async def _asynthesis_stream(self, prompt: str, chunks: List[Dict[str, Any]], budget: int) -> AsyncIterator[str]:
+        """Stream Gemini's condensed prose of retrieved traces as it is generated."""
+        request = self._synthesis_request(prompt, self._synthesis_input(chunks), budget)
+        # Only opening the stream is timed; the span must not stay open across yields
+        with span("gemini", "synthesize_stream"):
+            if settings.async_io:
+                stream = await asyncio.wait_for(
+                    self.client.aio.models.generate_content_stream(**request),
+                    timeout=settings.gemini_timeout
+                )
+            else:
+                stream = iterate_in_threadpool(
+                    await run_in_threadpool(self.client.models.generate_content_stream, **request)
+                )
+        
+        iterator = stream.__aiter__()
+        while True:
+            try:
+                # Time out on a stalled stream, not on a long one
+                response = await asyncio.wait_for(iterator.__anext__(), timeout=settings.gemini_timeout)
+            except StopAsyncIteration:
+                return
+            if response.text:
+                yield response.text
+    
+    async def astream_context(
+        self,
+        user_id: str,
+        prompt: str,
+        model: str,
+        max_results: int = 5,
+        system_prompt: Optional[str] = None,
+        max_context_tokens: Optional[int] = None,
+        mode: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Retrieve context as a stream of events.
+        
+        Yields a "traces" event with the packed traces as soon as retrieval
+        finishes, then "delta" events with pieces of `enhanced_context` (as
+        Gemini generates them when synthesizing), then a "done" event with
+        the full text. Synthesis always runs as its own streamed call after
+        retrieval, so that traces go out first. Failures end the stream with an
+        "error" event, except shedding during retrieval, which raises
+        OverloadedError before the first event.
+        """
+        await self._acheck_initialized()
+        mode = self._resolve_mode(mode)
+        budget = max_context_tokens or settings.context_token_budget
+        
+        generation = await self.retrieval_cache.ageneration(user_id)
+        result = None
+        if mode == "auto":
+            result = await self._acached_result(user_id, prompt, system_prompt, model, max_results, f"auto:{budget}", generation)
+        
+        if result is None:
+            result = await self._acached_result(user_id, prompt, system_prompt, model, max_results, "", generation)
+            if result is None:
+                try:
+                    result = await self.retrieval_flight.do(
+                        self._flight_key(user_id, generation, prompt, system_prompt, model, max_results, ""),
+                        lambda: self._aretrieve(user_id, prompt, model, max_results, system_prompt)
+                    )
+                except CircuitOpenError as e:
+                    result = await self._adegraded_result(user_id, prompt, system_prompt, model, max_results, e)
+                except OverloadedError:
+                    raise
+                except Exception as e:
+                    fallback = self._fallback_result(prompt, model, e)
+                    yield {"event": "error", "data": fallback["suggestions"]}
+                    return
+                else:
+                    await self.retrieval_cache.aset(
+                        user_id, prompt, system_prompt, model, max_results, result,
+                        generation=generation
+                    )
+            chunks = result["relevant_traces"]
+            result = self._assemble(result, model, max_results, budget, mode)
+            synthesize = (
+                bool(chunks) and "degraded" not in result["suggestions"]
+                and (mode == "synthesize" or self._needs_synthesis(result, mode))
+            )
+        else:
+            synthesize = False
+        
+        yield {
+            "event": "traces",
+            "data": {
+                "relevant_traces": result["relevant_traces"],
+                "suggestions": result["suggestions"],
+                "context": result["context"]
             }
-            
+        }
+        
+        if not synthesize:
+            if result["enhanced_context"]:
+                yield {"event": "delta", "data": {"text": result["enhanced_context"]}}
+            yield {"event": "done", "data": {"enhanced_context": result["enhanced_context"], "context": result["context"]}}
+            return
+        
+        parts: List[str] = []
+        tokens = 0
+        try:
+            async for text in self._asynthesis_stream(prompt, chunks, budget):
+                # Stop once the budget is spent; pieces are estimated one at a time
+                remaining = budget - tokens
+                piece_tokens = estimate_tokens(text, model)
+                if piece_tokens > remaining:
+                    text = truncate_to_tokens(text, remaining, model)
+                    if text:
+                        parts.append(text)
+                        yield {"event": "delta", "data": {"text": text}}
+                    break
+                tokens += piece_tokens
+                parts.append(text)
+                yield {"event": "delta", "data": {"text": text}}
         except Exception as e:
-            # Fallback if retrieval fails
-            return {
-                "enhanced_context": prompt,
-                "relevant_traces": [],
-                "suggestions": {
-                    "error": str(e),
-                    "model": model
-                }
-            }
+            mark_degraded("synthesis_error")
+            yield {"event": "error", "data": {"error": str(e) or type(e).__name__, "model": model}}
+            return
+        
+        result = self._with_synthesis(result, "".join(parts), model, budget)
+        if mode == "auto":
+            await self.retrieval_cache.aset(
+                user_id, prompt, system_prompt, model, max_results, result,
+                generation=generation, variant=f"auto:{budget}"
+            )
+        yield {"event": "done", "data": {"enhanced_context": result["enhanced_context"], "context": result["context"]}}
+    
+    async def aclose(self):
+        """Stop tracking uploads and close the async client's connection pool."""
+        self.tracker.stop()
+        if self.client is not None:
+            await self.client.aio.aclose()
 
 
 gemini_service = GeminiService()
-
@@ -1,25 +1,51 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
 from .config import settings
 from .gemini_service import gemini_service
-from .routes import context, traces, auth
+from .database import db
+from .trace_queue import trace_queue
+from .trace_retention import compactor
+from .circuit_breaker import circuit_breakers
+from .concurrency import OverloadedError
+from .metrics import TimingMiddleware, metrics_response_body
+from .rate_limit import rate_limiter
+from .warmup import Warmup
+from .wire import WireMiddleware, WireResponse
+from .routes import context, traces, auth, admin
+
+
+# Upstream clients are set up after the app starts serving; /ready reports when
+warmup = Warmup([gemini_service.ainitialize, db.awarmup])
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize services on startup."""
-    # Initialize Gemini File Search store
-    gemini_service.initialize()
+    # Find the Gemini File Search store and connect to Supabase in the background
+    warmup.start()
+    # Start draining queued traces in write-behind mode
+    if settings.trace_write_behind:
+        trace_queue.start(settings.trace_queue_workers, settings.trace_queue_batch_size)
+    # Evict traces past the retention limits, if any are set
+    compactor.start()
     yield
-    # Cleanup if needed
+    await warmup.stop()
+    await compactor.stop()
+    trace_queue.stop()
+    # Release the shared async connection pools
+    await db.aclose()
+    await gemini_service.aclose()
+    await rate_limiter.aclose()
 
 
 app = FastAPI(
     title=settings.api_title,
     version=settings.api_version,
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=WireResponse
 )
 
 # CORS middleware
@@ -31,10 +57,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# MessagePack bodies and zstd/gzip compression, for clients that ask for them
+app.add_middleware(
+    WireMiddleware,
+    minimum_size=settings.wire_compress_min_bytes,
+    max_body_size=settings.wire_max_request_bytes,
+)
+
+# Per-route latency and outcome metrics, and Server-Timing headers
+app.add_middleware(TimingMiddleware, router=app.router)
+
+
+@app.exception_handler(OverloadedError)
+async def overloaded(request: Request, exc: OverloadedError):
+    """Shed requests whose upstream calls are over their concurrency limit."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
 # Include routers
 app.include_router(auth.router, prefix=settings.api_prefix)
 app.include_router(context.router, prefix=settings.api_prefix)
 app.include_router(traces.router, prefix=settings.api_prefix)
+app.include_router(admin.router, prefix=settings.api_prefix)
 
 
 @app.get("/")
@@ -49,6 +97,29 @@ async def root():
 
 @app.get("/health")
 async def health():
-    """Health check endpoint."""
-    return {"status": "ok"}
+    """Health check endpoint, with the circuit breaker state of each upstream.
+    
+    Answers 200 even while an upstream's breaker is open, since requests are
+    still served, in degraded form.
+    """
+    upstreams = {name: breaker.stats() for name, breaker in circuit_breakers.items()}
+    closed = all(upstream["state"] == "closed" for upstream in upstreams.values())
+    return {"status": "ok" if closed else "degraded", "upstreams": upstreams}
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness endpoint: 503 until the upstream clients are set up.
+    
+    `/health` answers as soon as the app is serving, so it suits liveness
+    checks; route traffic by this one.
+    """
+    status = warmup.status()
+    return JSONResponse(status_code=200 if warmup.ready else 503, content=status)
+
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics endpoint."""
+    body, content_type = metrics_response_body()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,444 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi.routing import APIRoute
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.routing import Match
+
+from .circuit_breaker import CircuitOpenError, breaker_for, circuit_breakers
+from .concurrency import OverloadedError, limiter_for, upstream_limiters
+from .config import settings
+from .profiler import profiler
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests by route, method, status code and outcome.",
+    ["route", "method", "status", "outcome"]
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route and method.",
+    ["route", "method"],
+    buckets=LATENCY_BUCKETS
+)
+UPSTREAM_CALLS = Counter(
+    "upstream_calls_total",
+    "Calls to upstream services by upstream, operation and outcome.",
+    ["upstream", "operation", "outcome"]
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_call_duration_seconds",
+    "Latency of calls to upstream services.",
+    ["upstream", "operation"],
+    buckets=LATENCY_BUCKETS
+)
+DEGRADED = Counter(
+    "degraded_responses_total",
+    "Responses served in a degraded form (e.g. retrieval fell back to echoing the prompt).",
+    ["reason"]
+)
+RATE_LIMITED = Counter(
+    "rate_limited_requests_total",
+    "Requests rejected with a 429 by the per-API-key or per-user rate limit.",
+    ["scope"]
+)
+TRACES_DEDUPLICATED = Counter(
+    "traces_deduplicated_total",
+    "Stored traces that repeated an existing trace and were counted instead of uploaded."
+)
+TRACES_EVICTED = Counter(
+    "traces_evicted_total",
+    "Traces evicted by retention compaction."
+)
+TRACE_QUEUE_FAILED = Gauge(
+    "trace_queue_failed",
+    "Traces in the write-behind queue that ran out of attempts and await deletion."
+)
+
+
+class RequestTiming:
+    """Spans recorded while serving one request, for the Server-Timing header."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+        self.degraded: Optional[str] = None
+
+    def totals(self) -> Dict[str, float]:
+        """Seconds spent in each span or stage, summed by name."""
+        totals: Dict[str, float] = {}
+        for name, duration in self.spans:
+            totals[name] = totals.get(name, 0.0) + duration
+        return totals
+
+    def server_timing(self) -> str:
+        entries = [f"{name};dur={duration * 1000:.1f}" for name, duration in self.totals().items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_request_timing: contextvars.ContextVar[Optional[RequestTiming]] = contextvars.ContextVar("request_timing", default=None)
+_current_span: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current_timing() -> Optional[RequestTiming]:
+    """The timing record of the request being served, if any."""
+    return _request_timing.get()
+
+
+def mark_degraded(reason: str):
+    """Count a degraded response and flag the current request's outcome as degraded."""
+    DEGRADED.labels(reason=reason).inc()
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.degraded = reason
+
+
+@contextmanager
+def span(upstream: str, operation: str):
+    """Time a call to an upstream service.
+
+    Records latency and outcome metrics and, inside a request, a Server-Timing
+    entry. A span nested in a span of the same name (e.g. an async method
+    falling back to its sync twin) is not counted twice. Inside a request the
+    call also counts against the upstream's concurrency limit, and is shed
+    with OverloadedError when the limit is reached, and goes through its
+    circuit breaker, failing fast with CircuitOpenError while it is open;
+    background work is not limited.
+    """
+    name = f"{upstream}.{operation}"
+    if _current_span.get() == name:
+        yield
+        return
+
+    in_request = _request_timing.get() is not None
+    limiter = limiter_for(upstream) if in_request else None
+    if limiter is not None and not limiter.try_acquire():
+        UPSTREAM_CALLS.labels(upstream=upstream, operation=operation, outcome="shed").inc()
+        raise OverloadedError(upstream)
+    breaker = breaker_for(upstream) if in_request else None
+    admitted = breaker.acquire() if breaker is not None else None
+    if breaker is not None and admitted is None:
+        if limiter is not None:
+            limiter.cancel()
+        UPSTREAM_CALLS.labels(upstream=upstream, operation=operation, outcome="short_circuit").inc()
+        raise CircuitOpenError(upstream, breaker.retry_after())
+
+    token = _current_span.set(name)
+    start = time.perf_counter()
+    outcome = "error"
+    error: Optional[BaseException] = None
+    try:
+        yield
+        outcome = "ok"
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current_span.reset(token)
+        if limiter is not None:
+            limiter.release(duration, error)
+        if breaker is not None:
+            breaker.release(admitted, duration, error)
+        UPSTREAM_CALLS.labels(upstream=upstream, operation=operation, outcome=outcome).inc()
+        UPSTREAM_LATENCY.labels(upstream=upstream, operation=operation).observe(duration)
+        timing = _request_timing.get()
+        if timing is not None:
+            timing.spans.append((name, duration))
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of serving a request (e.g. authentication or serialization).
+
+    The stage's time, less that of the spans and stages recorded inside it,
+    is added to the request's Server-Timing entries and slow-request
+    breakdown. Outside a request it does nothing.
+    """
+    timing = _request_timing.get()
+    if timing is None:
+        yield
+        return
+
+    nested = len(timing.spans)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start - sum(d for _, d in timing.spans[nested:])
+        timing.spans.append((name, max(0.0, duration)))
+
+
+class TimedRoute(APIRoute):
+    """A route whose endpoint runs in a "handler" stage.
+
+    Time outside the stages (routing, request validation and response model
+    serialization) shows as the remainder of a slow request's breakdown.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if inspect.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed_endpoint(*args, **kwargs):
+                with stage("handler"):
+                    return await endpoint(*args, **kwargs)
+        else:
+            @functools.wraps(endpoint)
+            def timed_endpoint(*args, **kwargs):
+                with stage("handler"):
+                    return endpoint(*args, **kwargs)
+        super().__init__(path, timed_endpoint, **kwargs)
+
+
+def timed(upstream: str, operation: str) -> Callable:
+    """Decorator wrapping a sync function or coroutine function in a span."""
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(upstream, operation):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(upstream, operation):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class CacheCollector:
+    """Exports the hit/miss/eviction counters and sizes of caches.
+
+    Counters are this process's; the size of a shared cache is the shared size.
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, Any] = {}
+
+    def register(self, name: str, cache: Any):
+        """Export a cache exposing `stats()` under the given name."""
+        self._caches[name] = cache
+
+    def collect(self):
+        requests = CounterMetricFamily("cache_requests", "Cache lookups by cache and result.", labels=["cache", "result"])
+        evictions = CounterMetricFamily("cache_evictions", "Entries evicted to stay within size.", labels=["cache"])
+        oversized = CounterMetricFamily("cache_oversized", "Values too large for a cache slot, not cached.", labels=["cache"])
+        size = GaugeMetricFamily("cache_entries", "Entries currently cached.", labels=["cache"])
+        for name, cache in self._caches.items():
+            stats = cache.stats()
+            requests.add_metric([name, "hit"], stats["hits"])
+            requests.add_metric([name, "miss"], stats["misses"])
+            if "near_hits" in stats:
+                requests.add_metric([name, "near_hit"], stats["near_hits"])
+            # Not known for caches that Redis evicts and sizes
+            if "evictions" in stats:
+                evictions.add_metric([name], stats["evictions"])
+            # Only fixed-size slots turn values away
+            if "oversized" in stats:
+                oversized.add_metric([name], stats["oversized"])
+            if "size" in stats:
+                size.add_metric([name], stats["size"])
+        yield requests
+        yield evictions
+        yield oversized
+        yield size
+
+
+caches = CacheCollector()
+REGISTRY.register(caches)
+
+
+class SingleFlightCollector:
+    """Exports how many requests each single-flight group served from a shared call."""
+
+    def __init__(self):
+        self._flights: Dict[str, Any] = {}
+
+    def register(self, flight: Any):
+        """Export a SingleFlight under its name."""
+        self._flights[flight.name] = flight
+
+    def collect(self):
+        requests = CounterMetricFamily(
+            "singleflight_requests",
+            "Requests by single-flight group; 'shared' ones reused another request's upstream call.",
+            labels=["flight", "result"]
+        )
+        ratio = GaugeMetricFamily("singleflight_dedup_ratio", "Fraction of requests served from a shared call.", labels=["flight"])
+        inflight = GaugeMetricFamily("singleflight_inflight", "Upstream calls currently in flight.", labels=["flight"])
+        for name, flight in self._flights.items():
+            stats = flight.stats()
+            requests.add_metric([name, "leader"], stats["calls"])
+            requests.add_metric([name, "shared"], stats["shared"])
+            ratio.add_metric([name], stats["dedup_ratio"])
+            inflight.add_metric([name], stats["inflight"])
+        yield requests
+        yield ratio
+        yield inflight
+
+
+flights = SingleFlightCollector()
+REGISTRY.register(flights)
+
+
+class ConcurrencyCollector:
+    """Exports the adaptive concurrency limits on upstream calls."""
+
+    def collect(self):
+        limit = GaugeMetricFamily("upstream_concurrency_limit", "Current adaptive concurrency limit.", labels=["upstream"])
+        inflight = GaugeMetricFamily("upstream_inflight", "Limited upstream calls in flight.", labels=["upstream"])
+        decreases = CounterMetricFamily(
+            "upstream_concurrency_decreases",
+            "Times the limit was cut after a slow, timed out or throttled call.",
+            labels=["upstream"]
+        )
+        for name, limiter in upstream_limiters.items():
+            stats = limiter.stats()
+            limit.add_metric([name], stats["limit"])
+            inflight.add_metric([name], stats["inflight"])
+            decreases.add_metric([name], stats["decreases"])
+        yield limit
+        yield inflight
+        yield decreases
+
+
+REGISTRY.register(ConcurrencyCollector())
+
+
+class CircuitBreakerCollector:
+    """Exports the state of the upstream circuit breakers."""
+
+    def collect(self):
+        state = GaugeMetricFamily(
+            "circuit_breaker_state",
+            "1 for the state each upstream's breaker is in, 0 for the others.",
+            labels=["upstream", "state"]
+        )
+        opens = CounterMetricFamily("circuit_breaker_opens", "Times the breaker opened.", labels=["upstream"])
+        for name, breaker in circuit_breakers.items():
+            stats = breaker.stats()
+            for candidate in ("closed", "open", "half_open"):
+                state.add_metric([name, candidate], 1 if stats["state"] == candidate else 0)
+            opens.add_metric([name], stats["opens"])
+        yield state
+        yield opens
+
+
+REGISTRY.register(CircuitBreakerCollector())
+
+
+class SlowRequestLog:
+    """The most recent requests slower than `slow_request_threshold_ms`, with their per-stage breakdown."""
+
+    def __init__(self, size: int):
+        self._requests: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, scope, route: str, status: int, outcome: str, timing: RequestTiming, duration: float):
+        stages = {name: round(seconds * 1000, 3) for name, seconds in timing.totals().items()}
+        entry = {
+            "time": datetime.now(timezone.utc),
+            "method": scope["method"],
+            "route": route,
+            "path": scope["path"],
+            "status": status,
+            "outcome": outcome,
+            "duration_ms": round(duration * 1000, 3),
+            "stages": stages,
+            # Routing, validation and waiting for the event loop; spans run concurrently can make this 0
+            "other_ms": round(max(0.0, duration * 1000 - sum(stages.values())), 3),
+        }
+        with self._lock:
+            self._requests.append(entry)
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        """Up to `limit` slow requests, newest first."""
+        with self._lock:
+            return list(reversed(self._requests))[:limit]
+
+
+slow_requests = SlowRequestLog(settings.slow_request_buffer_size)
+
+
+def _route_path(app, scope) -> str:
+    """The route template that served a request, to keep label cardinality bounded."""
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", "unmatched")
+    for route in getattr(app, "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unmatched")
+    return "unmatched"
+
+
+class TimingMiddleware:
+    """ASGI middleware recording per-route latency and outcome, and adding a Server-Timing header.
+
+    Requests slower than `slow_request_threshold_ms` are kept in `slow_requests`.
+    Requests are also marked for the sampling profiler, when a session samples them.
+    """
+
+    def __init__(self, app, router=None):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = _request_timing.set(timing)
+        profiled = profiler.sample_request()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.server_timing().encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timing.reset(token)
+            if profiled is not None:
+                profiled.var.reset(profiled)
+            duration = time.perf_counter() - timing.start
+            route = _route_path(self.router, scope)
+            if status >= 500:
+                outcome = "error"
+            elif status >= 400:
+                outcome = "client_error"
+            elif timing.degraded:
+                outcome = "degraded"
+            else:
+                outcome = "ok"
+            REQUESTS.labels(route=route, method=scope["method"], status=str(status), outcome=outcome).inc()
+            REQUEST_LATENCY.labels(route=route, method=scope["method"]).observe(duration)
+            threshold = settings.slow_request_threshold_ms
+            if threshold and duration * 1000 >= threshold:
+                slow_requests.record(scope, route, status, outcome, timing, duration)
+
+
+def metrics_response_body() -> Tuple[bytes, str]:
+    """Render all metrics in the Prometheus text format. Returns (body, content type)."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
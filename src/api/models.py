@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Literal
 from datetime import datetime
 
 
@@ -11,6 +11,8 @@ class ContextRetrieveRequest(BaseModel):
     system_prompt: Optional[str] = None
     provider: str  # e.g., "openai", "anthropic"
     model: str  # e.g., "gpt-4", "claude-3-5-sonnet"
+    max_context_tokens: Optional[int] = Field(default=None, gt=0)  # defaults to CONTEXT_TOKEN_BUDGET
+    mode: Optional[Literal["retrieve_only", "synthesize", "auto"]] = None  # defaults to CONTEXT_MODE
 
 
 class ContextRetrieveResponse(BaseModel):
@@ -18,6 +20,41 @@ class ContextRetrieveResponse(BaseModel):
     enhanced_context: str
     relevant_traces: List[Dict[str, Any]]
     suggestions: Dict[str, Any]
+    context: Dict[str, Any] = Field(default_factory=dict)  # token budget accounting
+
+
+class ContextBatchItem(BaseModel):
+    """One prompt of a batch retrieval."""
+    prompt: str
+    system_prompt: Optional[str] = None
+    max_context_tokens: Optional[int] = Field(default=None, gt=0)
+    mode: Optional[Literal["retrieve_only", "synthesize", "auto"]] = None
+
+
+class ContextRetrieveBatchRequest(BaseModel):
+    """Request model for retrieving context for many prompts at once."""
+    provider: str
+    model: str
+    items: List[ContextBatchItem] = Field(..., min_length=1)
+    dedupe: bool = True  # return chunks shared by several items once, in `chunks`
+
+
+class ContextBatchResult(BaseModel):
+    """One prompt's result in a batch retrieval; `error` is set instead if it failed."""
+    index: int
+    enhanced_context: Optional[str] = None
+    # With dedupe, {"chunk_id", "relevance_score"} entries referring to the response's `chunks`
+    relevant_traces: List[Dict[str, Any]] = Field(default_factory=list)
+    suggestions: Dict[str, Any] = Field(default_factory=dict)
+    context: Dict[str, Any] = Field(default_factory=dict)
+    error: Optional[str] = None
+    retry_after: Optional[int] = None  # set when the item was shed
+
+
+class ContextRetrieveBatchResponse(BaseModel):
+    """Response model for batch retrieval."""
+    results: List[ContextBatchResult]
+    chunks: Dict[str, Dict[str, Any]] = Field(default_factory=dict)  # chunk_id -> chunk
 
 
 class TraceInput(BaseModel):
@@ -54,6 +91,88 @@ class TraceStoreResponse(BaseModel):
     """Response model for trace storage."""
     trace_id: str
     stored: bool
+    status: str = "stored"  # "stored", "queued" or "failed"
+
+
+class TraceStoreBatchRequest(BaseModel):
+    """Request model for storing many traces in one call."""
+    traces: List[TraceStoreRequest] = Field(..., min_length=1)
+
+
+class TraceStoreBatchResponse(BaseModel):
+    """Response model for batched trace storage."""
+    trace_ids: List[str]
+    stored: bool
+    status: str = "stored"  # "stored", "queued" or "failed"
+
+
+class TraceStatusResponse(BaseModel):
+    """Response model for a trace's indexing status."""
+    trace_id: str
+    status: str  # "queued", "pending", "indexed" or "failed"
+    created_at: Optional[datetime] = None
+
+
+class TraceRecord(BaseModel):
+    """A stored trace's metadata, as listed and exported."""
+    trace_id: str
+    provider: Optional[str] = None
+    model: Optional[str] = None
+    success: Optional[bool] = None
+    tokens_used: Optional[int] = None
+    latency_ms: Optional[int] = None
+    status: str
+    hit_count: int = 1
+    size_bytes: Optional[int] = None
+    created_at: Optional[datetime] = None
+    last_seen_at: Optional[datetime] = None
+
+
+class TraceListResponse(BaseModel):
+    """A page of the user's traces, newest first."""
+    traces: List[TraceRecord]
+    next_cursor: Optional[str] = None  # pass as `cursor` for the next page; None on the last page
+
+
+class LatencyStats(BaseModel):
+    """Latency of traces that reported one, in milliseconds; percentiles are estimated from a histogram."""
+    mean_ms: Optional[float] = None
+    p50_ms: Optional[float] = None
+    p95_ms: Optional[float] = None
+    p99_ms: Optional[float] = None
+    max_ms: Optional[float] = None
+
+
+class TraceStatsSummary(BaseModel):
+    """Aggregate statistics of a set of traces."""
+    traces: int
+    successes: int
+    success_rate: Optional[float] = None
+    tokens_used: int
+    avg_tokens: Optional[float] = None
+    latency: LatencyStats
+
+
+class TraceStatsGroup(TraceStatsSummary):
+    """Statistics of one provider, or one provider's model."""
+    provider: Optional[str] = None
+    model: Optional[str] = None
+
+
+class TraceStatsBucket(TraceStatsSummary):
+    """Statistics of one hour or day."""
+    bucket: datetime
+
+
+class TraceStatsResponse(BaseModel):
+    """Response model for trace analytics."""
+    start: datetime
+    end: datetime
+    granularity: str  # "hour" or "day"
+    group_by: str  # "model" or "provider"
+    totals: TraceStatsSummary
+    groups: List[TraceStatsGroup]
+    series: List[TraceStatsBucket]
 
 
 class CreateAPIKeyRequest(BaseModel):
@@ -66,3 +185,43 @@ class CreateAPIKeyResponse(BaseModel):
     api_key: str
     user_id: str
 
+
+class RevokeAPIKeyResponse(BaseModel):
+    """Response model for API key revocation."""
+    revoked: bool
+
+
+class ProfilerStartRequest(BaseModel):
+    """Request model for starting a profiling session."""
+    duration: float = Field(..., gt=0)  # seconds, up to PROFILER_MAX_DURATION
+    sample_rate: float = Field(default=1.0, gt=0, le=1)  # fraction of requests profiled; 1 profiles the whole process
+
+
+class ProfilerStatus(BaseModel):
+    """Response model for the sampling profiler's current or last session."""
+    running: bool
+    started_at: Optional[datetime] = None
+    duration: float
+    sample_rate: float
+    interval: float
+    samples: int
+    stacks: int  # distinct stacks recorded
+
+
+class SlowRequest(BaseModel):
+    """A request slower than SLOW_REQUEST_THRESHOLD_MS, with the milliseconds spent in each stage."""
+    time: datetime
+    method: str
+    route: str
+    path: str
+    status: int
+    outcome: str
+    duration_ms: float
+    stages: Dict[str, float]
+    other_ms: float
+
+
+class SlowRequestsResponse(BaseModel):
+    """Response model for recent slow requests."""
+    threshold_ms: float
+    requests: List[SlowRequest]
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class OperationFailed(Exception):
+    """Raised through a tracked future when the operation finished with an error."""
+
+
+class _Tracked:
+    __slots__ = ("operation", "future", "interval", "next_poll", "poll_errors")
+
+    def __init__(self, operation: Any, future: Future, interval: float):
+        self.operation = operation
+        self.future = future
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+        self.poll_errors = 0
+
+
+class OperationTracker:
+    """Tracks long-running operations from a single background thread.
+
+    Each tracked operation is polled with its own exponential backoff, from
+    `min_interval` up to `max_interval`. Every round polls all due operations
+    together, up to `max_batch`, on a small thread pool. Completion resolves
+    the Future returned by `track`.
+    """
+
+    def __init__(
+        self,
+        poll: Callable[[Any], Any],
+        min_interval: float = 0.25,
+        max_interval: float = 8.0,
+        max_batch: int = 32,
+        max_poll_errors: int = 5
+    ):
+        self.poll = poll
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_batch = max_batch
+        self.max_poll_errors = max_poll_errors
+        self._pending: List[_Tracked] = []
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _ensure_started(self):
+        """Start the polling thread on first use. Caller must hold the condition."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="operation-poll")
+            self._thread = threading.Thread(target=self._run, name="operation-tracker", daemon=True)
+            self._thread.start()
+
+    def track(self, operation: Any) -> Future:
+        """Track an operation and return a Future resolved with the finished operation."""
+        future: Future = Future()
+        with self._cond:
+            self._ensure_started()
+            if getattr(operation, "done", False):
+                # Resolve off the caller's thread, like every other completion
+                self._executor.submit(self._resolve, future, operation)
+            else:
+                self._pending.append(_Tracked(operation, future, self.min_interval))
+                self._cond.notify()
+        return future
+
+    def _resolve(self, future: Future, operation: Any):
+        error = getattr(operation, "error", None)
+        if error:
+            future.set_exception(OperationFailed(str(error)))
+        else:
+            future.set_result(operation)
+
+    def _poll(self, tracked: _Tracked):
+        try:
+            return self.poll(tracked.operation), None
+        except Exception as e:
+            return None, e
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+
+                now = time.monotonic()
+                due = [tracked for tracked in self._pending if tracked.next_poll <= now][:self.max_batch]
+                if not due:
+                    self._cond.wait(min(tracked.next_poll for tracked in self._pending) - now)
+                    continue
+
+            results = list(self._executor.map(self._poll, due))
+
+            now = time.monotonic()
+            finished = []
+            for tracked, (operation, error) in zip(due, results):
+                if error is not None:
+                    tracked.poll_errors += 1
+                    if tracked.poll_errors >= self.max_poll_errors:
+                        tracked.future.set_exception(error)
+                        finished.append(tracked)
+                        continue
+                elif operation.done:
+                    self._resolve(tracked.future, operation)
+                    finished.append(tracked)
+                    continue
+                else:
+                    tracked.operation = operation
+
+                # Back off until the next poll of this operation
+                tracked.interval = min(tracked.interval * 2, self.max_interval)
+                tracked.next_poll = now + tracked.interval
+
+            if finished:
+                with self._cond:
+                    self._pending = [tracked for tracked in self._pending if tracked not in finished]
+
+    def stop(self, timeout: float = 5.0):
+        """Stop polling. Operations still in flight are left unresolved."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from .config import settings
+
+# Whether the current request (and the tasks it starts) is being profiled
+_profiled: contextvars.ContextVar[bool] = contextvars.ContextVar("profiled", default=False)
+
+# Frames of a thread with nothing to do: pool workers waiting for work, the event loop polling
+_IDLE = {("queue.py", "get"), ("selectors.py", "select")}
+# Longest path prefixes first, so that labels are relative to the innermost root
+_ROOTS = sorted({os.path.abspath(p) for p in [os.getcwd(), *sys.path] if p}, key=len, reverse=True)
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profiling session is started while another one is running."""
+
+
+def _label(code) -> str:
+    """A frame's label: function, file and first line. Empty for the frames of an idle thread."""
+    filename = code.co_filename
+    if (os.path.basename(filename), code.co_name) in _IDLE:
+        return ""
+    for root in _ROOTS:
+        if filename.startswith(root + os.sep):
+            filename = filename[len(root) + 1:]
+            break
+    # co_qualname is new in Python 3.11
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({filename}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """A statistical profiler that can be switched on in production.
+
+    A background thread samples the Python stacks of the process's threads
+    every `interval` seconds, for the `duration` of a session, and counts
+    identical stacks. The event loop's stack is sampled while a task is
+    running on it; idle worker threads are skipped. The result is in the
+    collapsed-stack format of flamegraph.pl, speedscope and inferno.
+
+    With a `sample_rate` below 1, only a random fraction of requests is
+    profiled: the event loop is sampled while one of their tasks (or a task
+    they started) is running, and other threads are not sampled, since their
+    work cannot be told apart by request.
+
+    Sessions profile the worker process that started them.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.started_at: Optional[datetime] = None
+        self.duration = 0.0
+        self.sample_rate = 1.0
+        self.samples = 0
+        self._stacks: Dict[str, int] = {}
+        self._labels: Dict[Any, str] = {}
+        self._tasks: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._previous_factory = None
+        # Counts sessions, so that one ending does not undo the next one's setup
+        self._sessions = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float, sample_rate: float = 1.0):
+        """Start a session from the event loop, discarding the last one's samples."""
+        if self.running:
+            raise ProfilerBusyError("A profiling session is already running")
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        if sample_rate < 1 and getattr(self._loop.get_task_factory(), "__self__", None) is not self:
+            self._previous_factory = self._loop.get_task_factory()
+            self._loop.set_task_factory(self._task_factory)
+
+        with self._lock:
+            self._stacks = {}
+            self.samples = 0
+        self._tasks = weakref.WeakSet()
+        self.started_at = datetime.now(timezone.utc)
+        self.duration = duration
+        self.sample_rate = sample_rate
+        self._stop.clear()
+        self._sessions += 1
+        self._thread = threading.Thread(
+            target=self._run, args=(time.monotonic() + duration, self._sessions), name="profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """End the running session early. Its samples are kept."""
+        self._stop.set()
+
+    def sample_request(self) -> Optional[contextvars.Token]:
+        """Called as a request starts: marks it as profiled if the session samples it.
+
+        Returns a token to reset once the request is served, or None.
+        """
+        if not (self.running and self.sample_rate < 1 and random.random() < self.sample_rate):
+            return None
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks.add(task)
+        return _profiled.set(True)
+
+    def _task_factory(self, loop, coro, **kwargs):
+        # Tasks started by a profiled request are profiled with it
+        if self._previous_factory is not None:
+            task = self._previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        if _profiled.get():
+            self._tasks.add(task)
+        return task
+
+    def _run(self, deadline: float, session: int):
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            self._sample()
+        loop = self._loop
+        if getattr(loop.get_task_factory(), "__self__", None) is self:
+            try:
+                loop.call_soon_threadsafe(self._restore_task_factory, loop, session)
+            except RuntimeError:
+                # The loop is closed, and its factory with it
+                pass
+
+    def _restore_task_factory(self, loop: asyncio.AbstractEventLoop, session: int):
+        # Runs on the event loop once a session ends; a session started since keeps the factory
+        if session == self._sessions and getattr(loop.get_task_factory(), "__self__", None) is self:
+            loop.set_task_factory(self._previous_factory)
+            self._previous_factory = None
+
+    def _sample(self):
+        me = threading.get_ident()
+        current = asyncio.current_task(self._loop) if self._loop is not None else None
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            if thread_id == self._loop_thread:
+                if current is None or (self.sample_rate < 1 and current not in self._tasks):
+                    continue
+            elif self.sample_rate < 1:
+                continue
+
+            labels = []
+            idle = False
+            while frame is not None:
+                code = frame.f_code
+                label = self._labels.get(code)
+                if label is None:
+                    label = self._labels[code] = _label(code)
+                if not label:
+                    idle = True
+                    break
+                labels.append(label)
+                frame = frame.f_back
+            if not idle:
+                stacks.append(";".join(reversed(labels)))
+
+        with self._lock:
+            self.samples += 1
+            for stack in stacks:
+                self._stacks[stack] = self._stacks.get(stack, 0) + 1
+
+    def collapsed(self) -> str:
+        """The current or last session's stacks, one `frame;frame;... count` line each."""
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "running": self.running,
+                "started_at": self.started_at,
+                "duration": self.duration,
+                "sample_rate": self.sample_rate,
+                "interval": self.interval,
+                "samples": self.samples,
+                "stacks": len(self._stacks),
+            }
+
+
+profiler = SamplingProfiler(settings.profiler_interval)
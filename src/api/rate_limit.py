@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedError(Exception):
+    """Raised when a request exceeds its API key's or user's rate limit."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded for this {scope.replace('_', ' ')}")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class MemoryBuckets:
+    """Token buckets held in this process, bounded to the `max_keys` most recently used."""
+
+    def __init__(self, max_keys: int, clock: Callable[[], float] = time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        # key -> (tokens, time they were counted)
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def take(self, key: str, rate: float, burst: int, cost: float = 1.0) -> float:
+        """Take `cost` tokens from a bucket. Returns 0 if taken, else seconds until they will be available."""
+        now = self._clock()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # A dropped bucket comes back full, as it would have after idling anyway
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    async def aclose(self):
+        pass
+
+
+# Refill and take atomically on the Redis server, using its clock so that every
+# process sees the same time. Returns the wait as a string: Lua numbers returned
+# to Redis are truncated to integers.
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+class RedisBuckets:
+    """Token buckets in Redis, shared by every worker and instance pointed at it.
+
+    If Redis cannot be reached, requests are let through rather than failed.
+    """
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        # Only needed with this backend
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(_TAKE_SCRIPT)
+
+    async def take(self, key: str, rate: float, burst: int, cost: float = 1.0) -> float:
+        """Take `cost` tokens from a bucket. Returns 0 if taken, else seconds until they will be available."""
+        try:
+            return float(await self._take(keys=[self.prefix + key], args=[rate, burst, cost]))
+        except Exception:
+            logger.warning("Rate limit backend unavailable, allowing request", exc_info=True)
+            return 0.0
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class RateLimiter:
+    """Per-API-key and per-user request rate limits, configured by settings."""
+
+    def __init__(self):
+        self._backend = None
+
+    @property
+    def backend(self):
+        """The bucket store, created on first use from `settings.rate_limit_backend`."""
+        if self._backend is None:
+            if settings.rate_limit_backend == "redis":
+                self._backend = RedisBuckets(settings.rate_limit_redis_url)
+            else:
+                self._backend = MemoryBuckets(settings.rate_limit_max_keys)
+        return self._backend
+
+    async def check(self, key_hash: str, user_id: str, cost: float = 1.0):
+        """Count `cost` requests against an API key and user. Raises RateLimitedError when either is exhausted.
+
+        A cost is capped at the bucket's burst, so that it can always be paid once the bucket refills.
+        """
+        if not settings.rate_limit_enabled or cost <= 0:
+            return
+
+        limits: Dict[str, Tuple[str, float, int]] = {
+            "api_key": (f"key:{key_hash}", settings.api_key_rate_limit, settings.api_key_rate_burst),
+            "user": (f"user:{user_id}", settings.user_rate_limit, settings.user_rate_burst),
+        }
+        for scope, (key, rate, burst) in limits.items():
+            retry_after = await self.backend.take(key, rate, burst, min(cost, burst))
+            if retry_after > 0:
+                raise RateLimitedError(scope, retry_after)
+
+    async def aclose(self):
+        """Close the shared backend's connection, if any."""
+        if self._backend is not None:
+            await self._backend.aclose()
+            self._backend = None
+
+
+rate_limiter = RateLimiter()
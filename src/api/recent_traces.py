@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List
+
+from .retrieval_cache import normalize_prompt
+from .trace_records import trace_record, trace_text
+
+
+def _words(text: str) -> set:
+    return set(normalize_prompt(text).split())
+
+
+class RecentTraces:
+    """Each user's most recently stored traces, kept in memory.
+
+    Lets retrieval answer, roughly, without Gemini: traces are matched to a
+    prompt by the overlap of their words.
+    """
+
+    def __init__(self, per_user: int, max_users: int):
+        self.per_user = per_user
+        self.max_users = max_users
+        # user_id -> (words, record) of their latest traces, oldest first
+        self._traces: "OrderedDict[str, Deque[tuple]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, user_id: str, trace_ids: List[str], traces: List[Dict[str, Any]]):
+        """Remember a user's newly stored traces."""
+        entries = [
+            (_words(trace_text(trace)), trace_record(trace_id, trace))
+            for trace_id, trace in zip(trace_ids, traces)
+        ]
+        with self._lock:
+            recent = self._traces.get(user_id)
+            if recent is None:
+                recent = self._traces[user_id] = deque(maxlen=self.per_user)
+            recent.extend(entries)
+            self._traces.move_to_end(user_id)
+            while len(self._traces) > self.max_users:
+                self._traces.popitem(last=False)
+
+    def search(self, user_id: str, prompt: str, k: int) -> List[Dict[str, Any]]:
+        """Return up to k of the user's recent traces sharing words with `prompt`, scored by Jaccard similarity."""
+        query = _words(prompt)
+        with self._lock:
+            recent = list(self._traces.get(user_id, ()))
+        if not query:
+            return []
+
+        scored = []
+        # Newest first, so that they win ties
+        for words, record in reversed(recent):
+            overlap = len(query & words)
+            if overlap:
+                scored.append((overlap / len(query | words), record))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [dict(record, relevance_score=score) for score, record in scored[:k]]
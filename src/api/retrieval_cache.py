@@ -0,0 +1,271 @@
+import copy
+import hashlib
+import random
+import re
+import secrets
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .cache import TTLCache, MISSING
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: Optional[str]) -> str:
+    """Lowercase and collapse whitespace so trivially different prompts share a key."""
+    return _WHITESPACE.sub(" ", (text or "").strip().lower())
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+def _new_generation() -> str:
+    return secrets.token_hex(8)
+
+
+class MinHasher:
+    """MinHash signatures over word shingles, for estimating Jaccard similarity of prompts."""
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 3, seed: int = 1):
+        self.shingle_size = shingle_size
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def shingles(self, text: str) -> set:
+        words = text.split()
+        if len(words) <= self.shingle_size:
+            return {" ".join(words)}
+        return {" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        hashed = [
+            int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+            for shingle in self.shingles(text)
+        ]
+        return tuple(
+            min((a * h + b) % _MERSENNE_PRIME for h in hashed)
+            for a, b in self._perms
+        )
+
+    @staticmethod
+    def similarity(left: Tuple[int, ...], right: Tuple[int, ...]) -> float:
+        """Estimated Jaccard similarity of the shingle sets behind two signatures."""
+        return sum(1 for l, r in zip(left, right) if l == r) / len(left)
+
+
+class RetrievalCache:
+    """Per-user cache of retrieve_context results.
+
+    The exact tier is keyed on a hash of the normalized (user_id, prompt,
+    system_prompt, model, max_results, variant), where `variant` separates
+    results computed differently for the same request (e.g. retrieval modes).
+    The optional near-duplicate tier compares MinHash signatures of prompts
+    that share everything else.
+
+    Results and each user's generation live in `results` and `generations`,
+    which may be shared between processes (see shared_cache.py), so that an
+    invalidation in one process reaches all of them. The near-duplicate
+    signatures stay in the process that computed them.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        near_duplicate_threshold: Optional[float] = None,
+        max_signatures_per_user: int = 256,
+        results=None,
+        generations=None
+    ):
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.max_signatures_per_user = max_signatures_per_user
+        self._results = results if results is not None else TTLCache(max_size=max_size, ttl=ttl)
+        # Outlive the results, so that a forgotten generation only costs misses
+        self._generation_ttl = ttl * 2
+        self._generations = generations if generations is not None else TTLCache(max_size=max_size, ttl=self._generation_ttl)
+        self._hasher = MinHasher()
+        # (user_id, context digest) -> [(signature, exact key)], most recent last
+        self._signatures: Dict[Tuple[str, str], List[Tuple[Tuple[int, ...], str]]] = {}
+        self._lock = threading.Lock()
+        self.near_hits = 0
+
+    def _keys(
+        self,
+        user_id: str,
+        generation: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        variant: str
+    ) -> Tuple[Tuple[str, str], str]:
+        context = _digest(normalize_prompt(system_prompt), model, str(max_results), variant)
+        exact = f"{user_id}:{generation}:{_digest(context, normalize_prompt(prompt))}"
+        return (user_id, context), exact
+
+    def _near_duplicate(self, bucket: Tuple[str, str], prompt: str) -> Optional[str]:
+        """The exact key of the most similar cached prompt in `bucket`, if similar enough."""
+        if self.near_duplicate_threshold is None:
+            return None
+
+        signature = self._hasher.signature(normalize_prompt(prompt))
+        with self._lock:
+            candidates = list(self._signatures.get(bucket, ()))
+
+        best_key, best_score = None, self.near_duplicate_threshold
+        for candidate, key in reversed(candidates):
+            score = MinHasher.similarity(signature, candidate)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _remember(self, bucket: Tuple[str, str], exact: str, prompt: str):
+        if self.near_duplicate_threshold is None:
+            return
+
+        signature = self._hasher.signature(normalize_prompt(prompt))
+        with self._lock:
+            signatures = self._signatures.setdefault(bucket, [])
+            signatures.append((signature, exact))
+            if len(signatures) > self.max_signatures_per_user:
+                del signatures[0]
+
+    def get(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        variant: str = "",
+        generation: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Return a cached result for this request or a near-duplicate of it, or None.
+
+        Pass the user's `generation` if already read, to save looking it up.
+        """
+        if generation is None:
+            generation = self.generation(user_id)
+        bucket, exact = self._keys(user_id, generation, prompt, system_prompt, model, max_results, variant)
+
+        result = self._results.get(exact)
+        if result is not MISSING:
+            return copy.deepcopy(result)
+
+        near = self._near_duplicate(bucket, prompt)
+        if near is not None:
+            result = self._results.get(near)
+            if result is not MISSING:
+                self.near_hits += 1
+                return copy.deepcopy(result)
+
+        return None
+
+    async def aget(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        variant: str = "",
+        generation: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Return a cached result for this request or a near-duplicate of it, or None."""
+        if generation is None:
+            generation = await self.ageneration(user_id)
+        bucket, exact = self._keys(user_id, generation, prompt, system_prompt, model, max_results, variant)
+
+        result = await self._results.aget(exact)
+        if result is not MISSING:
+            return copy.deepcopy(result)
+
+        near = self._near_duplicate(bucket, prompt)
+        if near is not None:
+            result = await self._results.aget(near)
+            if result is not MISSING:
+                self.near_hits += 1
+                return copy.deepcopy(result)
+
+        return None
+
+    def set(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        result: Dict[str, Any],
+        generation: Optional[str] = None,
+        variant: str = ""
+    ):
+        """Cache a retrieval result.
+
+        Pass the `generation` read before retrieving so that a result computed
+        while the user's traces changed is not cached.
+        """
+        current = self.generation(user_id)
+        if generation is not None and generation != current:
+            return
+
+        bucket, exact = self._keys(user_id, current, prompt, system_prompt, model, max_results, variant)
+        self._results.set(exact, copy.deepcopy(result))
+        self._remember(bucket, exact, prompt)
+
+    async def aset(
+        self,
+        user_id: str,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: str,
+        max_results: int,
+        result: Dict[str, Any],
+        generation: Optional[str] = None,
+        variant: str = ""
+    ):
+        """Cache a retrieval result, unless the user's generation has moved on from `generation`."""
+        current = await self.ageneration(user_id)
+        if generation is not None and generation != current:
+            return
+
+        bucket, exact = self._keys(user_id, current, prompt, system_prompt, model, max_results, variant)
+        await self._results.aset(exact, copy.deepcopy(result))
+        self._remember(bucket, exact, prompt)
+
+    def generation(self, user_id: str) -> str:
+        """Current invalidation generation for a user.
+
+        Generations are random, never counted: one that is evicted or expires
+        is replaced by a new one, which cannot lead back to older results.
+        """
+        generation = self._generations.get(user_id)
+        if generation is MISSING:
+            generation = _new_generation()
+            self._generations.set(user_id, generation, ttl=self._generation_ttl)
+        return generation
+
+    async def ageneration(self, user_id: str) -> str:
+        generation = await self._generations.aget(user_id)
+        if generation is MISSING:
+            generation = _new_generation()
+            await self._generations.aset(user_id, generation, ttl=self._generation_ttl)
+        return generation
+
+    def invalidate_user(self, user_id: str):
+        """Drop every cached result for a user, e.g. after they store new traces."""
+        self._generations.set(user_id, _new_generation(), ttl=self._generation_ttl)
+        with self._lock:
+            buckets = [bucket for bucket in self._signatures if bucket[0] == user_id]
+            for bucket in buckets:
+                del self._signatures[bucket]
+
+    def stats(self) -> Dict[str, int]:
+        stats = self._results.stats()
+        stats["near_hits"] = self.near_hits
+        return stats
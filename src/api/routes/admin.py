@@ -0,0 +1,55 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from ..models import ProfilerStartRequest, ProfilerStatus, SlowRequestsResponse
+from ..auth import verify_admin_key
+from ..config import settings
+from ..metrics import TimedRoute, slow_requests
+from ..profiler import ProfilerBusyError, profiler
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(verify_admin_key)], route_class=TimedRoute)
+
+
+@router.get("/profiler", response_model=ProfilerStatus)
+async def profiler_status():
+    """Report the sampling profiler's current or last session."""
+    return profiler.status()
+
+
+@router.post("/profiler/start", response_model=ProfilerStatus)
+async def start_profiler(request: ProfilerStartRequest):
+    """Start sampling stacks for `duration` seconds, of all requests or of a `sample_rate` fraction of them.
+
+    Profiles the worker process that serves this request.
+    """
+    if request.duration > settings.profiler_max_duration:
+        raise HTTPException(
+            status_code=400,
+            detail=f"duration must be at most {settings.profiler_max_duration:g} seconds"
+        )
+    try:
+        profiler.start(request.duration, request.sample_rate)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return profiler.status()
+
+
+@router.post("/profiler/stop", response_model=ProfilerStatus)
+async def stop_profiler():
+    """End the running session early, keeping its samples."""
+    profiler.stop()
+    return profiler.status()
+
+
+@router.get("/profiler/stacks", response_class=PlainTextResponse)
+async def profiler_stacks():
+    """The session's samples as collapsed stacks, for flamegraph.pl, speedscope or inferno."""
+    return PlainTextResponse(profiler.collapsed())
+
+
+@router.get("/slow-requests", response_model=SlowRequestsResponse)
+async def get_slow_requests(limit: int = Query(default=50, ge=1)):
+    """Recent requests slower than SLOW_REQUEST_THRESHOLD_MS, newest first, with their per-stage breakdown.
+
+    Each worker process keeps its own.
+    """
+    return {"threshold_ms": settings.slow_request_threshold_ms, "requests": slow_requests.recent(limit)}
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, HTTPException
-from ..models import CreateAPIKeyRequest, CreateAPIKeyResponse
+from fastapi import APIRouter, HTTPException, Header
+from ..models import CreateAPIKeyRequest, CreateAPIKeyResponse, RevokeAPIKeyResponse
+from ..concurrency import OverloadedError
 from ..database import db
+from ..metrics import TimedRoute
 
-router = APIRouter(tags=["auth"])
+router = APIRouter(tags=["auth"], route_class=TimedRoute)
 
 
 @router.post("/auth/create-key", response_model=CreateAPIKeyResponse)
@@ -10,15 +12,32 @@ async def create_api_key(request: CreateAPIKeyRequest):
     """Create a new API key for a user. Creates user if they don't exist."""
     try:
         # Get or create user
-        user = db.get_or_create_user(request.email)
+        user = await db.aget_or_create_user(request.email)
         
         # Create API key
-        api_key, _ = db.create_api_key(user["id"])
+        api_key, _ = await db.acreate_api_key(user["id"])
         
         return CreateAPIKeyResponse(
             api_key=api_key,
             user_id=user["id"]
         )
+    except OverloadedError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create API key: {str(e)}")
 
+
+@router.post("/auth/revoke-key", response_model=RevokeAPIKeyResponse)
+async def revoke_api_key(x_api_key: str = Header(..., alias="X-API-Key")):
+    """Revoke the API key sent in the X-API-Key header."""
+    try:
+        revoked = await db.arevoke_api_key(x_api_key)
+    except OverloadedError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to revoke API key: {str(e)}")
+    
+    if not revoked:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    
+    return RevokeAPIKeyResponse(revoked=True)
@@ -1,9 +1,20 @@
-from fastapi import APIRouter, Depends
-from ..models import ContextRetrieveRequest, ContextRetrieveResponse
-from ..auth import get_user_id
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from ..models import (
+    ContextRetrieveRequest, ContextRetrieveResponse, ContextBatchItem, ContextBatchResult,
+    ContextRetrieveBatchRequest, ContextRetrieveBatchResponse
+)
+from ..auth import check_rate_limit, get_user_id
+from ..config import settings
+from ..context_assembly import chunk_key
 from ..gemini_service import gemini_service
+from ..concurrency import OverloadedError
+from ..metrics import TimedRoute, mark_degraded
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+import orjson
 
-router = APIRouter(tags=["context"])
+router = APIRouter(tags=["context"], route_class=TimedRoute)
 
 
 @router.post("/context/retrieve", response_model=ContextRetrieveResponse)
@@ -13,22 +24,166 @@ async def retrieve_context(
 ):
     """Retrieve relevant context for a prompt using Gemini File Search."""
     try:
-        result = gemini_service.retrieve_context(
+        result = await gemini_service.aretrieve_context(
             user_id=user_id,
             prompt=request.prompt,
-            model=request.model
+            model=request.model,
+            system_prompt=request.system_prompt,
+            max_context_tokens=request.max_context_tokens,
+            mode=request.mode
         )
         
         return ContextRetrieveResponse(
             enhanced_context=result["enhanced_context"],
             relevant_traces=result["relevant_traces"],
-            suggestions=result["suggestions"]
+            suggestions=result["suggestions"],
+            context=result.get("context", {})
         )
+    except OverloadedError:
+        raise
     except Exception as e:
-        # Return empty context on error
+        # Return empty context on error, but count it so failures show up in /metrics
+        mark_degraded("context_error")
         return ContextRetrieveResponse(
             enhanced_context=request.prompt,
             relevant_traces=[],
             suggestions={"error": str(e)}
         )
 
+
+def _share_chunks(results: List[ContextBatchResult]) -> Dict[str, Dict[str, Any]]:
+    """Move the items' chunks into one table, leaving references with each item's relevance scores.
+    
+    Chunks with the same text (ignoring case and whitespace) are stored once.
+    """
+    chunks: Dict[str, Dict[str, Any]] = {}
+    for result in results:
+        refs = []
+        for trace in result.relevant_traces:
+            chunk = {k: v for k, v in trace.items() if k != "relevance_score"}
+            chunk_id = chunk_key(chunk)[:16]
+            chunks.setdefault(chunk_id, chunk)
+            refs.append({"chunk_id": chunk_id, "relevance_score": trace.get("relevance_score")})
+        result.relevant_traces = refs
+    return chunks
+
+
+@router.post("/context/retrieve-batch", response_model=ContextRetrieveBatchResponse)
+async def retrieve_context_batch(
+    request: ContextRetrieveBatchRequest,
+    user_id: str = Depends(get_user_id),
+    x_api_key: str = Header(..., alias="X-API-Key")
+):
+    """Retrieve context for several prompts in one request.
+    
+    Authenticated once, but every item counts against the rate limits. Items
+    are retrieved concurrently, at most `context_batch_concurrency` at a time,
+    and one that fails carries its own `error` instead of failing the batch.
+    With `dedupe`, chunks retrieved for several items are returned once, in
+    `chunks`, and each item's `relevant_traces` refer to them by `chunk_id`.
+    """
+    if len(request.items) > settings.context_batch_max_items:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {settings.context_batch_max_items} items per batch"
+        )
+    # The first item was counted when the key was verified
+    await check_rate_limit(x_api_key, user_id, cost=len(request.items) - 1)
+    
+    semaphore = asyncio.Semaphore(settings.context_batch_concurrency)
+    
+    async def retrieve(item: ContextBatchItem) -> Dict[str, Any]:
+        async with semaphore:
+            return await gemini_service.aretrieve_context(
+                user_id=user_id,
+                prompt=item.prompt,
+                model=request.model,
+                system_prompt=item.system_prompt,
+                max_context_tokens=item.max_context_tokens,
+                mode=item.mode
+            )
+    
+    outcomes = await asyncio.gather(*(retrieve(item) for item in request.items), return_exceptions=True)
+    
+    results = []
+    shed = []
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, OverloadedError):
+            shed.append(outcome)
+            results.append(ContextBatchResult(index=index, error=str(outcome), retry_after=outcome.retry_after))
+        elif isinstance(outcome, Exception):
+            mark_degraded("context_error")
+            results.append(ContextBatchResult(index=index, error=str(outcome) or type(outcome).__name__))
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
+            results.append(ContextBatchResult(
+                index=index,
+                enhanced_context=outcome["enhanced_context"],
+                relevant_traces=outcome["relevant_traces"],
+                suggestions=outcome["suggestions"],
+                context=outcome.get("context", {})
+            ))
+    if len(shed) == len(results):
+        # Nothing was served; a 503 lets the client back off and retry the whole batch
+        raise shed[0]
+    
+    chunks = _share_chunks(results) if request.dedupe else {}
+    return ContextRetrieveBatchResponse(results=results, chunks=chunks)
+
+
+def _encode_event(event: Dict[str, Any], ndjson: bool) -> bytes:
+    if ndjson:
+        return orjson.dumps({"event": event["event"], **event["data"]}) + b"\n"
+    return b"event: " + event["event"].encode() + b"\ndata: " + orjson.dumps(event["data"]) + b"\n\n"
+
+
+async def _encode_events(first: Dict[str, Any], events: AsyncIterator[Dict[str, Any]], ndjson: bool) -> AsyncIterator[bytes]:
+    """Encode context events as Server-Sent Events or as NDJSON lines."""
+    yield _encode_event(first, ndjson)
+    try:
+        async for event in events:
+            yield _encode_event(event, ndjson)
+    except Exception as e:
+        # Headers are already sent, so report the failure in the stream
+        mark_degraded("context_error")
+        error = {"error": str(e) or type(e).__name__}
+        if ndjson:
+            yield orjson.dumps({"event": "error", **error}) + b"\n"
+        else:
+            yield b"event: error\ndata: " + orjson.dumps(error) + b"\n\n"
+
+
+@router.post("/context/retrieve-stream")
+async def retrieve_context_stream(
+    request: ContextRetrieveRequest,
+    http_request: Request,
+    format: Optional[str] = Query(default=None, pattern="^(sse|ndjson)$"),
+    user_id: str = Depends(get_user_id)
+):
+    """Stream retrieved traces, then the context as it is generated.
+    
+    Events: "traces" (relevant_traces, suggestions, context), "delta" (text),
+    then "done" (enhanced_context, context) or "error". Sent as Server-Sent
+    Events, or as NDJSON with `format=ndjson` or `Accept: application/x-ndjson`.
+    """
+    ndjson = format == "ndjson" or (
+        format is None and "application/x-ndjson" in http_request.headers.get("accept", "")
+    )
+    events = gemini_service.astream_context(
+        user_id=user_id,
+        prompt=request.prompt,
+        model=request.model,
+        system_prompt=request.system_prompt,
+        max_context_tokens=request.max_context_tokens,
+        mode=request.mode
+    )
+    # Wait for the first event before responding, so that a request shed
+    # during retrieval gets a 503 rather than a stream
+    first = await anext(events)
+    return StreamingResponse(
+        _encode_events(first, events, ndjson),
+        media_type="application/x-ndjson" if ndjson else "text/event-stream",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,51 +1,278 @@
-from fastapi import APIRouter, Depends
-from ..models import TraceStoreRequest, TraceStoreResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from ..models import (
+    TraceStoreRequest, TraceStoreResponse, TraceStoreBatchRequest, TraceStoreBatchResponse, TraceStatusResponse,
+    TraceStatsResponse, TraceRecord, TraceListResponse
+)
 from ..auth import get_user_id
-from ..gemini_service import gemini_service
+from ..config import settings
+from ..concurrency import OverloadedError
 from ..database import db
+from ..metrics import TimedRoute
+from ..trace_queue import trace_queue, awrite_trace, awrite_traces, new_trace_id, QueueFullError
+from ..wire import dumps_json
+from ..trace_stats import MAX_HOURLY_WINDOW, default_granularity, parse_window, summarize, window_start
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, Any, List, Literal, Optional, Tuple
+import base64
+import orjson
 import uuid
+import zlib
 
-router = APIRouter(tags=["traces"])
+router = APIRouter(tags=["traces"], route_class=TimedRoute)
+
+
+def _trace_data(request: TraceStoreRequest) -> Dict[str, Any]:
+    """Build the document stored in Gemini File Search for a trace."""
+    return {
+        "input": request.input.dict(),
+        "output": request.output.dict(),
+        "metadata": request.metadata.dict()
+    }
+
+
+def _trace_metadata(request: TraceStoreRequest, trace_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the trace_metadata row stored in Supabase for a trace."""
+    return {
+        "provider": request.metadata.provider,
+        "model": request.metadata.model,
+        "success": request.metadata.success,
+        "tokens_used": request.output.tokens_used,
+        "latency_ms": request.metadata.latency_ms,
+        # Counts against the retention size budget
+        "size_bytes": len(dumps_json(trace_data))
+    }
+
+
+def _queue_full() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Trace queue is full, retry later",
+        headers={"Retry-After": "1"}
+    )
 
 
 @router.post("/traces/store", response_model=TraceStoreResponse)
 async def store_trace(
     request: TraceStoreRequest,
+    response: Response,
     user_id: str = Depends(get_user_id)
 ):
     """Store a trace in Gemini File Search and Supabase."""
-    try:
-        # Prepare trace data
-        trace_data = {
-            "input": request.input.dict(),
-            "output": request.output.dict(),
-            "metadata": request.metadata.dict()
-        }
-        
-        # Store in Gemini File Search
-        trace_id = gemini_service.store_trace(user_id, trace_data)
+    # Prepare trace data
+    trace_data = _trace_data(request)
+    metadata = _trace_metadata(request, trace_data)
+    # Content-derived, so that storing the same trace again is counted rather than uploaded
+    trace_id = new_trace_id(user_id, trace_data)
+    
+    if settings.trace_write_behind:
+        # Persist locally and let the background workers write it upstream
+        try:
+            await run_in_threadpool(trace_queue.put, user_id, trace_id, trace_data, metadata)
+        except QueueFullError:
+            raise _queue_full()
         
-        # Store metadata in Supabase
-        db.store_trace_metadata(
-            user_id=user_id,
+        response.status_code = 202
+        return TraceStoreResponse(
             trace_id=trace_id,
-            metadata={
-                "provider": request.metadata.provider,
-                "model": request.metadata.model,
-                "success": request.metadata.success,
-                "tokens_used": request.output.tokens_used,
-                "latency_ms": request.metadata.latency_ms
-            }
+            stored=True,
+            status="queued"
         )
+    
+    try:
+        # Store in Gemini File Search and metadata in Supabase
+        trace_id = await awrite_trace(user_id, trace_id, trace_data, metadata)
         
         return TraceStoreResponse(
             trace_id=trace_id,
             stored=True
         )
+    except OverloadedError:
+        raise
     except Exception as e:
         # Return error response
         return TraceStoreResponse(
-            trace_id=str(uuid.uuid4()),
-            stored=False
+            trace_id=trace_id,
+            stored=False,
+            status="failed"
+        )
+
+
+@router.post("/traces/store-batch", response_model=TraceStoreBatchResponse)
+async def store_traces(
+    request: TraceStoreBatchRequest,
+    response: Response,
+    user_id: str = Depends(get_user_id)
+):
+    """Store many traces at once, packed into a few File Search documents and one metadata insert."""
+    if len(request.traces) > settings.trace_batch_max_items:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {settings.trace_batch_max_items} traces per batch"
+        )
+    
+    traces = [_trace_data(trace) for trace in request.traces]
+    trace_ids = [new_trace_id(user_id, trace_data) for trace_data in traces]
+    metadata = [_trace_metadata(trace, trace_data) for trace, trace_data in zip(request.traces, traces)]
+    
+    if settings.trace_write_behind:
+        try:
+            await run_in_threadpool(trace_queue.put_many, user_id, trace_ids, traces, metadata)
+        except QueueFullError:
+            raise _queue_full()
+        
+        response.status_code = 202
+        return TraceStoreBatchResponse(
+            trace_ids=trace_ids,
+            stored=True,
+            status="queued"
+        )
+    
+    try:
+        trace_ids = await awrite_traces(user_id, trace_ids, traces, metadata)
+        
+        return TraceStoreBatchResponse(
+            trace_ids=trace_ids,
+            stored=True
+        )
+    except OverloadedError:
+        raise
+    except Exception as e:
+        return TraceStoreBatchResponse(
+            trace_ids=trace_ids,
+            stored=False,
+            status="failed"
         )
 
+
+@router.get("/traces/stats", response_model=TraceStatsResponse)
+async def get_trace_stats(
+    window: str = Query(default="24h", pattern=r"^[1-9][0-9]{0,3}[hd]$"),
+    granularity: Optional[Literal["hour", "day"]] = None,
+    group_by: Literal["model", "provider"] = "model",
+    user_id: str = Depends(get_user_id)
+):
+    """Success rate, token totals and latency percentiles of the user's traces over a window.
+    
+    Served from the hourly or daily rollup tables, not from raw trace rows.
+    """
+    period = parse_window(window)
+    granularity = granularity or default_granularity(period)
+    if granularity == "hour" and period > MAX_HOURLY_WINDOW:
+        raise HTTPException(status_code=400, detail="Hourly stats cover at most 31 days; use granularity=day")
+    
+    # Rollup buckets are in UTC, without a time zone
+    end = datetime.now(timezone.utc).replace(tzinfo=None)
+    start = window_start(end, period, granularity)
+    rows = await db.aget_trace_stats(user_id, granularity, start.isoformat())
+    
+    return TraceStatsResponse(
+        start=start,
+        end=end,
+        granularity=granularity,
+        group_by=group_by,
+        **summarize(rows, group_by)
+    )
+
+
+def _encode_cursor(row: Dict[str, Any]) -> str:
+    """An opaque cursor for the page after `row`: its position in the (created_at, id) order."""
+    return base64.urlsafe_b64encode(orjson.dumps([row["created_at"], row["id"]])).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[Tuple[Optional[str], str]]:
+    """The (created_at, id) a cursor points after; created_at is None for a trace without one."""
+    if cursor is None:
+        return None
+    try:
+        created_at, row_id = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if created_at is not None:
+            datetime.fromisoformat(created_at)
+        row_id = str(uuid.UUID(row_id))
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, row_id
+
+
+_TRACE_FIELDS = tuple(TraceRecord.model_fields)
+
+
+def _record(row: Dict[str, Any]) -> Dict[str, Any]:
+    """The exported fields of a trace_metadata row."""
+    return {field: row.get(field) for field in _TRACE_FIELDS}
+
+
+@router.get("/traces", response_model=TraceListResponse)
+async def list_traces(
+    limit: int = Query(default=100, ge=1),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(get_user_id)
+):
+    """List the user's traces, newest first, a page at a time.
+    
+    Pages are keyed on the last trace of the previous one rather than an
+    offset, so reading deep into a long history costs no more than the first
+    page, and traces stored meanwhile do not shift the pages.
+    """
+    limit = min(limit, settings.trace_list_max_limit)
+    # One more than asked for tells whether there is a next page
+    rows = await db.alist_traces(user_id, _decode_cursor(cursor), limit + 1)
+    page = rows[:limit]
+    
+    return TraceListResponse(
+        traces=page,
+        next_cursor=_encode_cursor(page[-1]) if len(rows) > limit else None
+    )
+
+
+async def _export_lines(user_id: str, rows: List[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Compress the user's traces as gzip NDJSON, starting from the first page, `rows`.
+    
+    Holds one page in memory at a time. If a page fails, the stream ends
+    without the gzip trailer, which the client sees as a truncated file.
+    """
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    while True:
+        if rows:
+            compressed = compressor.compress(b"".join(orjson.dumps(_record(row)) + b"\n" for row in rows))
+            if compressed:
+                yield compressed
+        if len(rows) < settings.trace_export_page_size:
+            break
+        rows = await db.alist_traces(user_id, (rows[-1]["created_at"], rows[-1]["id"]), settings.trace_export_page_size)
+    yield compressor.flush()
+
+
+@router.get("/traces/export")
+async def export_traces(user_id: str = Depends(get_user_id)):
+    """Stream all of the user's traces, newest first, as a gzip-compressed NDJSON file."""
+    # Fetch the first page before responding, so that an upstream failure gets an error status
+    rows = await db.alist_traces(user_id, None, settings.trace_export_page_size)
+    return StreamingResponse(
+        _export_lines(user_id, rows),
+        media_type="application/gzip",
+        headers={"Content-Disposition": 'attachment; filename="traces.ndjson.gz"'}
+    )
+
+
+@router.get("/traces/{trace_id}/status", response_model=TraceStatusResponse)
+async def get_trace_status(
+    trace_id: str,
+    user_id: str = Depends(get_user_id)
+):
+    """Report whether a trace is queued, pending indexing, indexed or failed."""
+    # Traces still in the write-behind queue have no metadata row yet
+    queued_status = await run_in_threadpool(trace_queue.status, user_id, trace_id)
+    if queued_status:
+        return TraceStatusResponse(trace_id=trace_id, status=queued_status)
+    
+    row = await db.aget_trace_status(user_id, trace_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    
+    return TraceStatusResponse(
+        trace_id=trace_id,
+        status=row["status"],
+        created_at=row.get("created_at")
+    )
@@ -0,0 +1,64 @@
+"""Run the API under uvicorn, one worker process per available CPU.
+
+    python -m src.api.serve
+
+`WEB_CONCURRENCY` sets the number of workers instead. With more than one,
+the caches default to the memory-mapped backend (`CACHE_BACKEND=mmap`), so
+that the workers share API key lookups, user stores and retrieval results.
+"""
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> int:
+    """CPUs this process may run on, capped by its cgroup's CPU quota if it has one."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def worker_count() -> int:
+    return int(os.environ.get("WEB_CONCURRENCY") or available_cpus())
+
+
+def main(app: str = "src.api.main:app"):
+    logging.basicConfig(level=logging.INFO)
+    workers = worker_count()
+
+    from .config import settings
+
+    if workers > 1:
+        if settings.retrieval_backend == "local":
+            logger.warning("The local vector index cannot be shared between processes; running one worker")
+            workers = 1
+        elif settings.rate_limit_enabled and settings.rate_limit_backend == "memory":
+            logger.warning("Rate limits are counted per worker; set RATE_LIMIT_BACKEND=redis to share them")
+    if workers > 1 and "cache_backend" not in settings.model_fields_set:
+        # Inherited by the workers, which read their settings afresh
+        os.environ["CACHE_BACKEND"] = "mmap"
+
+    import uvicorn
+
+    logger.info("Starting %d worker(s)", workers)
+    uvicorn.run(
+        app,
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        workers=workers
+    )
+
+
+if __name__ == "__main__":
+    main()
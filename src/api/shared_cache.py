@@ -0,0 +1,333 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import orjson
+
+from .cache import MISSING, TTLCache
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"CTXCACHE"
+_VERSION = 1
+# magic, version, buckets, ways, slot size
+_FILE_HEADER = struct.Struct("<8sIIII")
+_HEADER_SIZE = 64
+# key digest, expiry (wall clock; 0 for an empty slot), value length
+_SLOT_HEADER = struct.Struct("<16sdI")
+_EMPTY_DIGEST = bytes(16)
+# Thread locks per cache; buckets share them by index
+_THREAD_LOCKS = 64
+
+
+def _free_bytes(directory: str) -> int:
+    """Free space in `directory`, less what the sparse cache files already in it may still take."""
+    stat = os.statvfs(directory)
+    free = stat.f_bavail * stat.f_frsize
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".cache"):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            free -= max(0, st.st_size - st.st_blocks * 512)
+    return free
+
+
+class MmapCache:
+    """A cache in a memory-mapped file, shared by every process on the host that maps it.
+
+    The file is a set-associative table: a key hashes to a bucket of `ways`
+    fixed-size slots, and a full bucket evicts the entry nearest to expiry.
+    Buckets are locked with fcntl record locks between processes, and with
+    thread locks within one. Values are stored as JSON; one that does not fit
+    in a slot is not cached. Entries expire by wall clock, which all the
+    processes share.
+
+    The layout is part of the file name, so that processes configured
+    differently never share a file. The file is sparse, but a write to a
+    page that no longer fits on its filesystem kills the process with
+    SIGBUS (tmpfs such as /dev/shm is often small in containers), so a file
+    that might not fit in `directory` goes in the temp dir instead.
+    """
+
+    def __init__(self, directory: str, name: str, max_size: int, ttl: float, slot_size: int = 1024, ways: int = 8):
+        self.ttl = ttl
+        self.ways = ways
+        self.slot_size = slot_size
+        self.buckets = max(1, -(-max_size // ways))
+        self.path = os.path.join(directory, f"{name}-v{_VERSION}-{self.buckets}x{ways}x{slot_size}.cache")
+        self.size = _HEADER_SIZE + self.buckets * ways * slot_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.oversized = 0
+        self._fd: Optional[int] = None
+        self._mm: Optional[mmap.mmap] = None
+        self._open_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(_THREAD_LOCKS)]
+
+    def _map(self) -> mmap.mmap:
+        """Map the file on first use, laying it out if this process is the first to open it."""
+        if self._mm is None:
+            with self._open_lock:
+                if self._mm is None:
+                    self.path = self._placed_path()
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    size = self.size
+                    header = _FILE_HEADER.pack(_MAGIC, _VERSION, self.buckets, self.ways, self.slot_size)
+                    fcntl.lockf(fd, fcntl.LOCK_EX)
+                    try:
+                        if os.pread(fd, _FILE_HEADER.size, 0) != header:
+                            # Sparse: pages are only allocated once written
+                            os.ftruncate(fd, size)
+                            os.pwrite(fd, header, 0)
+                    finally:
+                        fcntl.lockf(fd, fcntl.LOCK_UN)
+                    self._fd = fd
+                    self._mm = mmap.mmap(fd, size)
+        return self._mm
+
+    def _placed_path(self) -> str:
+        """Where to map the file: where another process already has, else `directory` if it fits there."""
+        fallback = os.path.join(tempfile.gettempdir(), "context-api", os.path.basename(self.path))
+        for path in (self.path, fallback):
+            if os.path.exists(path):
+                return path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if fallback == self.path or _free_bytes(os.path.dirname(self.path)) >= self.size:
+            return self.path
+        logger.warning(
+            "%s has no room for a %d MiB cache file; using %s. Give it more space or set CACHE_MMAP_DIR",
+            os.path.dirname(self.path), self.size >> 20, fallback
+        )
+        os.makedirs(os.path.dirname(fallback), exist_ok=True)
+        return fallback
+
+    def _locate(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        return digest, int.from_bytes(digest[:8], "little") % self.buckets
+
+    def _slots(self, bucket: int) -> range:
+        start = _HEADER_SIZE + bucket * self.ways * self.slot_size
+        return range(start, start + self.ways * self.slot_size, self.slot_size)
+
+    @contextmanager
+    def _bucket_lock(self, bucket: int, mode: int) -> Iterator[mmap.mmap]:
+        mm = self._map()
+        length = self.ways * self.slot_size
+        start = _HEADER_SIZE + bucket * length
+        with self._locks[bucket % _THREAD_LOCKS]:
+            fcntl.lockf(self._fd, mode, length, start)
+            try:
+                yield mm
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def get(self, key: str, default: Any = MISSING) -> Any:
+        """Return the cached value for `key`, or `default` if it is absent or expired."""
+        digest, bucket = self._locate(key)
+        now = time.time()
+        data = None
+        with self._bucket_lock(bucket, fcntl.LOCK_SH) as mm:
+            for offset in self._slots(bucket):
+                slot_digest, expires_at, length = _SLOT_HEADER.unpack_from(mm, offset)
+                if slot_digest == digest:
+                    if expires_at > now:
+                        data = mm[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + length]
+                    break
+        if data is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return orjson.loads(data)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Cache `value` for `ttl` seconds (the cache default if not given)."""
+        data = orjson.dumps(value)
+        if _SLOT_HEADER.size + len(data) > self.slot_size:
+            # Too large to share; an older value must not outlive it
+            self.oversized += 1
+            self.delete(key)
+            return
+
+        digest, bucket = self._locate(key)
+        with self._bucket_lock(bucket, fcntl.LOCK_EX) as mm:
+            now = time.time()
+            target, free, oldest = None, None, None
+            for offset in self._slots(bucket):
+                slot_digest, expires_at, _ = _SLOT_HEADER.unpack_from(mm, offset)
+                if slot_digest == digest:
+                    target = offset
+                    break
+                if expires_at <= now:
+                    if free is None:
+                        free = offset
+                elif oldest is None or expires_at < oldest[0]:
+                    oldest = (expires_at, offset)
+            if target is None:
+                if free is not None:
+                    target = free
+                else:
+                    target = oldest[1]
+                    self.evictions += 1
+            mm[target + _SLOT_HEADER.size:target + _SLOT_HEADER.size + len(data)] = data
+            _SLOT_HEADER.pack_into(mm, target, digest, now + (self.ttl if ttl is None else ttl), len(data))
+
+    def delete(self, key: str):
+        """Drop `key` from the cache if present."""
+        digest, bucket = self._locate(key)
+        with self._bucket_lock(bucket, fcntl.LOCK_EX) as mm:
+            for offset in self._slots(bucket):
+                if _SLOT_HEADER.unpack_from(mm, offset)[0] == digest:
+                    _SLOT_HEADER.pack_into(mm, offset, _EMPTY_DIGEST, 0.0, 0)
+                    break
+
+    async def aget(self, key: str, default: Any = MISSING) -> Any:
+        return self.get(key, default)
+
+    async def aset(self, key: str, value: Any, ttl: Optional[float] = None):
+        self.set(key, value, ttl)
+
+    async def adelete(self, key: str):
+        self.delete(key)
+
+    def clear(self):
+        """Drop every entry, for every process."""
+        for bucket in range(self.buckets):
+            with self._bucket_lock(bucket, fcntl.LOCK_EX) as mm:
+                for offset in self._slots(bucket):
+                    _SLOT_HEADER.pack_into(mm, offset, _EMPTY_DIGEST, 0.0, 0)
+
+    def __len__(self) -> int:
+        """Unexpired entries, counted without locking."""
+        mm = self._map()
+        now = time.time()
+        slot = struct.Struct(f"<16sd{self.slot_size - 24}x")
+        return sum(1 for _, expires_at in slot.iter_unpack(memoryview(mm)[_HEADER_SIZE:]) if expires_at > now)
+
+    def stats(self) -> Dict[str, int]:
+        """Return this process's hit/miss/eviction counters and the shared size."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "oversized": self.oversized,
+            "size": len(self),
+        }
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            os.close(self._fd)
+            self._mm = None
+
+
+class RedisCache:
+    """A cache in Redis, shared by every worker and instance pointed at it.
+
+    If Redis cannot be reached, lookups miss and writes are dropped, so an
+    outage costs upstream calls rather than failed requests.
+    """
+
+    def __init__(self, url: str, prefix: str, ttl: float):
+        # Only needed with this backend
+        import redis
+        import redis.asyncio
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url, socket_timeout=settings.cache_redis_timeout)
+        self.async_client = redis.asyncio.from_url(url, socket_timeout=settings.cache_redis_timeout)
+        self.hits = 0
+        self.misses = 0
+
+    def _found(self, data: Optional[bytes], default: Any) -> Any:
+        if data is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return orjson.loads(data)
+
+    def _px(self, ttl: Optional[float]) -> int:
+        return max(1, int((self.ttl if ttl is None else ttl) * 1000))
+
+    def get(self, key: str, default: Any = MISSING) -> Any:
+        """Return the cached value for `key`, or `default` if it is absent or Redis is unavailable."""
+        try:
+            data = self.client.get(self.prefix + key)
+        except Exception:
+            logger.warning("Cache backend unavailable, treating lookup as a miss", exc_info=True)
+            data = None
+        return self._found(data, default)
+
+    async def aget(self, key: str, default: Any = MISSING) -> Any:
+        try:
+            data = await self.async_client.get(self.prefix + key)
+        except Exception:
+            logger.warning("Cache backend unavailable, treating lookup as a miss", exc_info=True)
+            data = None
+        return self._found(data, default)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Cache `value` for `ttl` seconds (the cache default if not given)."""
+        try:
+            self.client.set(self.prefix + key, orjson.dumps(value), px=self._px(ttl))
+        except Exception:
+            logger.warning("Cache backend unavailable, not caching", exc_info=True)
+
+    async def aset(self, key: str, value: Any, ttl: Optional[float] = None):
+        try:
+            await self.async_client.set(self.prefix + key, orjson.dumps(value), px=self._px(ttl))
+        except Exception:
+            logger.warning("Cache backend unavailable, not caching", exc_info=True)
+
+    def delete(self, key: str):
+        """Drop `key` from the cache."""
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception:
+            # The entry now lives out its TTL, e.g. a revoked key stays valid that long
+            logger.error("Cache backend unavailable, could not drop %s", key, exc_info=True)
+
+    async def adelete(self, key: str):
+        try:
+            await self.async_client.delete(self.prefix + key)
+        except Exception:
+            logger.error("Cache backend unavailable, could not drop %s", key, exc_info=True)
+
+    def stats(self) -> Dict[str, int]:
+        """Return this process's hit/miss counters; Redis does its own eviction."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def cache_dir() -> str:
+    """Directory for memory-mapped caches: `settings.cache_mmap_dir`, else shared memory if the host has it."""
+    if settings.cache_mmap_dir:
+        return settings.cache_mmap_dir
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/context-api"
+    return os.path.join(tempfile.gettempdir(), "context-api")
+
+
+def make_cache(name: str, max_size: int, ttl: float, slot_size: int = 1024):
+    """Build the cache `name` on the backend set by `settings.cache_backend`.
+
+    "memory" (the default) is private to the process; "mmap" is shared by the
+    workers on one host and "redis" by every instance. `slot_size` bounds the
+    serialized size of an entry in the mmap backend.
+    """
+    if settings.cache_backend == "mmap":
+        return MmapCache(cache_dir(), name, max_size, ttl, slot_size)
+    if settings.cache_backend == "redis":
+        return RedisCache(settings.cache_redis_url, f"{settings.cache_redis_prefix}{name}:", ttl)
+    return TTLCache(max_size=max_size, ttl=ttl)
@@ -0,0 +1,63 @@
+import asyncio
+import copy
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class SingleFlight:
+    """Coalesces concurrent identical async calls into one.
+
+    While a call for a key is in flight, later callers with the same key wait
+    for it and share its result (or exception) instead of starting their own.
+    The shared call runs as its own task, so a caller that is cancelled (e.g.
+    on client disconnect) does not cancel it for the others. When a result was
+    shared, every caller gets its own deep copy, since callers mutate results.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # key -> [task, number of callers that joined it]
+        self._inflight: Dict[Hashable, List[Any]] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception retrieved even if every caller was cancelled
+            task.exception()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the result of `fn()`, sharing an in-flight call for the same key."""
+        entry = self._inflight.get(key)
+        # A finished call may linger until its done callback runs; never join it
+        if entry is None or entry[0].done():
+            task = asyncio.ensure_future(fn())
+            entry = [task, 0]
+            self._inflight[key] = entry
+            task.add_done_callback(lambda task: self._done(key, task))
+            self.calls += 1
+            leader = True
+        else:
+            entry[1] += 1
+            self.shared += 1
+            leader = False
+
+        result = await asyncio.shield(entry[0])
+        if leader and entry[1] == 0:
+            return result
+        return copy.deepcopy(result)
+
+    def stats(self) -> Dict[str, float]:
+        """Return upstream calls made, calls shared and the fraction of requests deduplicated."""
+        total = self.calls + self.shared
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "dedup_ratio": self.shared / total if total else 0.0,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,418 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Any, List, Optional
+
+from .config import settings
+from .database import db
+from .gemini_service import gemini_service
+from .metrics import TRACE_QUEUE_FAILED, TRACES_DEDUPLICATED
+from .wire import dumps_json
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the trace queue is at capacity."""
+
+
+def _normalized(value: Any) -> Any:
+    """Drop unset fields and surrounding whitespace, which do not change what a trace says."""
+    if isinstance(value, dict):
+        return {key: _normalized(item) for key, item in value.items() if item is not None}
+    if isinstance(value, list):
+        return [_normalized(item) for item in value]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def content_trace_id(user_id: str, trace_data: Dict[str, Any]) -> str:
+    """A trace_id derived from the user and the trace's normalized input and output.
+    
+    Storing the same trace again (a retrying client, a deterministic agent
+    loop) yields the same trace_id, which record_traces counts as a repeat.
+    Metadata such as latency is not part of a trace's identity. The id is a
+    version 8 (custom) UUID holding the first bits of a SHA-256 digest.
+    """
+    content = dumps_json(
+        {"user_id": user_id, "input": _normalized(trace_data.get("input")), "output": _normalized(trace_data.get("output"))},
+        sort_keys=True
+    )
+    value = int.from_bytes(hashlib.sha256(content).digest()[:16], "big")
+    # uuid.UUID only sets the version and variant bits for versions 1 to 5
+    value = (value & ~(0xF << 76) & ~(0x3 << 62)) | (0x8 << 76) | (0x2 << 62)
+    return str(uuid.UUID(int=value))
+
+
+def new_trace_id(user_id: str, trace_data: Dict[str, Any]) -> str:
+    """The trace_id for a trace to store: content-derived with `trace_dedup`, else random."""
+    if settings.trace_dedup:
+        return content_trace_id(user_id, trace_data)
+    return str(uuid.uuid4())
+
+
+def record_indexing(trace_ids: List[str], error: Optional[BaseException], document_name: Optional[str] = None):
+    """Record the outcome of indexing uploaded traces in trace_metadata."""
+    db.update_trace_status(trace_ids, "failed" if error else "indexed", document_name)
+
+
+def _to_upload(trace_ids: List[str], traces: List[Dict[str, Any]], upload_ids: List[str]):
+    """The traces among a batch to upload, each once. Returns (trace_ids, traces)."""
+    pending = set(upload_ids)
+    ids, data = [], []
+    for trace_id, trace_data in zip(trace_ids, traces):
+        if trace_id in pending:
+            pending.discard(trace_id)
+            ids.append(trace_id)
+            data.append(trace_data)
+    TRACES_DEDUPLICATED.inc(len(trace_ids) - len(ids))
+    return ids, data
+
+
+# Metadata rows are written as pending before the upload, so that the indexing
+# callback always finds them; a failed upload marks them failed and re-raises.
+# Repeats of stored traces are only counted, and not uploaded again.
+
+def write_trace(user_id: str, trace_id: str, trace_data: Dict[str, Any], metadata: Dict[str, Any]) -> str:
+    """Write a trace's metadata to Supabase and the trace to Gemini File Search."""
+    if not db.record_traces(user_id, [(trace_id, metadata)]):
+        TRACES_DEDUPLICATED.inc()
+        return trace_id
+    try:
+        return gemini_service.store_trace(user_id, trace_data, trace_id=trace_id, on_indexed=record_indexing)
+    except Exception:
+        db.update_trace_status([trace_id], "failed")
+        raise
+
+
+def write_traces(user_id: str, trace_ids: List[str], traces: List[Dict[str, Any]], metadata: List[Dict[str, Any]]) -> List[str]:
+    """Write a batch of one user's traces as a single bulk metadata call plus packed documents."""
+    upload_ids, upload = _to_upload(trace_ids, traces, db.record_traces(user_id, list(zip(trace_ids, metadata))))
+    if upload:
+        try:
+            gemini_service.store_traces(user_id, upload, trace_ids=upload_ids, on_indexed=record_indexing)
+        except Exception:
+            db.update_trace_status(upload_ids, "failed")
+            raise
+    return trace_ids
+
+
+async def awrite_trace(user_id: str, trace_id: str, trace_data: Dict[str, Any], metadata: Dict[str, Any]) -> str:
+    """Write a trace's metadata to Supabase and the trace to Gemini File Search."""
+    if not await db.arecord_traces(user_id, [(trace_id, metadata)]):
+        TRACES_DEDUPLICATED.inc()
+        return trace_id
+    try:
+        return await gemini_service.astore_trace(user_id, trace_data, trace_id=trace_id, on_indexed=record_indexing)
+    except Exception:
+        await db.aupdate_trace_status([trace_id], "failed")
+        raise
+
+
+async def awrite_traces(user_id: str, trace_ids: List[str], traces: List[Dict[str, Any]], metadata: List[Dict[str, Any]]) -> List[str]:
+    """Write a batch of one user's traces as a single bulk metadata call plus packed documents."""
+    upload_ids, upload = _to_upload(trace_ids, traces, await db.arecord_traces(user_id, list(zip(trace_ids, metadata))))
+    if upload:
+        try:
+            await gemini_service.astore_traces(user_id, upload, trace_ids=upload_ids, on_indexed=record_indexing)
+        except Exception:
+            await db.aupdate_trace_status(upload_ids, "failed")
+            raise
+    return trace_ids
+
+
+# Items a worker may lease: queued and due, or leased by a worker that has not finished in time
+_READY = "(status = 'queued' AND available_at <= ?) OR (status = 'inflight' AND leased_until <= ?)"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TraceQueue:
+    """Bounded, SQLite-backed queue drained to Gemini and Supabase by worker threads.
+
+    Several worker processes may share the queue file; each leases items in
+    its own write transaction. A lease lasts `lease_seconds`, after which the
+    item is handed out again, so items held by a process that died are
+    written even if its PID has been reused. Items that run out of attempts
+    are parked as failed, and deleted by the workers `failed_retention_seconds`
+    later.
+    """
+
+    def __init__(self, path: str, max_size: int, max_attempts: int, lease_seconds: float = 300.0,
+                 failed_retention_seconds: float = 7 * 86400):
+        self.path = path
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.failed_retention_seconds = failed_retention_seconds
+        self._next_purge = 0.0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._workers: List[threading.Thread] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the queue database on first use. Caller must hold the lock."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS trace_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    trace_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    last_error TEXT
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_trace_queue_ready ON trace_queue(status, available_at)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_trace_queue_trace_id ON trace_queue(trace_id)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(trace_queue)")]
+            if "owner" not in columns:
+                # Process holding an inflight item's lease; added when queues became shared by workers
+                conn.execute("ALTER TABLE trace_queue ADD COLUMN owner INTEGER")
+            if "leased_until" not in columns:
+                # When an inflight item's lease runs out; items leased before it existed have none
+                conn.execute("ALTER TABLE trace_queue ADD COLUMN leased_until REAL")
+            if "failed_at" not in columns:
+                # When an item was parked; items parked before it existed fall back to their last retry time
+                conn.execute("ALTER TABLE trace_queue ADD COLUMN failed_at REAL")
+            # Items leased by this process before a restart, or by one that has visibly died,
+            # go back on the queue now rather than when their lease runs out. Other worker
+            # processes sharing the file keep theirs.
+            owners = conn.execute("SELECT DISTINCT owner FROM trace_queue WHERE status = 'inflight'").fetchall()
+            for (owner,) in owners:
+                if owner is None or owner == os.getpid() or not _alive(owner):
+                    conn.execute(
+                        "UPDATE trace_queue SET status = 'queued', owner = NULL WHERE status = 'inflight' AND owner IS ?",
+                        (owner,)
+                    )
+            self._conn = conn
+        return self._conn
+
+    def size(self) -> int:
+        """Number of traces waiting to be written or currently being written."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT COUNT(*) FROM trace_queue WHERE status IN ('queued', 'inflight')"
+            ).fetchone()
+        return row[0]
+
+    def failed_count(self) -> int:
+        """Number of parked traces that ran out of attempts and have not been purged yet."""
+        with self._lock:
+            row = self._connect().execute("SELECT COUNT(*) FROM trace_queue WHERE status = 'failed'").fetchone()
+        return row[0]
+
+    def purge_failed(self) -> int:
+        """Delete parked traces older than `failed_retention_seconds`. Returns how many were deleted."""
+        with self._lock:
+            cursor = self._connect().execute(
+                "DELETE FROM trace_queue WHERE status = 'failed' AND COALESCE(failed_at, available_at) <= ?",
+                (time.time() - self.failed_retention_seconds,)
+            )
+        return cursor.rowcount
+
+    def put(self, user_id: str, trace_id: str, trace_data: Dict[str, Any], metadata: Dict[str, Any]):
+        """Persist a trace for background writing. Raises QueueFullError when at capacity."""
+        self.put_many(user_id, [trace_id], [trace_data], [metadata])
+
+    def put_many(self, user_id: str, trace_ids: List[str], traces: List[Dict[str, Any]], metadata: List[Dict[str, Any]]):
+        """Persist a batch of traces atomically. Raises QueueFullError if they do not all fit."""
+        now = time.time()
+        rows = [
+            (trace_id, user_id, json.dumps({"trace_data": trace_data, "metadata": meta}, default=str), now)
+            for trace_id, trace_data, meta in zip(trace_ids, traces, metadata)
+        ]
+        with self._not_empty:
+            conn = self._connect()
+            with conn:
+                # Write-locked from the count on, so that other processes cannot overfill it
+                conn.execute("BEGIN IMMEDIATE")
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM trace_queue WHERE status IN ('queued', 'inflight')"
+                ).fetchone()[0]
+                if pending + len(rows) > self.max_size:
+                    raise QueueFullError(f"Trace queue is full ({pending} pending)")
+                conn.executemany(
+                    "INSERT INTO trace_queue (trace_id, user_id, payload, available_at) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+            self._not_empty.notify(len(rows))
+
+    def get(self, timeout: float = 1.0) -> Optional[Dict[str, Any]]:
+        """Lease the next ready trace, waiting up to `timeout` seconds. Returns None if nothing is ready."""
+        items = self.get_batch(1, timeout)
+        return items[0] if items else None
+
+    def get_batch(self, limit: int, timeout: float = 1.0) -> List[Dict[str, Any]]:
+        """Lease up to `limit` ready traces, waiting up to `timeout` seconds for the first one.
+
+        Ready traces are those queued and due, and those whose lease has run out.
+        """
+        deadline = time.monotonic() + timeout
+        with self._not_empty:
+            conn = self._connect()
+            while True:
+                now = time.time()
+                # An idle queue is polled with plain reads, which do not contend for the write lock
+                rows = []
+                if conn.execute(f"SELECT 1 FROM trace_queue WHERE {_READY} LIMIT 1", (now, now)).fetchone():
+                    with conn:
+                        # Select and lease in one write transaction, so that no other process leases the same rows
+                        conn.execute("BEGIN IMMEDIATE")
+                        rows = conn.execute(
+                            f"SELECT id, trace_id, user_id, payload, attempts FROM trace_queue "
+                            f"WHERE {_READY} ORDER BY id LIMIT ?",
+                            (now, now, limit)
+                        ).fetchall()
+                        conn.executemany(
+                            "UPDATE trace_queue SET status = 'inflight', owner = ?, leased_until = ? WHERE id = ?",
+                            [(os.getpid(), now + self.lease_seconds, row[0]) for row in rows]
+                        )
+                if rows:
+                    items = []
+                    for row in rows:
+                        payload = json.loads(row[3])
+                        items.append({
+                            "id": row[0],
+                            "trace_id": row[1],
+                            "user_id": row[2],
+                            "trace_data": payload["trace_data"],
+                            "metadata": payload["metadata"],
+                            "attempts": row[4],
+                        })
+                    return items
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopping.is_set():
+                    return []
+                # Wake up for new items, or in time for the next retry to become ready
+                self._not_empty.wait(min(remaining, 0.5))
+
+    def status(self, user_id: str, trace_id: str) -> Optional[str]:
+        """Return "queued" or "failed" for a user's trace still held by the queue, else None."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT status FROM trace_queue WHERE trace_id = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
+                (trace_id, user_id)
+            ).fetchone()
+        if not row:
+            return None
+        return "failed" if row[0] == "failed" else "queued"
+
+    def ack(self, item_id: int):
+        """Remove a trace that was written successfully."""
+        with self._lock:
+            self._connect().execute("DELETE FROM trace_queue WHERE id = ?", (item_id,))
+
+    def nack(self, item_id: int, error: str):
+        """Schedule a failed trace for retry with exponential backoff, or park it once attempts run out."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT attempts FROM trace_queue WHERE id = ?", (item_id,)).fetchone()
+            if not row:
+                return
+
+            attempts = row[0] + 1
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    "UPDATE trace_queue SET status = 'failed', attempts = ?, last_error = ?, failed_at = ? WHERE id = ?",
+                    (attempts, error, time.time(), item_id)
+                )
+            else:
+                delay = min(2 ** attempts, 60)
+                conn.execute(
+                    "UPDATE trace_queue SET status = 'queued', attempts = ?, available_at = ?, last_error = ? "
+                    "WHERE id = ?",
+                    (attempts, time.time() + delay, error, item_id)
+                )
+
+    def _work(self, batch_size: int):
+        """Worker loop: lease batches of traces and write them per user until the queue is stopped."""
+        while not self._stopping.is_set():
+            # Parked traces are not counted against max_size, so they are purged here to bound the file
+            if time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + 60
+                purged = self.purge_failed()
+                if purged:
+                    logger.info("Purged %d failed traces from the queue", purged)
+
+            items = self.get_batch(batch_size, timeout=1.0)
+            if not items:
+                continue
+
+            # Each user's traces are packed into their own documents
+            by_user: Dict[str, List[Dict[str, Any]]] = {}
+            for item in items:
+                by_user.setdefault(item["user_id"], []).append(item)
+
+            for user_id, user_items in by_user.items():
+                try:
+                    write_traces(
+                        user_id,
+                        [item["trace_id"] for item in user_items],
+                        [item["trace_data"] for item in user_items],
+                        [item["metadata"] for item in user_items]
+                    )
+                except Exception as e:
+                    logger.warning("Writing %d traces for user %s failed: %s", len(user_items), user_id, e)
+                    for item in user_items:
+                        self.nack(item["id"], str(e))
+                else:
+                    for item in user_items:
+                        self.ack(item["id"])
+
+    def start(self, workers: int, batch_size: int = 1):
+        """Start the background worker pool."""
+        if self._workers:
+            return
+
+        self._stopping.clear()
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, args=(batch_size,), name=f"trace-writer-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout: float = 10.0):
+        """Stop the worker pool. Unwritten traces stay on disk for the next start."""
+        self._stopping.set()
+        with self._not_empty:
+            self._not_empty.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+
+trace_queue = TraceQueue(
+    path=settings.trace_queue_path,
+    max_size=settings.trace_queue_max_size,
+    max_attempts=settings.trace_queue_max_attempts,
+    lease_seconds=settings.trace_queue_lease_seconds,
+    failed_retention_seconds=settings.trace_queue_failed_retention_seconds
+)
+# Without write-behind there is no queue, and a scrape should not create its file
+TRACE_QUEUE_FAILED.set_function(lambda: trace_queue.failed_count() if settings.trace_write_behind else 0)
@@ -0,0 +1,25 @@
+import time
+from typing import Any, Dict
+
+
+def trace_text(trace_data: Dict[str, Any]) -> str:
+    """The text a trace is indexed under: its system prompt and prompt."""
+    trace_input = trace_data.get("input") or {}
+    return "\n".join(part for part in (trace_input.get("system_prompt"), trace_input.get("prompt")) if part)
+
+
+def trace_record(trace_id: str, trace_data: Dict[str, Any]) -> Dict[str, Any]:
+    """The compact record returned for a trace in search results."""
+    trace_input = trace_data.get("input") or {}
+    trace_output = trace_data.get("output") or {}
+    metadata = trace_data.get("metadata") or {}
+    return {
+        "trace_id": trace_id,
+        "prompt": trace_input.get("prompt"),
+        "system_prompt": trace_input.get("system_prompt"),
+        "output": trace_output.get("text"),
+        "provider": metadata.get("provider"),
+        "model": metadata.get("model"),
+        "success": metadata.get("success", True),
+        "created_at": time.time(),
+    }
@@ -0,0 +1,112 @@
+import asyncio
+import fcntl
+import logging
+import os
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from .config import settings
+from .database import db
+from .gemini_service import gemini_service
+from .metrics import TRACES_EVICTED
+
+logger = logging.getLogger(__name__)
+
+
+def retention_enabled() -> bool:
+    return bool(
+        settings.trace_retention_days or settings.trace_retention_max_traces or settings.trace_retention_max_bytes
+    )
+
+
+class Compactor:
+    """Enforces per-user trace retention in the background.
+
+    Every `interval` seconds, looks up the traces past the retention limits
+    (`trace_retention_days`, `trace_retention_max_traces` and
+    `trace_retention_max_bytes`), at most `max_per_run` of them, and evicts
+    them least recently seen first, `batch_size` at a time: deletes the File
+    Search documents left holding no retained trace, then the traces'
+    metadata rows. The stats rollups are kept. A document packed with several
+    traces is deleted with the last of them.
+
+    Worker processes on one host take turns through a lock file, so that only
+    one of them compacts at a time; a run repeated elsewhere finds nothing to do.
+    """
+
+    def __init__(self, interval: float, batch_size: int, max_per_run: int = 1000, lock_path: Optional[str] = None):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_per_run = max_per_run
+        self.lock_path = lock_path or os.path.join(tempfile.gettempdir(), "context-api-compaction.lock")
+        self.evicted = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Compact periodically in a background task, if any retention limit is set."""
+        if retention_enabled():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                with open(self.lock_path, "a") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # Another worker on this host is compacting
+                        continue
+                    evicted = await self.compact()
+                if evicted:
+                    logger.info("Evicted %d traces past retention", evicted)
+            except Exception:
+                logger.exception("Trace compaction failed; retrying in %.0fs", self.interval)
+
+    async def compact(self) -> int:
+        """Evict the traces past the retention limits, up to `max_per_run`. Returns how many were evicted."""
+        # Finding them is the expensive part, done once per run
+        rows = await db.aexpired_traces(self.max_per_run)
+        for start in range(0, len(rows), self.batch_size):
+            await self._evict(rows[start:start + self.batch_size])
+        return len(rows)
+
+    async def _evict(self, rows: List[Dict[str, Any]]):
+        trace_ids = {row["trace_id"] for row in rows}
+        documents = {row["document_name"] for row in rows if row.get("document_name")}
+        # Batch uploads put several traces in one document; keep it while any of them is retained
+        retained = {
+            row["document_name"] for row in await db.aget_document_traces(sorted(documents))
+            if row["trace_id"] not in trace_ids
+        }
+
+        by_user: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            by_user.setdefault(row["user_id"], []).append(row)
+        for user_id, user_rows in by_user.items():
+            await gemini_service.adelete_traces(
+                user_id,
+                [row["trace_id"] for row in user_rows],
+                sorted({row["document_name"] for row in user_rows if row.get("document_name")} - retained)
+            )
+
+        # Rows go last: had a deletion above failed, the next run would find them again
+        await db.adelete_traces(sorted(trace_ids))
+        self.evicted += len(rows)
+        TRACES_EVICTED.inc(len(rows))
+
+    async def stop(self):
+        """Cancel the background task."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+compactor = Compactor(
+    settings.trace_compaction_interval,
+    settings.trace_compaction_batch_size,
+    settings.trace_compaction_max_per_run
+)
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Upper bounds of the latency histogram slots; the last slot is 60 s and over.
+# Must match trace_latency_histogram() in supabase_schema.sql.
+LATENCY_BOUNDS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# Hourly rollups are read for windows up to this long
+MAX_HOURLY_WINDOW = timedelta(days=31)
+
+
+def parse_window(window: str) -> timedelta:
+    """Parse a window such as "24h" or "7d"."""
+    count, unit = int(window[:-1]), window[-1]
+    return timedelta(hours=count) if unit == "h" else timedelta(days=count)
+
+
+def default_granularity(window: timedelta) -> str:
+    """Hourly buckets for windows up to two days, daily beyond."""
+    return "hour" if window <= timedelta(hours=48) else "day"
+
+
+def window_start(now: datetime, window: timedelta, granularity: str) -> datetime:
+    """Start of the first rollup bucket in the window ending at `now`."""
+    start = now - window
+    if granularity == "day":
+        return start.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start.replace(minute=0, second=0, microsecond=0)
+
+
+def merge_histograms(histograms: Iterable[Sequence[int]]) -> List[int]:
+    """Sum latency histograms slot by slot."""
+    merged = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+    for histogram in histograms:
+        for slot, count in enumerate(histogram or ()):
+            merged[slot] += count
+    return merged
+
+
+def histogram_percentile(histogram: Sequence[int], q: float, max_ms: Optional[float] = None) -> Optional[float]:
+    """Estimate the q-th percentile (0-100) of a latency histogram, interpolating within its slot."""
+    total = sum(histogram)
+    if not total:
+        return None
+
+    rank = q / 100 * total
+    seen = 0
+    for slot, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            lower = LATENCY_BOUNDS_MS[slot - 1] if slot else 0
+            upper = LATENCY_BOUNDS_MS[slot] if slot < len(LATENCY_BOUNDS_MS) else (max_ms or lower)
+            if max_ms is not None:
+                upper = min(upper, max_ms)
+            value = lower + (upper - lower) * (rank - seen) / count
+            return round(max(value, 0.0), 1)
+        seen += count
+    return max_ms
+
+
+def summarize_rows(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine rollup rows into trace counts, success rate, tokens and latency percentiles."""
+    traces = sum(row["traces"] for row in rows)
+    successes = sum(row["successes"] for row in rows)
+    tokens_used = sum(row["tokens_used"] for row in rows)
+    latency_count = sum(row["latency_count"] for row in rows)
+    maxima = [row["latency_max_ms"] for row in rows if row.get("latency_max_ms") is not None]
+    max_ms = max(maxima) if maxima else None
+    histogram = merge_histograms(row["latency_histogram"] for row in rows)
+    return {
+        "traces": traces,
+        "successes": successes,
+        "success_rate": round(successes / traces, 4) if traces else None,
+        "tokens_used": tokens_used,
+        "avg_tokens": round(tokens_used / traces, 1) if traces else None,
+        "latency": {
+            "mean_ms": round(sum(row["latency_sum_ms"] for row in rows) / latency_count, 1) if latency_count else None,
+            "p50_ms": histogram_percentile(histogram, 50, max_ms),
+            "p95_ms": histogram_percentile(histogram, 95, max_ms),
+            "p99_ms": histogram_percentile(histogram, 99, max_ms),
+            "max_ms": max_ms,
+        },
+    }
+
+
+def _group_key(row: Dict[str, Any], group_by: str) -> Tuple[str, ...]:
+    if group_by == "provider":
+        return (row["provider"],)
+    return (row["provider"], row["model"])
+
+
+def summarize(rows: List[Dict[str, Any]], group_by: str) -> Dict[str, Any]:
+    """Totals, per-model or per-provider groups (busiest first) and a per-bucket series."""
+    groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    buckets: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(_group_key(row, group_by), []).append(row)
+        buckets.setdefault(row["bucket"], []).append(row)
+
+    group_stats = []
+    for key, group_rows in groups.items():
+        stats = summarize_rows(group_rows)
+        stats["provider"] = key[0] or None
+        stats["model"] = (key[1] or None) if group_by == "model" else None
+        group_stats.append(stats)
+    group_stats.sort(key=lambda stats: stats["traces"], reverse=True)
+
+    return {
+        "totals": summarize_rows(rows),
+        "groups": group_stats,
+        "series": [dict(summarize_rows(buckets[bucket]), bucket=bucket) for bucket in sorted(buckets)],
+    }
@@ -0,0 +1,328 @@
+import abc
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .trace_records import trace_record, trace_text
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"\w+")
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class Embedder(abc.ABC):
+    """Turns texts into L2-normalized float32 vectors of a fixed dimension."""
+
+    dim: int
+
+    @abc.abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed each text as one row."""
+
+
+class HashingEmbedder(Embedder):
+    """Deterministic feature-hashing embedder over word unigrams and bigrams.
+
+    Needs no model or network, so it serves as the offline default and as the
+    stub embedder in tests.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = _TOKEN.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vectors[row, bucket] += sign
+        return _normalize_rows(vectors)
+
+
+class GeminiEmbedder(Embedder):
+    """Embeds texts with the Gemini embeddings API, in batches."""
+
+    def __init__(self, client, model: str, dim: int, batch_size: int = 100):
+        self.client = client
+        self.model = model
+        self.dim = dim
+        self.batch_size = batch_size
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        from google.genai import types
+
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self.client.models.embed_content(
+                model=self.model,
+                contents=texts[start:start + self.batch_size],
+                config=types.EmbedContentConfig(output_dimensionality=self.dim)
+            )
+            vectors.extend(embedding.values for embedding in response.embeddings)
+        if not vectors:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return _normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+def _kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means. Returns (centroids, assignment of each vector)."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(k):
+            members = vectors[assignment == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids, assignment
+
+
+class UserIndex:
+    """One user's vectors and trace records.
+
+    Vectors live in an append-only float32 file that is memory-mapped for
+    search; records live in an append-only JSONL file. Once the index is large
+    enough an IVF partition (k-means centroids plus inverted lists) is built in
+    memory and rebuilt whenever the index doubles in size.
+
+    A manifest holding the row count is written after both files, so rows
+    that a crash left in only one of them are dropped on load. `remove`
+    rewrites both files beside the old ones and commits the rewrite in the
+    manifest before moving them into place; loading finishes a committed
+    rewrite and discards an uncommitted one.
+    """
+
+    def __init__(self, path: str, dim: int, ivf_min_size: int = 4096, nprobe: int = 8):
+        self.path = path
+        self.dim = dim
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._records_path = os.path.join(path, "traces.jsonl")
+        self._manifest_path = os.path.join(path, "manifest.json")
+        self._lock = threading.Lock()
+        self._records: List[Dict[str, Any]] = []
+        self._vectors: Optional[np.memmap] = None
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[np.ndarray] = []
+        self._ivf_size = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+        self._remap()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _load(self):
+        """Read the records, truncating both files to the rows committed in the manifest."""
+        manifest = None
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+        for path in (self._vectors_path, self._records_path):
+            if os.path.exists(path + ".tmp"):
+                if manifest is not None and manifest.get("compacting"):
+                    os.replace(path + ".tmp", path)
+                else:
+                    os.remove(path + ".tmp")
+
+        records: List[Dict[str, Any]] = []
+        ends: List[int] = []
+        if os.path.exists(self._records_path):
+            with open(self._records_path, "rb") as f:
+                offset = 0
+                for line in f:
+                    # A torn last line has no newline, or is not valid JSON
+                    if not line.endswith(b"\n"):
+                        break
+                    if line.strip():
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            break
+                        ends.append(offset + len(line))
+                    offset += len(line)
+
+        row_bytes = self.dim * 4
+        vector_rows = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        # Indexes written before the manifest existed are trusted as far as both files go
+        count = min(len(records), vector_rows)
+        if manifest is not None:
+            count = min(count, manifest["count"])
+        if count < max(len(records), vector_rows):
+            logger.warning(
+                "Vector index %s holds %d records and %d vectors; truncating to %d",
+                self.path, len(records), vector_rows, count
+            )
+        for path, size in ((self._records_path, ends[count - 1] if count else 0), (self._vectors_path, count * row_bytes)):
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                os.truncate(path, size)
+        self._records = records[:count]
+        if manifest != {"count": count}:
+            self._write_manifest(count)
+
+    def _write_manifest(self, count: int, compacting: bool = False):
+        manifest: Dict[str, Any] = {"count": count}
+        if compacting:
+            manifest["compacting"] = True
+        with open(self._manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(self._manifest_path + ".tmp", self._manifest_path)
+
+    def _remap(self):
+        """Memory-map the vectors written so far."""
+        count = len(self._records)
+        if count == 0:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+
+    def add(self, vectors: np.ndarray, records: List[Dict[str, Any]]):
+        """Append vectors and their records."""
+        if vectors.shape != (len(records), self.dim):
+            raise ValueError(f"Expected {len(records)} vectors of dimension {self.dim}, got {vectors.shape}")
+
+        with self._lock:
+            with open(self._vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with open(self._records_path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + "\n")
+            self._write_manifest(len(self._records) + len(records))
+            self._records.extend(records)
+            self._remap()
+
+            if len(self._records) >= self.ivf_min_size and len(self._records) >= 2 * self._ivf_size:
+                self._build_ivf()
+
+    def remove(self, trace_ids: List[str]) -> int:
+        """Drop the records of traces, rewriting both files without them. Returns how many were dropped."""
+        trace_ids = set(trace_ids)
+        with self._lock:
+            keep = [i for i, record in enumerate(self._records) if record.get("trace_id") not in trace_ids]
+            removed = len(self._records) - len(keep)
+            if not removed:
+                return 0
+
+            vectors = np.asarray(self._vectors)[keep]
+            records = [self._records[i] for i in keep]
+            with open(self._vectors_path + ".tmp", "wb") as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with open(self._records_path + ".tmp", "w") as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + "\n")
+            # Committed from here: a crash before the manifest is rewritten is rolled forward on load
+            self._write_manifest(len(records), compacting=True)
+            os.replace(self._vectors_path + ".tmp", self._vectors_path)
+            os.replace(self._records_path + ".tmp", self._records_path)
+            self._write_manifest(len(records))
+
+            self._records = records
+            self._remap()
+            self._centroids, self._lists, self._ivf_size = None, [], 0
+            if len(records) >= self.ivf_min_size:
+                self._build_ivf()
+        return removed
+
+    def _build_ivf(self):
+        """Partition the current vectors into sqrt(n) clusters. Caller must hold the lock."""
+        vectors = np.asarray(self._vectors)
+        k = max(1, int(np.sqrt(len(vectors))))
+        self._centroids, assignment = _kmeans(vectors, k)
+        self._lists = [np.flatnonzero(assignment == cluster) for cluster in range(k)]
+        self._ivf_size = len(vectors)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        """Return up to k (cosine similarity, record) pairs, best first."""
+        with self._lock:
+            vectors = self._vectors
+            records = self._records
+            centroids, lists, ivf_size = self._centroids, self._lists, self._ivf_size
+
+        if vectors is None or k <= 0:
+            return []
+
+        if centroids is not None:
+            # Probe the nearest clusters, plus everything added since the last build
+            probes = np.argsort(-(centroids @ query))[:self.nprobe]
+            candidates = np.concatenate(
+                [lists[p] for p in probes] + [np.arange(ivf_size, len(vectors))]
+            )
+        else:
+            candidates = np.arange(len(vectors))
+
+        scores = np.asarray(vectors[candidates]) @ query
+        top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), records[candidates[i]]) for i in top]
+
+
+class VectorIndex:
+    """Per-user approximate nearest neighbour indexes of stored traces."""
+
+    def __init__(self, path: str, embedder: Embedder, ivf_min_size: int = 4096, nprobe: int = 8):
+        self.path = path
+        self.embedder = embedder
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self._indexes: Dict[str, UserIndex] = {}
+        self._lock = threading.Lock()
+
+    def _index(self, user_id: str) -> UserIndex:
+        """Load a user's index on first use."""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                directory = hashlib.sha256(user_id.encode()).hexdigest()[:32]
+                index = UserIndex(
+                    os.path.join(self.path, directory),
+                    self.embedder.dim,
+                    ivf_min_size=self.ivf_min_size,
+                    nprobe=self.nprobe
+                )
+                self._indexes[user_id] = index
+            return index
+
+    def add_traces(self, user_id: str, trace_ids: List[str], traces: List[Dict[str, Any]]):
+        """Embed traces in one batch and add them to the user's index."""
+        if not traces:
+            return
+        vectors = self.embedder.embed([trace_text(trace) for trace in traces])
+        records = [trace_record(trace_id, trace) for trace_id, trace in zip(trace_ids, traces)]
+        self._index(user_id).add(vectors, records)
+
+    def remove_traces(self, user_id: str, trace_ids: List[str]) -> int:
+        """Drop traces from the user's index. Returns how many were dropped."""
+        return self._index(user_id).remove(trace_ids)
+
+    def search(self, user_id: str, query: str, k: int) -> List[Dict[str, Any]]:
+        """Return the user's k traces most similar to `query`, with a `relevance_score` each."""
+        index = self._index(user_id)
+        if not len(index):
+            return []
+        vector = self.embedder.embed([query])[0]
+        return [
+            dict(record, relevance_score=score)
+            for score, record in index.search(vector, k)
+        ]
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """Initializes upstream clients in the background once the app is serving.
+
+    Liveness does not wait for it; readiness (`/ready`) does. A failed attempt
+    is retried with backoff, since requests would initialize lazily anyway and
+    a transient upstream error should not keep an instance out of rotation.
+    """
+
+    def __init__(self, steps: List[Callable[[], Awaitable[Any]]], retry_seconds: float = 1.0, max_retry_seconds: float = 30.0):
+        self.steps = steps
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.ready = False
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self.started_at: Optional[float] = None
+        self.seconds: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Run the steps in a background task."""
+        self.started_at = time.perf_counter()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        delay = self.retry_seconds
+        while True:
+            self.attempts += 1
+            try:
+                await asyncio.gather(*(step() for step in self.steps))
+            except Exception as exc:
+                self.error = f"{type(exc).__name__}: {exc}"
+                logger.warning("Warmup failed (attempt %d), retrying in %.0fs: %s", self.attempts, delay, self.error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_seconds)
+            else:
+                self.ready = True
+                self.error = None
+                self.seconds = time.perf_counter() - self.started_at
+                logger.info("Warmed up in %.2fs", self.seconds)
+                return
+
+    async def stop(self):
+        """Cancel a warmup still in progress."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self) -> Dict[str, Any]:
+        """Readiness as reported by `/ready`."""
+        if self.ready:
+            return {"status": "ready", "warmup_seconds": round(self.seconds, 3)}
+        status = {"status": "starting" if self.error is None else "failed", "attempts": self.attempts}
+        if self.error is not None:
+            status["error"] = self.error
+        return status
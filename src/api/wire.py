@@ -0,0 +1,247 @@
+import contextvars
+import io
+import json
+import zlib
+from typing import Any, Mapping, Optional
+
+import msgpack
+import orjson
+import zstandard
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse
+
+from .metrics import stage
+
+MSGPACK = "application/msgpack"
+_MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+# Responses worth compressing; streamed ones are passed through as they are
+_COMPRESSIBLE = ("application/json", "application/msgpack", "application/x-ndjson", "text/")
+# Per-request CPU matters more than the last few percent of size; gzip 6 costs twice gzip 3 for ~15% smaller bodies
+_ZSTD_LEVEL = 3
+_GZIP_LEVEL = 3
+
+# Whether the current request asked for MessagePack responses
+_msgpack_response: contextvars.ContextVar[bool] = contextvars.ContextVar("msgpack_response", default=False)
+
+
+class RequestBodyError(Exception):
+    """Raised for a request body that cannot be decoded."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class WireResponse(JSONResponse):
+    """The default response class: JSON encoded with orjson, or MessagePack when the request accepts it."""
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        media_type: Optional[str] = None,
+        background: Optional[BackgroundTask] = None,
+    ):
+        # The signature is JSONResponse's: FastAPI reads the default status code from it for the OpenAPI schema
+        if media_type is None and _msgpack_response.get():
+            media_type = MSGPACK
+        super().__init__(content, status_code, headers, media_type, background)
+
+    def render(self, content: Any) -> bytes:
+        with stage("serialize"):
+            if self.media_type == MSGPACK:
+                return msgpack.packb(content, default=str)
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def dumps_json(value: Any, sort_keys: bool = False) -> bytes:
+    """Encode a value as compact JSON with orjson, falling back to the stdlib encoder for what orjson refuses.
+
+    orjson rejects integers wider than 64 bits, which user-supplied trace
+    fields (such as `parameters`) may hold. Values JSON cannot represent are
+    encoded as their str().
+    """
+    try:
+        return orjson.dumps(value, default=str, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    except orjson.JSONEncodeError:
+        return json.dumps(value, default=str, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _accepted_codings(accept_encoding: str) -> set:
+    """Content codings in an Accept-Encoding header, without those refused with q=0."""
+    codings = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            codings.add(coding.strip())
+    return codings
+
+
+def response_coding(accept_encoding: str) -> Optional[str]:
+    """The coding to compress a response with: zstd if accepted, else gzip, else None."""
+    codings = _accepted_codings(accept_encoding)
+    for coding in ("zstd", "gzip"):
+        if coding in codings:
+            return coding
+    return None
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == "zstd":
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(body)
+    compressor = zlib.compressobj(_GZIP_LEVEL, wbits=31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def decompress(body: bytes, coding: str, limit: int) -> bytes:
+    """Decompress a request body, refusing one that inflates past `limit` bytes."""
+    try:
+        if coding == "zstd":
+            data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read(limit + 1)
+        elif coding in ("gzip", "x-gzip"):
+            data = zlib.decompressobj(wbits=31).decompress(body, limit + 1)
+        elif coding == "identity":
+            data = body
+        else:
+            raise RequestBodyError(415, f"Unsupported Content-Encoding: {coding}")
+    except (zlib.error, zstandard.ZstdError) as e:
+        raise RequestBodyError(400, f"Malformed {coding} request body: {e}")
+    if len(data) > limit:
+        raise RequestBodyError(413, f"Request body exceeds {limit} bytes")
+    return data
+
+
+def msgpack_to_json(body: bytes) -> bytes:
+    try:
+        return orjson.dumps(msgpack.unpackb(body), option=orjson.OPT_NON_STR_KEYS)
+    except (ValueError, TypeError, msgpack.UnpackException, orjson.JSONEncodeError) as e:
+        raise RequestBodyError(400, f"Malformed MessagePack request body: {e}")
+
+
+class WireMiddleware:
+    """ASGI middleware for the compact wire formats SDKs can opt into.
+
+    Requests may be compressed (`Content-Encoding: zstd` or `gzip`) and may
+    be MessagePack (`Content-Type: application/msgpack`); they are decoded
+    to JSON before they reach the routes. A request whose `Accept` names
+    MessagePack gets MessagePack from routes that use the default response
+    class. Responses of at least `minimum_size` bytes are compressed with
+    zstd or gzip, as `Accept-Encoding` allows. Streamed responses are passed
+    through, as are responses already encoded.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, max_body_size: int = 32 * 1024 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        coding = headers.get("content-encoding", "").strip().lower()
+        is_msgpack = headers.get("content-type", "").split(";")[0].strip().lower() in _MSGPACK_TYPES
+        if coding or is_msgpack:
+            try:
+                body = await self._read_body(receive)
+                with stage("decode"):
+                    if coding:
+                        body = decompress(body, coding, self.max_body_size)
+                    if is_msgpack:
+                        body = msgpack_to_json(body)
+            except RequestBodyError as e:
+                response = JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+                await response(scope, receive, send)
+                return
+            except ClientDisconnect:
+                # Nobody is left to answer, and a truncated body must not reach the routes
+                return
+            scope = dict(scope, headers=self._decoded_headers(scope, body, is_msgpack))
+            receive = self._replay(body, receive)
+
+        token = _msgpack_response.set(any(t in headers.get("accept", "") for t in _MSGPACK_TYPES))
+        try:
+            coding = response_coding(headers.get("accept-encoding", ""))
+            await self.app(scope, receive, self._compressing(send, coding) if coding else send)
+        finally:
+            _msgpack_response.reset(token)
+
+    async def _read_body(self, receive) -> bytes:
+        """The whole request body. Raises ClientDisconnect if the client goes away before sending it."""
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnect()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_size:
+                raise RequestBodyError(413, f"Request body exceeds {self.max_body_size} bytes")
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    @staticmethod
+    def _decoded_headers(scope, body: bytes, is_msgpack: bool) -> list:
+        headers = MutableHeaders(raw=list(scope["headers"]))
+        if "content-encoding" in headers:
+            del headers["content-encoding"]
+        if is_msgpack:
+            headers["content-type"] = "application/json"
+        headers["content-length"] = str(len(body))
+        return headers.raw
+
+    @staticmethod
+    def _replay(body: bytes, receive):
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Later calls wait for the client to disconnect
+            return await receive()
+        return replay
+
+    def _compressing(self, send, coding: str):
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Held until the body shows whether the response is worth compressing
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            initial, start = start, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=initial["headers"])
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+                or not headers.get("content-type", "").startswith(_COMPRESSIBLE)
+            ):
+                await send(initial)
+                await send(message)
+                return
+
+            body = compress(body, coding)
+            headers["content-encoding"] = coding
+            headers["content-length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send(initial)
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+        return send_compressed
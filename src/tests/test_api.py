@@ -19,7 +19,8 @@ def test_health_endpoint():
     """Test health check endpoint."""
     response = client.get("/health")
     assert response.status_code == 200
-    assert response.json() == {"status": "ok"}
+    assert response.json()["status"] == "ok"
+    assert response.json()["upstreams"]["gemini"]["state"] == "closed"
 
 
 def test_create_api_key():
@@ -0,0 +1,33 @@
+import time
+from src.api.cache import TTLCache, MISSING
+
+
+def test_get_set_and_counters():
+    """Test hits and misses are counted and None can be cached."""
+    cache = TTLCache(max_size=10, ttl=60)
+    assert cache.get("a") is MISSING
+    cache.set("a", None)
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_entries_expire():
+    """Test entries are dropped once their TTL has passed."""
+    cache = TTLCache(max_size=10, ttl=60)
+    cache.set("a", 1, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get("a", "gone") == "gone"
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted():
+    """Test the cache stays within max_size by evicting the LRU entry."""
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
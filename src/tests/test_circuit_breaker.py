@@ -0,0 +1,105 @@
+from src.api import circuit_breaker
+from src.api.circuit_breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from src.api.concurrency import OverloadedError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _call(breaker, latency=0.1, error=None):
+    admitted = breaker.acquire()
+    if admitted is not None:
+        breaker.release(admitted, latency, error)
+    return admitted
+
+
+def test_breaker_opens_on_errors_and_slow_calls():
+    """Test the breaker opens once enough recent calls failed or were slow, and then refuses calls."""
+    breaker = CircuitBreaker("test", slow_call_seconds=1.0, window=10, min_calls=4, failure_threshold=0.5, clock=Clock())
+    _call(breaker)
+    _call(breaker, error=ValueError())
+    _call(breaker)
+    assert breaker.state == CLOSED
+    _call(breaker, latency=5.0)
+    assert breaker.state == OPEN
+    assert _call(breaker) is None
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_breaker_ignores_shed_and_cancelled_calls():
+    """Test calls shed by this service say nothing about the upstream's health."""
+    breaker = CircuitBreaker("test", slow_call_seconds=1.0, min_calls=2, clock=Clock())
+    for _ in range(5):
+        _call(breaker, error=OverloadedError("test"))
+    assert breaker.state == CLOSED
+    assert breaker.stats()["failure_rate"] == 0.0
+
+
+def test_breaker_half_open_probes():
+    """Test the breaker half-opens after its timeout, closes on good probes and reopens on a bad one."""
+    clock = Clock()
+    breaker = CircuitBreaker("test", slow_call_seconds=1.0, min_calls=1, open_seconds=10.0, probes=2, clock=clock)
+    _call(breaker, error=ValueError())
+    assert breaker.state == OPEN and breaker.retry_after() == 10
+
+    clock.now = 10.0
+    assert breaker.acquire() == HALF_OPEN
+    assert breaker.acquire() == HALF_OPEN
+    # Only `probes` calls go through at once
+    assert breaker.acquire() is None
+    breaker.release(HALF_OPEN, 0.1)
+    breaker.release(HALF_OPEN, 5.0)
+    assert breaker.state == OPEN
+
+    clock.now = 20.0
+    _call(breaker)
+    _call(breaker)
+    assert breaker.state == CLOSED
+
+
+def test_open_breaker_answers_from_recent_traces(monkeypatch):
+    """Test retrieval answers at once from recent traces, without calling Gemini, while its breaker is open."""
+    from fastapi.testclient import TestClient
+    from benchmarks.fakes import FakeGeminiClient
+    from src.api.auth import get_user_id
+    from src.api.config import settings
+    from src.api.gemini_service import GeminiService
+    from src.api.main import app
+    from src.api.routes import context as context_routes
+
+    monkeypatch.setattr(settings, "circuit_breakers", True)
+    monkeypatch.setattr(settings, "store_partitioning", "global")
+    service = GeminiService()
+    service.client = FakeGeminiClient()
+    service.store_name = "fileSearchStores/test"
+    service.initialized = True
+    service.recent_traces.add("user-1", ["t-1", "t-2"], [
+        {"input": {"prompt": "how do I reset a password"}, "output": {"text": "Use the reset link."}},
+        {"input": {"prompt": "billing questions"}, "output": {"text": "See invoices."}},
+    ])
+    monkeypatch.setattr(context_routes, "gemini_service", service)
+    breaker = CircuitBreaker("gemini", slow_call_seconds=1.0, min_calls=1)
+    _call(breaker, error=ValueError())
+    monkeypatch.setitem(circuit_breaker.circuit_breakers, "gemini", breaker)
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        client = TestClient(app)
+        body = {"prompt": "reset my password", "provider": "openai", "model": "gpt-4", "mode": "retrieve_only"}
+        response = client.post("/api/v1/context/retrieve", json=body)
+
+        assert response.status_code == 200
+        assert response.json()["suggestions"]["degraded"] == "circuit_open"
+        assert [trace["trace_id"] for trace in response.json()["relevant_traces"]] == ["t-1"]
+        assert "Use the reset link." in response.json()["enhanced_context"]
+        assert service.client.calls == []
+
+        health = client.get("/health").json()
+        assert health["status"] == "degraded"
+        assert health["upstreams"]["gemini"]["state"] == "open"
+    finally:
+        app.dependency_overrides.clear()
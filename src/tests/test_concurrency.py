@@ -0,0 +1,86 @@
+import httpx
+from src.api import concurrency
+from src.api.concurrency import AdaptiveLimiter, is_overload
+
+
+class Throttled(Exception):
+    code = 429
+
+
+def test_limiter_sheds_over_limit():
+    """Test calls beyond the limit are refused rather than queued."""
+    limiter = AdaptiveLimiter("test", initial=2, min_limit=1, max_limit=10, latency_target=1.0)
+    assert limiter.try_acquire() and limiter.try_acquire()
+    assert not limiter.try_acquire()
+    assert limiter.stats()["shed"] == 1
+
+    limiter.release(0.1)
+    assert limiter.try_acquire()
+
+
+def test_limiter_aimd():
+    """Test the limit grows additively on fast calls and halves once per window on overload."""
+    now = [0.0]
+    limiter = AdaptiveLimiter("test", initial=4, min_limit=1, max_limit=10, latency_target=1.0, clock=lambda: now[0])
+    for _ in range(8):
+        limiter.try_acquire()
+        limiter.release(0.1)
+    assert limiter.stats()["limit"] == 5
+
+    for _ in range(3):
+        limiter.try_acquire()
+        limiter.release(0.1, Throttled())
+    assert limiter.stats()["limit"] == 2
+    assert limiter.stats()["decreases"] == 1
+
+    # Slow calls count as overload once the window has passed
+    now[0] = 2.0
+    limiter.try_acquire()
+    limiter.release(5.0)
+    assert limiter.stats()["limit"] == 1
+
+    # Other errors leave the limit alone
+    limiter.try_acquire()
+    limiter.release(0.1, ValueError())
+    assert limiter.stats()["limit"] == 1
+
+
+def test_is_overload():
+    """Test timeouts and 429/503 responses are treated as overload."""
+    assert is_overload(TimeoutError())
+    assert is_overload(httpx.ReadTimeout("slow"))
+    assert is_overload(Throttled())
+    assert not is_overload(ValueError())
+
+
+def test_shed_request_gets_503(monkeypatch):
+    """Test a request whose Gemini call is shed gets a 503 instead of a degraded 200."""
+    from fastapi.testclient import TestClient
+    from benchmarks.fakes import FakeGeminiClient
+    from src.api.auth import get_user_id
+    from src.api.config import settings
+    from src.api.gemini_service import GeminiService
+    from src.api.main import app
+    from src.api.routes import context as context_routes
+
+    monkeypatch.setattr(settings, "adaptive_concurrency", True)
+    service = GeminiService()
+    service.client = FakeGeminiClient()
+    service.store_name = "fileSearchStores/test"
+    service.initialized = True
+    monkeypatch.setattr(context_routes, "gemini_service", service)
+    # A limiter with its only slot taken
+    limiter = AdaptiveLimiter("gemini", initial=1, min_limit=1, max_limit=1, latency_target=1.0)
+    limiter.try_acquire()
+    monkeypatch.setitem(concurrency.upstream_limiters, "gemini", limiter)
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        client = TestClient(app)
+        body = {"prompt": "reset a password", "provider": "openai", "model": "gpt-4", "mode": "retrieve_only"}
+        for path in ("/api/v1/context/retrieve", "/api/v1/context/retrieve-stream"):
+            response = client.post(path, json=body)
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+        assert service.client.calls == []
+    finally:
+        app.dependency_overrides.clear()
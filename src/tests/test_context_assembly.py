@@ -0,0 +1,88 @@
+import time
+from types import SimpleNamespace
+from src.api.context_assembly import (
+    assemble_context,
+    estimate_tokens,
+    normalize_chunk,
+    rerank_chunks,
+    truncate_to_tokens,
+)
+from src.api.gemini_service import GeminiService
+
+
+def test_estimate_tokens_by_model_family():
+    """Test token estimates depend on the model family and count non-ASCII conservatively."""
+    text = "word " * 100
+    assert estimate_tokens(text, "claude-3-5-sonnet") > estimate_tokens(text, "gpt-4o")
+    assert estimate_tokens("", "gpt-4") == 0
+    assert estimate_tokens("日本語のテキスト", "gpt-4") == 8
+
+
+def test_truncate_to_tokens_fits_budget():
+    """Test truncation lands within the budget at a word boundary."""
+    text = " ".join(f"word{i}" for i in range(500))
+    cut = truncate_to_tokens(text, 50, "gpt-4")
+    assert estimate_tokens(cut, "gpt-4") <= 50
+    assert cut.endswith("…")
+    assert truncate_to_tokens("short", 50, "gpt-4") == "short"
+
+
+def test_normalize_chunk_reads_trace_fields_from_json():
+    """Test trace_id and created_at are recovered from serialized trace text."""
+    chunk = normalize_chunk({
+        "chunk": {"text": '{"trace_id": "t-1", "created_at": 1700000000.5, "input": {}}'},
+        "relevance_score": 0.4
+    })
+    assert chunk["trace_id"] == "t-1"
+    assert chunk["created_at"] == 1700000000.5
+    assert "chunk" not in chunk
+
+
+def test_rerank_prefers_recent_at_equal_relevance():
+    """Test recency breaks ties between equally relevant chunks."""
+    now = time.time()
+    chunks = [
+        {"text": "old", "relevance_score": 0.5, "created_at": now - 30 * 86400},
+        {"text": "new", "relevance_score": 0.5, "created_at": now},
+    ]
+    ranked = rerank_chunks(chunks, recency_weight=0.2, half_life=7 * 86400, now=now)
+    assert [chunk["text"] for chunk in ranked] == ["new", "old"]
+
+
+def test_assemble_dedupes_and_packs_into_budget():
+    """Test duplicates are dropped, the best chunks are kept and the budget is respected."""
+    chunks = [
+        {"text": "Prompt: reset a password", "relevance_score": 0.9},
+        {"text": "prompt:   RESET a password", "relevance_score": 0.95},
+        {"text": "filler " * 400, "relevance_score": 0.5},
+        {"text": "Prompt: unrelated", "relevance_score": 0.1},
+    ]
+    result = assemble_context(chunks, "gpt-4", token_budget=100, max_chunks=5, recency_weight=0.0)
+
+    stats = result["stats"]
+    assert stats["chunks_retrieved"] == 4
+    assert stats["chunks_unique"] == 3
+    assert stats["tokens_used"] <= 100
+    assert stats["truncated"]
+    assert result["chunks"][0]["relevance_score"] == 0.95
+    assert result["chunks"][-1]["truncated"]
+    assert estimate_tokens(result["text"], "gpt-4") <= 100
+
+
+def test_retrieval_result_scores_grounding_chunks():
+    """Test File Search grounding chunks are scored by the supports that cite them."""
+    grounding = SimpleNamespace(
+        grounding_chunks=[
+            SimpleNamespace(retrieved_context=SimpleNamespace(text="first", title="a")),
+            SimpleNamespace(retrieved_context=SimpleNamespace(text="second", title="b")),
+        ],
+        grounding_supports=[
+            SimpleNamespace(grounding_chunk_indices=[0, 1], confidence_scores=[0.2, 0.9]),
+            SimpleNamespace(grounding_chunk_indices=[0], confidence_scores=[0.6]),
+        ],
+        retrieval_queries=None
+    )
+    response = SimpleNamespace(text="prose", candidates=[SimpleNamespace(grounding_metadata=grounding)])
+
+    result = GeminiService()._retrieval_result(response, "gpt-4", False)
+    assert [(c["text"], c["relevance_score"]) for c in result["relevant_traces"]] == [("first", 0.6), ("second", 0.9)]
@@ -0,0 +1,75 @@
+import pytest
+from fastapi.testclient import TestClient
+from src.api.auth import get_user_id
+from src.api.config import settings
+from src.api.main import app
+from src.api.rate_limit import RateLimiter
+from src.api.routes import context as context_routes
+from src.tests.test_context_modes import _service
+
+
+@pytest.fixture
+def client():
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        yield TestClient(app, headers={"X-API-Key": "ctx_test"})
+    finally:
+        app.dependency_overrides.clear()
+
+
+def _body(prompts, **extra):
+    items = [{"prompt": prompt, "mode": "retrieve_only"} for prompt in prompts]
+    return {"provider": "openai", "model": "gpt-4", "items": items, **extra}
+
+
+def test_batch_shares_chunks_and_reports_item_errors(monkeypatch, client):
+    """Test a batch returns chunks common to its items once, and a failed item alongside the others."""
+    monkeypatch.setattr(settings, "rate_limit_enabled", False)
+    service = _service(monkeypatch)
+    aretrieve_context = service.aretrieve_context
+
+    async def flaky(user_id, prompt, model, **kwargs):
+        if prompt == "broken":
+            raise RuntimeError("upstream error")
+        return await aretrieve_context(user_id, prompt, model, **kwargs)
+
+    monkeypatch.setattr(service, "aretrieve_context", flaky)
+    monkeypatch.setattr(context_routes, "gemini_service", service)
+
+    response = client.post("/api/v1/context/retrieve-batch", json=_body(["reset a password", "broken", "rotate a key"]))
+    assert response.status_code == 200
+    body = response.json()
+    first, failed, last = body["results"]
+    assert [r["index"] for r in body["results"]] == [0, 1, 2]
+    assert failed["error"] == "upstream error"
+    # Every prompt retrieves the same three fake chunks
+    assert len(body["chunks"]) == 3
+    assert first["relevant_traces"] == last["relevant_traces"]
+    assert {ref["chunk_id"] for ref in first["relevant_traces"]} == set(body["chunks"])
+    assert {chunk["trace_id"] for chunk in body["chunks"].values()} == {"fake-0", "fake-1", "fake-2"}
+
+    response = client.post("/api/v1/context/retrieve-batch", json=_body(["reset a password"], dedupe=False))
+    [result] = response.json()["results"]
+    assert response.json()["chunks"] == {}
+    assert result["relevant_traces"][0]["trace_id"] == "fake-0"
+
+
+def test_batch_size_and_rate_limits(monkeypatch, client):
+    """Test an oversized batch is rejected, and each item counts against the rate limits."""
+    from src.api import auth
+
+    monkeypatch.setattr(context_routes, "gemini_service", _service(monkeypatch))
+    monkeypatch.setattr(settings, "context_batch_max_items", 3)
+    monkeypatch.setattr(auth, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(settings, "rate_limit_enabled", True)
+    monkeypatch.setattr(settings, "rate_limit_backend", "memory")
+    monkeypatch.setattr(settings, "api_key_rate_burst", 10)
+    monkeypatch.setattr(settings, "user_rate_burst", 5)
+
+    assert client.post("/api/v1/context/retrieve-batch", json=_body(["a"] * 4)).status_code == 413
+    # The key was verified without checking its limit, so this batch costs two of five
+    assert client.post("/api/v1/context/retrieve-batch", json=_body(["a", "b", "c"])).status_code == 200
+    assert client.post("/api/v1/context/retrieve-batch", json=_body(["a", "b", "c"])).status_code == 200
+    response = client.post("/api/v1/context/retrieve-batch", json=_body(["a", "b", "c"]))
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
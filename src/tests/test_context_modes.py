@@ -0,0 +1,104 @@
+import asyncio
+from benchmarks.fakes import FakeGeminiClient
+from src.api.config import settings
+from src.api.gemini_service import GeminiService
+
+
+def _service(monkeypatch, chunks=3, chunk_chars=400):
+    monkeypatch.setattr(settings, "store_partitioning", "global")
+    monkeypatch.setattr(settings, "async_io", True)
+    service = GeminiService()
+    service.client = FakeGeminiClient(chunks=chunks, chunk_chars=chunk_chars)
+    service.store_name = "fileSearchStores/test"
+    service.initialized = True
+    return service
+
+
+def test_retrieve_only_returns_chunks_without_generation(monkeypatch):
+    """Test retrieve-only runs File Search on the retrieval model with output capped."""
+    monkeypatch.setattr(settings, "retrieval_model", "retrieval-model")
+    service = _service(monkeypatch)
+
+    result = service.retrieve_context("user-1", "reset a password", "gpt-4", mode="retrieve_only")
+
+    [(model, config)] = service.client.calls
+    assert model == "retrieval-model"
+    assert config.max_output_tokens == settings.retrieval_max_output_tokens
+    assert result["suggestions"]["mode"] == "retrieve_only"
+    assert not result["context"]["synthesized"]
+    assert result["relevant_traces"][0]["trace_id"] == "fake-0"
+    assert "Patterns relevant to" not in result["enhanced_context"]
+
+
+def test_synthesize_uses_configured_model(monkeypatch):
+    """Test synthesize mode returns the synthesis model's text."""
+    monkeypatch.setattr(settings, "synthesis_model", "synthesis-model")
+    service = _service(monkeypatch)
+
+    result = asyncio.run(service.aretrieve_context("user-1", "reset a password", "gpt-4", mode="synthesize"))
+
+    assert [model for model, _ in service.client.calls] == ["synthesis-model"]
+    assert result["enhanced_context"].startswith("Patterns relevant to")
+    assert result["context"]["synthesized"]
+
+
+def test_auto_synthesizes_only_when_traces_overflow(monkeypatch):
+    """Test auto mode returns chunks that fit, and synthesizes (once, then cached) when they do not."""
+    service = _service(monkeypatch, chunks=3, chunk_chars=40)
+    result = service.retrieve_context("user-1", "small prompt", "gpt-4", mode="auto", max_context_tokens=1000)
+    assert len(service.client.calls) == 1
+    assert not result["context"]["synthesized"]
+
+    service = _service(monkeypatch, chunks=3, chunk_chars=2000)
+    for _ in range(2):
+        result = service.retrieve_context("user-1", "large prompt", "gpt-4", mode="auto", max_context_tokens=200)
+    assert len(service.client.calls) == 2
+    assert result["context"]["synthesized"]
+    assert result["suggestions"]["cached"]
+
+
+def _collect(events):
+    async def run():
+        return [event async for event in events]
+    return asyncio.run(run())
+
+
+def test_stream_sends_traces_before_synthesized_text(monkeypatch):
+    """Test the stream yields traces first, then deltas that add up to the final context."""
+    service = _service(monkeypatch)
+
+    events = _collect(service.astream_context("user-1", "reset a password", "gpt-4", mode="synthesize"))
+
+    kinds = [event["event"] for event in events]
+    assert kinds[0] == "traces" and kinds[-1] == "done"
+    assert kinds.count("delta") > 1
+    assert events[0]["data"]["relevant_traces"]
+    text = "".join(event["data"]["text"] for event in events if event["event"] == "delta")
+    assert events[-1]["data"]["enhanced_context"] == text
+    assert events[-1]["data"]["context"]["synthesized"]
+
+
+def test_stream_endpoint_formats(monkeypatch):
+    """Test the streaming endpoint speaks SSE by default and NDJSON on request."""
+    from fastapi.testclient import TestClient
+    from src.api.auth import get_user_id
+    from src.api.main import app
+    from src.api.routes import context as context_routes
+    import orjson
+
+    service = _service(monkeypatch)
+    monkeypatch.setattr(context_routes, "gemini_service", service)
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        client = TestClient(app)
+        body = {"prompt": "reset a password", "provider": "openai", "model": "gpt-4", "mode": "retrieve_only"}
+
+        response = client.post("/api/v1/context/retrieve-stream", json=body)
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text.startswith("event: traces\ndata: ")
+
+        response = client.post("/api/v1/context/retrieve-stream?format=ndjson", json=body)
+        lines = [orjson.loads(line) for line in response.text.splitlines()]
+        assert [line["event"] for line in lines] == ["traces", "delta", "done"]
+    finally:
+        app.dependency_overrides.clear()
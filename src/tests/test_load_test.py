@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from benchmarks import load_test
+from src.api.circuit_breaker import CircuitBreaker, circuit_breakers
+from src.api.config import settings
+from src.api.database import db
+from src.api.gemini_service import gemini_service
+
+
+@pytest.fixture
+def singletons(monkeypatch):
+    """Restore what install_fakes swaps on the service singletons once the test is done."""
+    for obj, name in [
+        (settings, "async_io"), (settings, "trace_write_behind"), (settings, "rate_limit_enabled"),
+        # The clients themselves, not the property that creates one on first use
+        (db, "_client"), (db, "async_client"),
+        (gemini_service, "client"), (gemini_service, "store_name"), (gemini_service, "initialized"),
+    ]:
+        monkeypatch.setattr(obj, name, getattr(obj, name))
+    # Never used by the fakes, but required to build the real clients
+    monkeypatch.setattr(settings, "supabase_url", "https://load-test.supabase.co")
+    monkeypatch.setattr(settings, "supabase_key", "load-test")
+    monkeypatch.setattr(settings, "gemini_api_key", "load-test")
+
+
+def test_load_test_runs_against_fakes(singletons):
+    """Test the load test drives every endpoint through the fakes and reports percentiles."""
+    args = load_test.parse_args([
+        "--requests", "20", "--warmup", "0", "--concurrency", "4", "--users", "2",
+        "--supabase-ms", "0", "--gemini-ms", "0", "--upload-ms", "0"
+    ])
+    report = asyncio.run(load_test.run(args))
+
+    assert set(report["results"]) == set(load_test.ENDPOINTS)
+    for result in report["results"].values():
+        assert result["requests"] == 20
+        assert result["errors"] == 0
+        assert result["degraded"] == 0
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+
+
+def test_injected_errors_surface_as_degraded(singletons, monkeypatch):
+    """Test upstream failures from the fakes are reported, not hidden."""
+    # Failures trip a breaker of the test's own, left behind afterwards
+    monkeypatch.setitem(circuit_breakers, "gemini", CircuitBreaker("gemini", slow_call_seconds=15.0))
+
+    args = load_test.parse_args([
+        "--endpoints", "context_retrieve", "--requests", "20", "--warmup", "0", "--concurrency", "4",
+        "--users", "1", "--supabase-ms", "0", "--gemini-ms", "0", "--gemini-error-rate", "1",
+        # A seed of its own, so no prompt is already in the retrieval cache
+        "--seed", "7"
+    ])
+    report = asyncio.run(load_test.run(args))
+
+    assert report["results"]["context_retrieve"]["degraded"] == 20
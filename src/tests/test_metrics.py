@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from src.api.main import app
+from src.api.metrics import span, timed, mark_degraded, current_timing
+
+client = TestClient(app)
+
+
+def _sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_requests_are_counted_by_route_template():
+    """Test requests are labelled with the route template and get a Server-Timing header."""
+    labels = {"route": "/health", "method": "GET", "status": "200", "outcome": "ok"}
+    before = _sample("http_requests_total", labels)
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert "total;dur=" in response.headers["server-timing"]
+    assert _sample("http_requests_total", labels) == before + 1
+
+
+def test_unknown_paths_share_one_label():
+    """Test unmatched paths do not create a label per path."""
+    labels = {"route": "unmatched", "method": "GET", "status": "404", "outcome": "client_error"}
+    before = _sample("http_requests_total", labels)
+    client.get("/no/such/path/123")
+    assert _sample("http_requests_total", labels) == before + 1
+
+
+def test_metrics_endpoint():
+    """Test the Prometheus endpoint exposes request and cache metrics."""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "http_request_duration_seconds_bucket" in response.text
+    assert 'cache_requests_total{cache="api_key"' in response.text
+
+
+def test_upstream_spans():
+    """Test upstream spans record outcomes and are not double counted when nested."""
+    ok = {"upstream": "test", "operation": "op", "outcome": "ok"}
+    error = {"upstream": "test", "operation": "op", "outcome": "error"}
+    before_ok, before_error = _sample("upstream_calls_total", ok), _sample("upstream_calls_total", error)
+
+    @timed("test", "op")
+    async def call():
+        with span("test", "op"):
+            return 1
+
+    assert asyncio.run(call()) == 1
+    with pytest.raises(ValueError):
+        with span("test", "op"):
+            raise ValueError()
+
+    assert _sample("upstream_calls_total", ok) == before_ok + 1
+    assert _sample("upstream_calls_total", error) == before_error + 1
+
+
+def test_mark_degraded_outside_request():
+    """Test degraded responses are counted even without a request in progress."""
+    before = _sample("degraded_responses_total", {"reason": "test"})
+    assert current_timing() is None
+    mark_degraded("test")
+    assert _sample("degraded_responses_total", {"reason": "test"}) == before + 1
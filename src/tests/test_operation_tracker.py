@@ -0,0 +1,50 @@
+import types
+import pytest
+from src.api.operation_tracker import OperationTracker, OperationFailed
+
+
+def make_operation(polls_left, error=None):
+    return types.SimpleNamespace(done=polls_left == 0, polls_left=polls_left, error=error)
+
+
+def poll(operation):
+    return make_operation(operation.polls_left - 1, error=operation.error)
+
+
+def test_operations_resolve_when_done():
+    """Test tracked operations resolve after polling, each on its own schedule."""
+    tracker = OperationTracker(poll, min_interval=0.001, max_interval=0.01)
+    try:
+        fast = tracker.track(make_operation(1))
+        slow = tracker.track(make_operation(4))
+        done = tracker.track(make_operation(0))
+        assert fast.result(timeout=2).done
+        assert slow.result(timeout=2).done
+        assert done.result(timeout=2).done
+        assert len(tracker) == 0
+    finally:
+        tracker.stop()
+
+
+def test_failed_operation_raises():
+    """Test an operation finishing with an error fails its future."""
+    tracker = OperationTracker(poll, min_interval=0.001, max_interval=0.01)
+    try:
+        future = tracker.track(make_operation(2, error={"message": "bad file"}))
+        with pytest.raises(OperationFailed):
+            future.result(timeout=2)
+    finally:
+        tracker.stop()
+
+
+def test_poll_errors_fail_after_retries():
+    """Test an operation whose polls keep failing is given up on."""
+    def broken_poll(operation):
+        raise ConnectionError("unreachable")
+
+    tracker = OperationTracker(broken_poll, min_interval=0.001, max_interval=0.002, max_poll_errors=3)
+    try:
+        with pytest.raises(ConnectionError):
+            tracker.track(make_operation(5)).result(timeout=2)
+    finally:
+        tracker.stop()
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src.api import profiler as profiler_module
+from src.api.auth import get_user_id
+from src.api.config import settings
+from src.api.main import app
+from src.api.profiler import SamplingProfiler
+from src.api.routes import context as context_routes
+from src.tests.test_context_modes import _service
+
+ADMIN = {"X-Admin-Key": "admin-secret"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(settings, "admin_api_key", "admin-secret")
+    return TestClient(app)
+
+
+def _burn(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+async def _sampled_work():
+    _burn(0.2)
+
+
+async def _unsampled_work():
+    _burn(0.2)
+
+
+def test_profiler_samples_only_sampled_requests(monkeypatch):
+    """Test a session below a sample rate of 1 records the stacks of sampled requests and the tasks they start."""
+    draws = iter([0.0, 0.9])
+    monkeypatch.setattr(profiler_module.random, "random", lambda: next(draws))
+    profiler = SamplingProfiler(interval=0.005)
+
+    async def request(work):
+        token = profiler.sample_request()
+        try:
+            # Run in a task of its own, as route code started with asyncio.gather would be
+            await asyncio.create_task(work())
+        finally:
+            if token is not None:
+                token.var.reset(token)
+
+    async def run():
+        profiler.start(duration=5, sample_rate=0.5)
+        await request(_sampled_work)
+        await request(_unsampled_work)
+        profiler.stop()
+
+    asyncio.run(run())
+    stacks = profiler.collapsed()
+    assert "_sampled_work (" in stacks
+    assert "_unsampled_work" not in stacks
+    for line in stacks.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0 and ";" in stack
+    assert profiler.status()["samples"] > 0
+
+
+def test_task_factory_is_restored_when_the_session_ends():
+    """Test a sampled session hands the event loop back its own task factory once it ends."""
+    profiler = SamplingProfiler(interval=0.005)
+
+    def factory(loop, coro, **kwargs):
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.set_task_factory(factory)
+        profiler.start(duration=5, sample_rate=0.5)
+        assert loop.get_task_factory() != factory
+        profiler.stop()
+        deadline = time.monotonic() + 5
+        while loop.get_task_factory() is not factory:
+            assert time.monotonic() < deadline, "task factory was not restored"
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+
+def test_admin_endpoints_require_the_admin_key(client, monkeypatch):
+    """Test the admin endpoints are hidden without ADMIN_API_KEY and refuse other keys."""
+    assert client.get("/api/v1/admin/profiler", headers={"X-Admin-Key": "wrong"}).status_code == 403
+    assert client.get("/api/v1/admin/profiler").status_code == 403
+    monkeypatch.setattr(settings, "admin_api_key", None)
+    assert client.get("/api/v1/admin/profiler", headers=ADMIN).status_code == 404
+
+
+def test_profiler_session_through_admin_endpoints(client):
+    """Test a session can be started once at a time, stopped early, and its stacks fetched."""
+    assert client.post("/api/v1/admin/profiler/start", json={"duration": 3600}, headers=ADMIN).status_code == 400
+    response = client.post("/api/v1/admin/profiler/start", json={"duration": 30}, headers=ADMIN)
+    assert response.status_code == 200 and response.json()["running"]
+    assert client.post("/api/v1/admin/profiler/start", json={"duration": 30}, headers=ADMIN).status_code == 409
+
+    stopped = client.post("/api/v1/admin/profiler/stop", headers=ADMIN).json()
+    assert stopped["duration"] == 30
+    deadline = time.monotonic() + 5
+    while client.get("/api/v1/admin/profiler", headers=ADMIN).json()["running"]:
+        assert time.monotonic() < deadline, "session did not stop"
+        time.sleep(0.01)
+    response = client.get("/api/v1/admin/profiler/stacks", headers=ADMIN)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+
+def test_slow_requests_are_captured_with_stages(client, monkeypatch):
+    """Test requests over the threshold are kept, newest first, with time per stage."""
+    monkeypatch.setattr(settings, "rate_limit_enabled", False)
+    monkeypatch.setattr(settings, "slow_request_threshold_ms", 1e-6)
+    monkeypatch.setattr(context_routes, "gemini_service", _service(monkeypatch))
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        response = client.post(
+            "/api/v1/context/retrieve",
+            json={"prompt": "reset a password", "provider": "openai", "model": "gpt-4", "mode": "retrieve_only"}
+        )
+        assert response.status_code == 200
+        assert "handler;dur=" in response.headers["server-timing"]
+    finally:
+        app.dependency_overrides.clear()
+
+    monkeypatch.setattr(settings, "slow_request_threshold_ms", 0)
+    body = client.get("/api/v1/admin/slow-requests", params={"limit": 1}, headers=ADMIN).json()
+    [slow] = body["requests"]
+    assert slow["path"] == "/api/v1/context/retrieve"
+    assert slow["status"] == 200
+    assert {"handler", "serialize"} <= set(slow["stages"])
+    assert sum(slow["stages"].values()) + slow["other_ms"] == pytest.approx(slow["duration_ms"], abs=0.01)
+
+    # A threshold of 0 captures nothing
+    client.get("/health")
+    assert client.get("/api/v1/admin/slow-requests", params={"limit": 1}, headers=ADMIN).json()["requests"] == [slow]
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from src.api import auth
+from src.api.config import settings
+from src.api.rate_limit import MemoryBuckets, RateLimiter, RateLimitedError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_then_refills():
+    """Test a bucket allows `burst` requests at once, then one per 1/rate seconds."""
+    clock = Clock()
+    buckets = MemoryBuckets(max_keys=10, clock=clock)
+
+    waits = [asyncio.run(buckets.take("k", rate=2.0, burst=3)) for _ in range(4)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] == pytest.approx(0.5)
+
+    clock.now = 0.5
+    assert asyncio.run(buckets.take("k", rate=2.0, burst=3)) == 0.0
+    # Other keys have their own bucket
+    assert asyncio.run(buckets.take("other", rate=2.0, burst=3)) == 0.0
+
+
+def test_user_limit_spans_their_keys(monkeypatch):
+    """Test the per-user bucket is shared by all of a user's API keys."""
+    monkeypatch.setattr(settings, "rate_limit_enabled", True)
+    monkeypatch.setattr(settings, "rate_limit_backend", "memory")
+    monkeypatch.setattr(settings, "api_key_rate_burst", 10)
+    monkeypatch.setattr(settings, "user_rate_burst", 3)
+    limiter = RateLimiter()
+
+    async def run():
+        for key in ("a", "b", "c"):
+            await limiter.check(key, "user-1")
+        await limiter.check("d", "user-1")
+
+    with pytest.raises(RateLimitedError) as error:
+        asyncio.run(run())
+    assert error.value.scope == "user"
+    assert error.value.retry_after > 0
+
+
+def test_verify_api_key_returns_429(monkeypatch):
+    """Test an exhausted API key gets a 429 with Retry-After."""
+    async def averify_api_key(api_key):
+        return {"user_id": "user-1", "email": "user@example.com"}
+
+    monkeypatch.setattr(auth.db, "averify_api_key", averify_api_key)
+    monkeypatch.setattr(auth, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(settings, "rate_limit_enabled", True)
+    monkeypatch.setattr(settings, "rate_limit_backend", "memory")
+    monkeypatch.setattr(settings, "api_key_rate_limit", 0.5)
+    monkeypatch.setattr(settings, "api_key_rate_burst", 1)
+
+    assert asyncio.run(auth.verify_api_key("key"))["user_id"] == "user-1"
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(auth.verify_api_key("key"))
+    assert error.value.status_code == 429
+    assert error.value.headers["Retry-After"] == "2"
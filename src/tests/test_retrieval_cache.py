@@ -0,0 +1,45 @@
+from src.api.retrieval_cache import RetrievalCache, MinHasher, normalize_prompt
+
+RESULT = {"enhanced_context": "ctx", "relevant_traces": [], "suggestions": {}}
+
+
+def test_exact_hit_ignores_case_and_whitespace():
+    """Test prompts that differ only in case and spacing share an entry."""
+    cache = RetrievalCache(max_size=10, ttl=60)
+    cache.set("user-1", "Write a  story", None, "gpt-4", 5, RESULT)
+    assert cache.get("user-1", "write a story ", None, "gpt-4", 5) == RESULT
+    assert cache.get("user-2", "write a story", None, "gpt-4", 5) is None
+    assert cache.get("user-1", "write a story", None, "claude-3", 5) is None
+
+
+def test_near_duplicate_hit():
+    """Test a prompt differing by one trailing word hits the near-duplicate tier."""
+    cache = RetrievalCache(max_size=10, ttl=60, near_duplicate_threshold=0.8)
+    prompt = "summarize the quarterly sales report for the north america region and list the top products"
+    cache.set("user-1", prompt, None, "gpt-4", 5, RESULT)
+    assert cache.get("user-1", prompt + " please", None, "gpt-4", 5) == RESULT
+    assert cache.get("user-1", "translate this poem into french", None, "gpt-4", 5) is None
+
+
+def test_invalidate_user():
+    """Test storing traces invalidates only that user's entries."""
+    cache = RetrievalCache(max_size=10, ttl=60, near_duplicate_threshold=0.8)
+    cache.set("user-1", "prompt", None, "gpt-4", 5, RESULT)
+    cache.set("user-2", "prompt", None, "gpt-4", 5, RESULT)
+    generation = cache.generation("user-1")
+    cache.invalidate_user("user-1")
+    assert cache.get("user-1", "prompt", None, "gpt-4", 5) is None
+    assert cache.get("user-2", "prompt", None, "gpt-4", 5) == RESULT
+
+    # A result computed before the invalidation is not cached
+    cache.set("user-1", "prompt", None, "gpt-4", 5, RESULT, generation=generation)
+    assert cache.get("user-1", "prompt", None, "gpt-4", 5) is None
+
+
+def test_minhash_similarity():
+    """Test identical texts have similarity 1 and unrelated texts score low."""
+    hasher = MinHasher()
+    text = normalize_prompt("the quick brown fox jumps over the lazy dog")
+    assert MinHasher.similarity(hasher.signature(text), hasher.signature(text)) == 1.0
+    other = hasher.signature("completely different words in this sentence here")
+    assert MinHasher.similarity(hasher.signature(text), other) < 0.2
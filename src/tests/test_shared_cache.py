@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from src.api.cache import MISSING
+from src.api.metrics import CacheCollector
+from src.api.retrieval_cache import RetrievalCache
+from src.api.shared_cache import MmapCache
+
+
+def _set_in_child(directory):
+    MmapCache(directory, "test", max_size=64, ttl=60).set("key", {"user_id": "user-1"})
+
+
+def test_mmap_cache_is_shared_between_processes(tmp_path):
+    """Test an entry written by one process is read, and deleted, by another."""
+    cache = MmapCache(str(tmp_path), "test", max_size=64, ttl=60)
+    assert cache.get("key") is MISSING
+
+    child = multiprocessing.get_context("fork").Process(target=_set_in_child, args=(str(tmp_path),))
+    child.start()
+    child.join()
+    assert cache.get("key") == {"user_id": "user-1"}
+
+    MmapCache(str(tmp_path), "test", max_size=64, ttl=60).delete("key")
+    assert cache.get("key", "gone") == "gone"
+    assert cache.stats()["hits"] == 1
+
+
+def test_mmap_cache_expiry_eviction_and_oversized_values(tmp_path):
+    """Test entries expire, a full bucket evicts, and values too large for a slot are not cached."""
+    cache = MmapCache(str(tmp_path), "test", max_size=2, ttl=60, slot_size=64, ways=2)
+    cache.set("a", None, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get("a", "gone") == "gone"
+
+    for key in "bcd":
+        cache.set(key, key)
+    assert len(cache) == 2
+    assert cache.stats()["evictions"] == 1
+
+    cache.set("b", "x" * 100)
+    assert cache.get("b", "gone") == "gone"
+    assert cache.stats()["oversized"] == 1
+    collector = CacheCollector()
+    collector.register("test", cache)
+    oversized = next(family for family in collector.collect() if family.name == "cache_oversized")
+    assert [sample.value for sample in oversized.samples if sample.name == "cache_oversized_total"] == [1]
+
+
+def test_retrieval_invalidation_reaches_other_processes(tmp_path):
+    """Test a user's results cached in one process are dropped when another invalidates them."""
+    def make_cache():
+        return RetrievalCache(
+            max_size=64,
+            ttl=60,
+            results=MmapCache(str(tmp_path), "retrieval", max_size=64, ttl=60, slot_size=4096),
+            generations=MmapCache(str(tmp_path), "generations", max_size=64, ttl=120, slot_size=128)
+        )
+
+    first, second = make_cache(), make_cache()
+    first.set("user-1", "a prompt", None, "gpt-4", 5, {"enhanced_context": "x"})
+    assert second.get("user-1", "a prompt", None, "gpt-4", 5) == {"enhanced_context": "x"}
+
+    second.invalidate_user("user-1")
+    assert first.get("user-1", "a prompt", None, "gpt-4", 5) is None
+
+
+def test_mmap_cache_that_does_not_fit_goes_to_the_temp_dir(tmp_path, monkeypatch):
+    """Test a cache file larger than its directory's free space is mapped in the temp dir, by every process."""
+    shm = tmp_path / "shm"
+    shm.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    monkeypatch.setattr(os, "statvfs", lambda path: SimpleNamespace(f_bavail=1, f_frsize=4096))
+
+    cache = MmapCache(str(shm), "test", max_size=64, ttl=60)
+    cache.set("key", "value")
+    assert cache.path.startswith(str(tmp_path / "tmp"))
+    assert os.listdir(shm) == []
+
+    # Space freed since does not split the processes between two files
+    monkeypatch.undo()
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    assert MmapCache(str(shm), "test", max_size=64, ttl=60).get("key") == "value"
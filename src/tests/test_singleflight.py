@@ -0,0 +1,153 @@
+import asyncio
+import pytest
+from benchmarks.fakes import FakeGeminiClient, Latency
+from src.api.config import settings
+from src.api.gemini_service import GeminiService
+from src.api.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    """Test concurrent callers with the same key share one call and get their own copies."""
+    flight = SingleFlight("test")
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"value": [1]}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)), flight.do("other", fetch))
+
+    results = asyncio.run(run())
+    assert len(calls) == 2
+    assert all(result == {"value": [1]} for result in results)
+    assert results[0] is not results[1]
+    assert flight.stats()["shared"] == 4
+    assert flight.stats()["dedup_ratio"] == pytest.approx(4 / 6)
+    assert len(flight) == 0
+
+
+def test_errors_are_shared_and_not_cached():
+    """Test an exception reaches every waiter and the next call starts afresh."""
+    flight = SingleFlight("test")
+    attempts = []
+
+    async def fail():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", fail) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(run()))
+    asyncio.run(run())
+    assert len(attempts) == 2
+
+
+def test_cancelled_caller_does_not_cancel_shared_call():
+    """Test a follower still gets the result when the caller that started the call is cancelled."""
+    flight = SingleFlight("test")
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_identical_retrievals_make_one_gemini_call(monkeypatch):
+    """Test a burst of identical retrievals shares a single generate_content call."""
+    monkeypatch.setattr(settings, "store_partitioning", "global")
+    monkeypatch.setattr(settings, "async_io", True)
+    service = GeminiService()
+    service.client = FakeGeminiClient(generate_latency=Latency(median_ms=20, sigma=0))
+    service.store_name = "fileSearchStores/test"
+    service.initialized = True
+
+    async def run():
+        return await asyncio.gather(*(
+            service.aretrieve_context("user-1", prompt, "gpt-4", mode="retrieve_only")
+            for prompt in ["Reset a password"] * 4 + ["reset  a PASSWORD"]
+        ))
+
+    results = asyncio.run(run())
+    assert len(service.client.calls) == 1
+    assert len({id(result) for result in results}) == 5
+    assert service.retrieval_flight.stats()["shared"] == 4
+
+
+def test_concurrent_key_lookups_share_one_query(monkeypatch):
+    """Test concurrent verifications of an uncached key share one Supabase query."""
+    from benchmarks.fakes import FakeAsyncSupabaseClient, FakeSupabaseClient, FakeTables
+    from src.api.database import Database
+
+    monkeypatch.setattr(settings, "async_io", True)
+    tables = FakeTables()
+    database = Database()
+    database.client = FakeSupabaseClient(tables=tables)
+    database.async_client = FakeAsyncSupabaseClient(latency=Latency(median_ms=20, sigma=0), tables=tables)
+    user = database.get_or_create_user("a@example.com")
+    api_key, _ = database.create_api_key(user["id"])
+
+    queries = []
+    table = database.async_client.table
+    database.async_client.table = lambda name: queries.append(name) or table(name)
+
+    async def run():
+        return await asyncio.gather(*(database.averify_api_key(api_key) for _ in range(10)))
+
+    results = asyncio.run(run())
+    assert queries == ["api_keys"]
+    assert all(result["user_id"] == user["id"] for result in results)
+
+
+def test_user_store_creation_is_per_user(monkeypatch):
+    """Test concurrent requests of a user create one store, without waiting on other users' creations."""
+    from types import SimpleNamespace
+    from src.api import gemini_service as gemini_module
+
+    monkeypatch.setattr(settings, "store_partitioning", "user")
+    monkeypatch.setattr(settings, "async_io", True)
+    assigned = {}
+
+    async def aget_user_store(user_id):
+        return assigned.get(user_id)
+
+    async def aset_user_store(user_id, store_name):
+        return assigned.setdefault(user_id, store_name)
+
+    monkeypatch.setattr(gemini_module.db, "aget_user_store", aget_user_store)
+    monkeypatch.setattr(gemini_module.db, "aset_user_store", aset_user_store)
+    created, finished = [], []
+
+    async def create(config):
+        user_id = config["display_name"].removeprefix("context-api-user-")
+        created.append(user_id)
+        await asyncio.sleep(0.2 if user_id == "slow-1" else 0)
+        return SimpleNamespace(name=f"fileSearchStores/{user_id}")
+
+    service = GeminiService()
+    service.client = SimpleNamespace(aio=SimpleNamespace(file_search_stores=SimpleNamespace(create=create)))
+
+    async def lookup(user_id):
+        store_name = await service.astore_for_user(user_id)
+        finished.append(user_id)
+        return store_name
+
+    async def run():
+        return await asyncio.gather(*(lookup("slow-1") for _ in range(3)), lookup("fast-2"))
+
+    results = asyncio.run(run())
+    assert results == ["fileSearchStores/slow-1"] * 3 + ["fileSearchStores/fast-2"]
+    assert sorted(created) == ["fast-2", "slow-1"]
+    assert finished[0] == "fast-2"
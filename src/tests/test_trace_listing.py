@@ -0,0 +1,88 @@
+import base64
+import gzip
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.fakes import FakeAsyncSupabaseClient, FakeSupabaseClient, FakeTables
+from src.api.auth import get_user_id
+from src.api.config import settings
+from src.api.database import db
+from src.api.main import app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """A client for user-1, who has five traces; user-2 has one."""
+    tables = FakeTables()
+    rows = tables.table("trace_metadata")
+    for i in range(5):
+        rows.append(tables.new_row({"user_id": "user-1", "trace_id": f"t{i}", "status": "indexed", "created_at": f"2024-01-0{i + 1}T00:00:00"}))
+    rows.append(tables.new_row({"user_id": "user-2", "trace_id": "other", "status": "indexed"}))
+    monkeypatch.setattr(db, "_client", FakeSupabaseClient(tables=tables))
+    monkeypatch.setattr(db, "async_client", FakeAsyncSupabaseClient(tables=tables))
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_list_traces_pages_by_cursor(client):
+    """Test listing walks the user's traces newest first, page by page, until there is no cursor."""
+    seen = []
+    params = {"limit": 2}
+    while True:
+        body = client.get("/api/v1/traces", params=params).json()
+        assert len(body["traces"]) <= 2
+        seen.extend(trace["trace_id"] for trace in body["traces"])
+        if body["next_cursor"] is None:
+            break
+        params["cursor"] = body["next_cursor"]
+    assert seen == ["t4", "t3", "t2", "t1", "t0"]
+    assert client.get("/api/v1/traces", params={"cursor": "not-a-cursor"}).status_code == 400
+
+
+def test_export_streams_gzip_ndjson(client, monkeypatch):
+    """Test the export holds every one of the user's traces, across several pages."""
+    monkeypatch.setattr(settings, "trace_export_page_size", 2)
+    response = client.get("/api/v1/traces/export")
+    assert response.headers["content-type"] == "application/gzip"
+    lines = [orjson.loads(line) for line in gzip.decompress(response.content).splitlines()]
+    assert [line["trace_id"] for line in lines] == ["t4", "t3", "t2", "t1", "t0"]
+    assert set(lines[0]) == {
+        "trace_id", "provider", "model", "success", "tokens_used", "latency_ms",
+        "status", "hit_count", "size_bytes", "created_at", "last_seen_at"
+    }
+
+
+def test_cursors_are_validated(client):
+    """Test a cursor whose timestamp or id is malformed gets 400 instead of reaching the database."""
+    def cursor(value) -> str:
+        return base64.urlsafe_b64encode(orjson.dumps(value)).decode()
+
+    row_id = "00000000-0000-0000-0000-000000000001"
+    assert client.get("/api/v1/traces", params={"cursor": cursor(["2024-01-03T00:00:00", row_id])}).status_code == 200
+    for bad in (["yesterday", row_id], ["2024-01-03T00:00:00", "1"], [5, row_id], ["2024-01-03T00:00:00"], {}):
+        assert client.get("/api/v1/traces", params={"cursor": cursor(bad)}).status_code == 400
+
+
+def test_traces_without_created_at_are_listed_last(client, monkeypatch):
+    """Test pages walk traces without a created_at after the others, and a cursor can point at one."""
+    rows = db.client.tables.table("trace_metadata")
+    for name in ("n0", "n1"):
+        rows.append(db.client.tables.new_row({"user_id": "user-1", "trace_id": name, "status": "indexed", "created_at": None}))
+    seen = []
+    params = {"limit": 2}
+    while True:
+        body = client.get("/api/v1/traces", params=params).json()
+        seen.extend(trace["trace_id"] for trace in body["traces"])
+        if body["next_cursor"] is None:
+            break
+        params["cursor"] = body["next_cursor"]
+    assert seen == ["t4", "t3", "t2", "t1", "t0", "n1", "n0"]
+
+    monkeypatch.setattr(settings, "trace_export_page_size", 3)
+    lines = gzip.decompress(client.get("/api/v1/traces/export").content).splitlines()
+    assert [orjson.loads(line)["trace_id"] for line in lines] == seen
@@ -0,0 +1,114 @@
+import pytest
+from src.api.trace_queue import TraceQueue, QueueFullError
+
+
+def make_queue(tmp_path, max_size=10, max_attempts=3):
+    return TraceQueue(path=str(tmp_path / "queue.db"), max_size=max_size, max_attempts=max_attempts)
+
+
+def test_put_get_ack(tmp_path):
+    """Test a queued trace is leased once and removed on ack."""
+    queue = make_queue(tmp_path)
+    queue.put("user-1", "trace-1", {"input": {"prompt": "hi"}}, {"model": "gpt-4"})
+    assert queue.size() == 1
+
+    item = queue.get(timeout=0)
+    assert item["trace_id"] == "trace-1"
+    assert item["trace_data"] == {"input": {"prompt": "hi"}}
+    assert queue.get(timeout=0) is None
+
+    queue.ack(item["id"])
+    assert queue.size() == 0
+
+
+def test_queue_is_bounded(tmp_path):
+    """Test put rejects traces once the queue is at capacity."""
+    queue = make_queue(tmp_path, max_size=2)
+    queue.put("user-1", "trace-1", {}, {})
+    queue.put("user-1", "trace-2", {}, {})
+    with pytest.raises(QueueFullError):
+        queue.put("user-1", "trace-3", {}, {})
+
+
+def test_nack_parks_after_max_attempts(tmp_path):
+    """Test failed traces are retried later and parked after the last attempt."""
+    queue = make_queue(tmp_path, max_attempts=1)
+    queue.put("user-1", "trace-1", {}, {})
+    item = queue.get(timeout=0)
+    queue.nack(item["id"], "upstream error")
+    assert queue.size() == 0
+    assert queue.get(timeout=0) is None
+
+
+def test_queue_survives_restart(tmp_path):
+    """Test leased but unacknowledged traces are redelivered after a restart."""
+    queue = make_queue(tmp_path)
+    queue.put("user-1", "trace-1", {}, {})
+    assert queue.get(timeout=0)["trace_id"] == "trace-1"
+
+    reopened = make_queue(tmp_path)
+    item = reopened.get(timeout=0)
+    assert item["trace_id"] == "trace-1"
+
+
+def test_put_many_and_get_batch(tmp_path):
+    """Test a batch is enqueued atomically and leased in insertion order."""
+    queue = make_queue(tmp_path, max_size=3)
+    queue.put_many("user-1", ["t1", "t2", "t3"], [{}, {}, {}], [{}, {}, {}])
+    with pytest.raises(QueueFullError):
+        queue.put_many("user-1", ["t4"], [{}], [{}])
+
+    items = queue.get_batch(2, timeout=0)
+    assert [item["trace_id"] for item in items] == ["t1", "t2"]
+    assert [item["trace_id"] for item in queue.get_batch(10, timeout=0)] == ["t3"]
+
+
+def test_status_of_queued_and_parked_traces(tmp_path):
+    """Test the queue reports its own traces as queued, then failed once parked."""
+    queue = make_queue(tmp_path, max_attempts=1)
+    queue.put("user-1", "trace-1", {}, {})
+    assert queue.status("user-1", "trace-1") == "queued"
+    assert queue.status("user-2", "trace-1") is None
+
+    queue.nack(queue.get(timeout=0)["id"], "upstream error")
+    assert queue.status("user-1", "trace-1") == "failed"
+
+
+def test_processes_sharing_a_queue_lease_different_items(tmp_path):
+    """Test a second queue on the same file neither leases nor requeues items another live process holds."""
+    queue = make_queue(tmp_path)
+    queue.put_many("user-1", ["trace-1", "trace-2"], [{}, {}], [{}, {}])
+    assert queue.get(timeout=0)["trace_id"] == "trace-1"
+    # Pretend the lease belongs to another, still running, process
+    queue._connect().execute("UPDATE trace_queue SET owner = 1 WHERE status = 'inflight'")
+
+    other = make_queue(tmp_path)
+    assert [item["trace_id"] for item in other.get_batch(10, timeout=0)] == ["trace-2"]
+
+
+def test_expired_leases_are_handed_out_again(tmp_path):
+    """Test an item whose lease ran out is leased again, even when its owner's PID belongs to a live process."""
+    queue = TraceQueue(path=str(tmp_path / "queue.db"), max_size=10, max_attempts=3, lease_seconds=60)
+    queue.put("user-1", "trace-1", {}, {})
+    assert queue.get(timeout=0)["trace_id"] == "trace-1"
+    # Leased by another process that is still running, or by a dead one whose PID was reused
+    queue._connect().execute("UPDATE trace_queue SET owner = 1 WHERE status = 'inflight'")
+
+    other = make_queue(tmp_path)
+    assert other.get(timeout=0) is None
+    other._connect().execute("UPDATE trace_queue SET leased_until = leased_until - 61")
+    assert other.get(timeout=0)["trace_id"] == "trace-1"
+
+
+def test_parked_traces_are_purged_after_retention(tmp_path):
+    """Test parked traces are counted, and deleted once older than the failed retention."""
+    queue = TraceQueue(path=str(tmp_path / "queue.db"), max_size=10, max_attempts=1, failed_retention_seconds=60)
+    queue.put("user-1", "trace-1", {}, {})
+    queue.nack(queue.get(timeout=0)["id"], "upstream error")
+    assert queue.failed_count() == 1
+    assert queue.purge_failed() == 0
+
+    queue._connect().execute("UPDATE trace_queue SET failed_at = failed_at - 61")
+    assert queue.purge_failed() == 1
+    assert queue.failed_count() == 0
+    assert queue.status("user-1", "trace-1") is None
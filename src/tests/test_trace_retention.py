@@ -0,0 +1,160 @@
+import asyncio
+import time
+
+import pytest
+
+from benchmarks.fakes import FakeAsyncSupabaseClient, FakeSupabaseClient, FakeTables
+from src.api import trace_queue, trace_retention
+from src.api.config import settings
+from src.api.database import db
+from src.api.trace_queue import content_trace_id
+from src.api.trace_retention import Compactor
+from src.tests.test_context_modes import _service
+
+
+def _trace(prompt: str, text: str = "done") -> dict:
+    return {"input": {"prompt": prompt}, "output": {"text": text}, "metadata": {"provider": "openai", "model": "gpt-4"}}
+
+
+@pytest.fixture
+def upstreams(monkeypatch):
+    """Fake Supabase and Gemini behind the trace write path and the compactor."""
+    monkeypatch.setattr(settings, "operation_poll_min_interval", 0.01)
+    tables = FakeTables()
+    monkeypatch.setattr(db, "_client", FakeSupabaseClient(tables=tables))
+    monkeypatch.setattr(db, "async_client", FakeAsyncSupabaseClient(tables=tables))
+    service = _service(monkeypatch)
+    monkeypatch.setattr(trace_queue, "gemini_service", service)
+    monkeypatch.setattr(trace_retention, "gemini_service", service)
+    yield tables.table("trace_metadata"), service.client
+    service.tracker.stop()
+
+
+def _wait_indexed(rows):
+    deadline = time.monotonic() + 5
+    while any(row["status"] == "pending" for row in rows):
+        assert time.monotonic() < deadline, "traces were not indexed"
+        time.sleep(0.01)
+
+
+def test_content_trace_id_ignores_formatting_and_metadata():
+    """Test identical traces get one trace_id, whatever their whitespace, unset fields and latency."""
+    trace = _trace("reset a password")
+    same = {"input": {"prompt": " reset a password\n", "system_prompt": None}, "output": {"text": "done"}, "metadata": {"latency_ms": 5}}
+    assert content_trace_id("user-1", trace) == content_trace_id("user-1", same)
+    assert content_trace_id("user-1", trace) != content_trace_id("user-2", trace)
+    assert content_trace_id("user-1", trace) != content_trace_id("user-1", _trace("reset a password", "other"))
+
+
+def test_traces_with_wide_integers_are_stored(upstreams):
+    """Test a trace whose parameters hold an integer wider than 64 bits gets an id and is uploaded."""
+    rows, gemini = upstreams
+    trace = _trace("reset a password")
+    trace["input"]["parameters"] = {"seed": 2 ** 70}
+    trace_id = content_trace_id("user-1", trace)
+    assert trace_id != content_trace_id("user-1", _trace("reset a password"))
+
+    asyncio.run(trace_queue.awrite_trace("user-1", trace_id, trace, {}))
+    assert len(gemini.documents) == 1
+    assert [row["trace_id"] for row in rows] == [trace_id]
+
+
+def test_retried_metadata_writes_keep_the_status(upstreams):
+    """Test a new metadata row starts pending, and writing it again does not reset an indexed row."""
+    rows, _ = upstreams
+    assert db.record_traces("user-1", [("t1", {"provider": "openai"})]) == ["t1"]
+    assert rows[0]["status"] == "pending"
+    db.update_trace_status(["t1"], "indexed", "documents/d1")
+    assert db.record_traces("user-1", [("t1", {"provider": "openai"})]) == []
+    assert asyncio.run(db.arecord_traces("user-1", [("t1", {"provider": "openai"})])) == []
+    assert len(rows) == 1
+    assert rows[0]["status"] == "indexed"
+
+
+def test_repeats_are_counted_not_uploaded(upstreams):
+    """Test storing a trace again, alone or in a batch, increments its hit count without another upload."""
+    rows, gemini = upstreams
+    trace = _trace("reset a password")
+    trace_id = content_trace_id("user-1", trace)
+
+    async def run():
+        await trace_queue.awrite_trace("user-1", trace_id, dict(trace), {"size_bytes": 100})
+        await trace_queue.awrite_trace("user-1", trace_id, dict(trace), {"size_bytes": 100})
+        other = _trace("rotate a key")
+        other_id = content_trace_id("user-1", other)
+        return await trace_queue.awrite_traces(
+            "user-1", [trace_id, other_id, other_id], [dict(trace), dict(other), dict(other)], [{}, {}, {}]
+        )
+
+    trace_ids = asyncio.run(run())
+    assert trace_ids[0] == trace_id and trace_ids[1] == trace_ids[2]
+    # One document for the first trace and one for the batch, which only held the new trace
+    assert len(gemini.documents) == 2
+    assert {row["trace_id"]: row["hit_count"] for row in rows} == {trace_id: 3, trace_ids[1]: 2}
+
+
+def test_compaction_evicts_least_recently_seen(upstreams, monkeypatch):
+    """Test compaction evicts past the count and age limits, deleting documents once none of their traces remain."""
+    rows, gemini = upstreams
+    traces = {name: _trace(name) for name in "abcd"}
+    ids = {name: content_trace_id("user-1", trace) for name, trace in traces.items()}
+
+    async def store():
+        for name in "ab":
+            await trace_queue.awrite_trace("user-1", ids[name], traces[name], {})
+        # c and d share a document
+        await trace_queue.awrite_traces("user-1", [ids["c"], ids["d"]], [traces["c"], traces["d"]], [{}, {}])
+
+    asyncio.run(store())
+    _wait_indexed(rows)
+    documents = {row["trace_id"]: row["document_name"] for row in rows}
+    # Least recently seen first: a, c, b, d
+    for day, name in enumerate("acbd", 1):
+        next(row for row in rows if row["trace_id"] == ids[name])["last_seen_at"] = f"2020-01-0{day}T00:00:00+00:00"
+
+    compactor = Compactor(interval=3600, batch_size=1)
+    monkeypatch.setattr(settings, "trace_retention_max_traces", 2)
+    assert asyncio.run(compactor.compact()) == 2
+    assert {row["trace_id"] for row in rows} == {ids["b"], ids["d"]}
+    # c's document still holds d
+    assert sorted(gemini.documents) == sorted([documents[ids["b"]], documents[ids["d"]]])
+
+    monkeypatch.setattr(settings, "trace_retention_max_traces", 0)
+    monkeypatch.setattr(settings, "trace_retention_days", 30)
+    assert asyncio.run(compactor.compact()) == 2
+    assert rows == [] and gemini.documents == []
+
+
+def test_stale_pending_uploads_are_retried_and_evicted(upstreams, monkeypatch):
+    """Test a trace left pending past the lease is uploaded again when stored again, and can be evicted."""
+    rows, gemini = upstreams
+    trace = _trace("reset a password")
+    trace_id = content_trace_id("user-1", trace)
+    # A writer that died between recording the trace and uploading it
+    db.record_traces("user-1", [(trace_id, {})])
+    assert db.record_traces("user-1", [(trace_id, {})]) == []
+    assert rows[0]["hit_count"] == 2
+
+    rows[0]["upload_started_at"] = "2020-01-01T00:00:00+00:00"
+    assert db.record_traces("user-1", [(trace_id, {})]) == [trace_id]
+    assert rows[0]["hit_count"] == 2
+
+    rows[0]["upload_started_at"] = rows[0]["last_seen_at"] = "2020-01-01T00:00:00+00:00"
+    monkeypatch.setattr(settings, "trace_retention_days", 30)
+    assert asyncio.run(Compactor(interval=3600, batch_size=10).compact()) == 1
+    assert rows == []
+
+
+def test_indexed_traces_without_a_document_are_kept(upstreams, monkeypatch):
+    """Test retention skips traces indexed before their document was recorded, whose document it cannot delete."""
+    rows, _ = upstreams
+    db.record_traces("user-1", [("old", {})])
+    db.update_trace_status(["old"], "indexed")
+    rows[0]["last_seen_at"] = "2020-01-01T00:00:00+00:00"
+    monkeypatch.setattr(settings, "trace_retention_days", 30)
+    monkeypatch.setattr(settings, "retrieval_backend", "gemini")
+    assert db.expired_traces(10) == []
+
+    # The local index removes traces by trace_id
+    monkeypatch.setattr(settings, "retrieval_backend", "local")
+    assert [row["trace_id"] for row in db.expired_traces(10)] == ["old"]
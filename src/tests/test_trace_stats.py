@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+from src.api.trace_stats import (
+    LATENCY_BOUNDS_MS,
+    histogram_percentile,
+    parse_window,
+    summarize,
+    window_start,
+)
+
+
+def _histogram(**slots):
+    histogram = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+    for slot, count in slots.items():
+        histogram[int(slot[1:])] = count
+    return histogram
+
+
+def _row(bucket, provider, model, traces, successes, tokens, histogram, max_ms):
+    return {
+        "bucket": bucket, "provider": provider, "model": model, "traces": traces, "successes": successes,
+        "tokens_used": tokens, "latency_count": sum(histogram), "latency_sum_ms": 300 * sum(histogram),
+        "latency_max_ms": max_ms, "latency_histogram": histogram,
+    }
+
+
+def test_window_start_aligns_to_buckets():
+    """Test windows are parsed and their start is truncated to the bucket size."""
+    now = datetime(2024, 5, 10, 14, 35)
+    assert parse_window("24h") == timedelta(hours=24)
+    assert parse_window("7d") == timedelta(days=7)
+    assert window_start(now, timedelta(hours=24), "hour") == datetime(2024, 5, 9, 14, 0)
+    assert window_start(now, timedelta(days=7), "day") == datetime(2024, 5, 3)
+
+
+def test_histogram_percentile_interpolates():
+    """Test percentiles are interpolated within a slot and capped by the observed maximum."""
+    # 100 traces between 250 and 500 ms
+    histogram = _histogram(s3=100)
+    assert histogram_percentile(histogram, 50) == 375.0
+    assert histogram_percentile(histogram, 99, max_ms=400) == 398.5
+    assert histogram_percentile([0] * 11, 50) is None
+    # Over the last bound, the maximum is the only upper limit known
+    assert histogram_percentile(_histogram(s10=4), 50, max_ms=90000) == 75000.0
+
+
+def test_summarize_groups_and_series():
+    """Test rollup rows combine into totals, per-model groups and a per-bucket series."""
+    rows = [
+        _row("2024-05-10T13:00:00", "openai", "gpt-4", 10, 9, 1000, _histogram(s2=10), 240),
+        _row("2024-05-10T14:00:00", "openai", "gpt-4", 30, 27, 3000, _histogram(s3=30), 480),
+        _row("2024-05-10T14:00:00", "anthropic", "claude-3-5-sonnet", 5, 5, 800, _histogram(s4=5), 900),
+    ]
+
+    stats = summarize(rows, "model")
+    assert stats["totals"]["traces"] == 45
+    assert stats["totals"]["success_rate"] == round(41 / 45, 4)
+    assert stats["totals"]["latency"]["max_ms"] == 900
+    assert [(g["provider"], g["model"], g["traces"]) for g in stats["groups"]] == [
+        ("openai", "gpt-4", 40), ("anthropic", "claude-3-5-sonnet", 5)
+    ]
+    assert [b["traces"] for b in stats["series"]] == [10, 35]
+
+    by_provider = summarize(rows, "provider")
+    assert [(g["provider"], g["model"]) for g in by_provider["groups"]] == [("openai", None), ("anthropic", None)]
+
+
+def test_stats_endpoint_reads_rollups(monkeypatch):
+    """Test the endpoint picks the rollup table by window and rejects over-long hourly windows."""
+    from fastapi.testclient import TestClient
+    from src.api.auth import get_user_id
+    from src.api.main import app
+    from src.api.routes import traces as trace_routes
+
+    calls = []
+
+    async def aget_trace_stats(user_id, granularity, start):
+        calls.append((user_id, granularity))
+        return [_row("2024-05-10T14:00:00", "openai", "gpt-4", 2, 1, 50, _histogram(s1=2), 80)]
+
+    monkeypatch.setattr(trace_routes.db, "aget_trace_stats", aget_trace_stats)
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        client = TestClient(app)
+        response = client.get("/api/v1/traces/stats")
+        assert response.status_code == 200
+        assert response.json()["granularity"] == "hour"
+        assert response.json()["groups"][0]["success_rate"] == 0.5
+
+        assert client.get("/api/v1/traces/stats?window=30d").json()["granularity"] == "day"
+        assert client.get("/api/v1/traces/stats?window=60d&granularity=hour").status_code == 400
+        assert calls == [("user-1", "hour"), ("user-1", "day")]
+    finally:
+        app.dependency_overrides.clear()
@@ -0,0 +1,120 @@
+import numpy as np
+from src.api.vector_index import VectorIndex, HashingEmbedder, UserIndex
+
+
+def make_trace(prompt, output="ok"):
+    return {
+        "input": {"prompt": prompt, "parameters": {}},
+        "output": {"text": output},
+        "metadata": {"provider": "openai", "model": "gpt-4", "success": True}
+    }
+
+
+def test_hashing_embedder_is_deterministic():
+    """Test the stub embedder returns identical normalized vectors for identical text."""
+    embedder = HashingEmbedder(dim=64)
+    vectors = embedder.embed(["write a story", "write a story", ""])
+    assert vectors.shape == (3, 64)
+    assert np.allclose(vectors[0], vectors[1])
+    assert np.isclose(np.linalg.norm(vectors[0]), 1.0)
+
+
+def test_search_ranks_similar_traces_first(tmp_path):
+    """Test a user's most similar trace comes back first with a real score."""
+    index = VectorIndex(str(tmp_path), HashingEmbedder(dim=256))
+    index.add_traces("user-1", ["t1", "t2", "t3"], [
+        make_trace("write a short story about a dragon"),
+        make_trace("translate this sentence into french"),
+        make_trace("summarize the quarterly sales report"),
+    ])
+
+    results = index.search("user-1", "write a story about a dragon", k=2)
+    assert [r["trace_id"] for r in results][0] == "t1"
+    assert results[0]["relevance_score"] > results[1]["relevance_score"]
+    assert results[0]["output"] == "ok"
+
+
+def test_users_are_isolated_and_persisted(tmp_path):
+    """Test searches only see the caller's traces and survive a reload."""
+    index = VectorIndex(str(tmp_path), HashingEmbedder(dim=64))
+    index.add_traces("user-1", ["t1"], [make_trace("hello world")])
+    assert index.search("user-2", "hello world", k=5) == []
+
+    reloaded = VectorIndex(str(tmp_path), HashingEmbedder(dim=64))
+    assert [r["trace_id"] for r in reloaded.search("user-1", "hello world", k=5)] == ["t1"]
+
+
+def test_ivf_search_matches_exact_neighbour(tmp_path):
+    """Test the IVF partition still finds an exact duplicate."""
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(300, 16)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = UserIndex(str(tmp_path), dim=16, ivf_min_size=100, nprobe=4)
+    index.add(vectors, [{"trace_id": str(i)} for i in range(300)])
+
+    score, record = index.search(vectors[42], k=1)[0]
+    assert record["trace_id"] == "42"
+    assert score > 0.99
+
+
+def test_remove_rewrites_index(tmp_path):
+    """Test removed traces are gone from search, the IVF partition and the files."""
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(300, 16)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = UserIndex(str(tmp_path), dim=16, ivf_min_size=100, nprobe=4)
+    index.add(vectors, [{"trace_id": str(i)} for i in range(300)])
+
+    assert index.remove([str(i) for i in range(0, 300, 2)] + ["missing"]) == 150
+    assert index.search(vectors[42], k=1)[0][1]["trace_id"] != "42"
+    score, record = index.search(vectors[43], k=1)[0]
+    assert record["trace_id"] == "43"
+    assert score > 0.99
+
+    reloaded = UserIndex(str(tmp_path), dim=16)
+    assert len(reloaded) == 150
+    assert reloaded.search(vectors[43], k=1)[0][1]["trace_id"] == "43"
+
+
+def test_gemini_service_local_backend(tmp_path, monkeypatch):
+    """Test storing and retrieving traces end to end without Gemini."""
+    from src.api.config import settings
+    from src.api.gemini_service import GeminiService
+
+    monkeypatch.setattr(settings, "retrieval_backend", "local")
+    monkeypatch.setattr(settings, "vector_index_path", str(tmp_path))
+    monkeypatch.setattr(settings, "gemini_api_key", None)
+    service = GeminiService()
+    service.initialize()
+
+    service.store_traces("user-1", [make_trace("write a poem about the sea", "waves")])
+    result = service.retrieve_context("user-1", "write a poem about the sea", "gpt-4")
+    assert result["relevant_traces"][0]["output"] == "waves"
+    assert "waves" in result["enhanced_context"]
+
+
+def test_interrupted_writes_are_recovered_on_load(tmp_path):
+    """Test rows a crash left in only one file are dropped, and a committed rewrite is finished."""
+    index = UserIndex(str(tmp_path), dim=4)
+    vectors = np.eye(4, dtype=np.float32)
+    index.add(vectors[:2], [{"trace_id": "a"}, {"trace_id": "b"}])
+
+    # An add that wrote its vectors and half a record, then crashed
+    with open(tmp_path / "vectors.f32", "ab") as f:
+        f.write(vectors[2].tobytes())
+    with open(tmp_path / "traces.jsonl", "a") as f:
+        f.write('{"trace_id": "c"')
+    reloaded = UserIndex(str(tmp_path), dim=4)
+    assert len(reloaded) == 2
+    assert reloaded.search(vectors[1], k=1)[0][1]["trace_id"] == "b"
+    reloaded.add(vectors[3:], [{"trace_id": "d"}])
+    assert UserIndex(str(tmp_path), dim=4).search(vectors[3], k=1)[0][1]["trace_id"] == "d"
+
+    # A remove that committed its rewrite but crashed before moving the records into place
+    reloaded.remove(["a"])
+    (tmp_path / "traces.jsonl").rename(tmp_path / "traces.jsonl.tmp")
+    with open(tmp_path / "traces.jsonl", "w") as f:
+        f.write('{"trace_id": "a"}\n{"trace_id": "b"}\n{"trace_id": "d"}\n')
+    (tmp_path / "manifest.json").write_text('{"count": 2, "compacting": true}')
+    recovered = UserIndex(str(tmp_path), dim=4)
+    assert [recovered.search(v, k=1)[0][1]["trace_id"] for v in (vectors[1], vectors[3])] == ["b", "d"]
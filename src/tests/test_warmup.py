@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import pytest
+
+from src.api.warmup import Warmup
+
+
+def test_warmup_retries_until_ready():
+    """Test a failed warmup step is retried, and readiness reported meanwhile."""
+    calls = []
+
+    async def step():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError("upstream down")
+
+    async def run():
+        warmup = Warmup([step], retry_seconds=0.01)
+        assert warmup.status()["status"] == "starting"
+        warmup.start()
+        while warmup.error is None:
+            await asyncio.sleep(0)
+        assert warmup.status() == {"status": "failed", "attempts": 1, "error": "ConnectionError: upstream down"}
+        while not warmup.ready:
+            await asyncio.sleep(0.005)
+        return warmup
+
+    warmup = asyncio.run(run())
+    assert len(calls) == 2
+    assert warmup.status()["status"] == "ready"
+
+
+def test_store_name_is_cached_between_starts(tmp_path, monkeypatch):
+    """Test the File Search store found at one start is reused at the next without listing stores."""
+    from google import genai
+    from benchmarks.fakes import FakeGeminiClient
+    from src.api.config import settings
+    from src.api.gemini_service import GeminiService
+
+    monkeypatch.setattr(genai, "Client", lambda **kwargs: FakeGeminiClient(stores=1))
+    monkeypatch.setattr(settings, "retrieval_backend", "gemini")
+    monkeypatch.setattr(settings, "store_partitioning", "global")
+    monkeypatch.setattr(settings, "gemini_store_name", None)
+    monkeypatch.setattr(settings, "gemini_api_key", "key-1")
+    monkeypatch.setattr(settings, "store_name_cache_path", str(tmp_path / "store_name"))
+
+    first = GeminiService()
+    first.initialize()
+    assert first.store_name == first.client.stores[0].name
+
+    # The same project, which must not be listed again
+    client = FakeGeminiClient()
+    client.stores = list(first.client.stores)
+    client.file_search_stores.list = lambda: pytest.fail("stores were listed")
+    monkeypatch.setattr(genai, "Client", lambda **kwargs: client)
+    second = GeminiService()
+    second.initialize()
+    assert second.store_name == first.store_name
+
+
+def test_stale_store_name_is_not_reused(tmp_path, monkeypatch):
+    """Test a remembered store is ignored under another API key, and replaced once it has been deleted."""
+    from google import genai
+    from benchmarks.fakes import FakeGeminiClient
+    from src.api.config import settings
+    from src.api.gemini_service import GeminiService
+
+    client = FakeGeminiClient(stores=1)
+    monkeypatch.setattr(genai, "Client", lambda **kwargs: client)
+    monkeypatch.setattr(settings, "retrieval_backend", "gemini")
+    monkeypatch.setattr(settings, "store_partitioning", "global")
+    monkeypatch.setattr(settings, "gemini_store_name", None)
+    monkeypatch.setattr(settings, "gemini_api_key", "key-1")
+    monkeypatch.setattr(settings, "store_name_cache_path", str(tmp_path / "store_name"))
+    GeminiService().initialize()
+
+    # Another project, whose stores are listed
+    other = FakeGeminiClient(stores=1)
+    monkeypatch.setattr(genai, "Client", lambda **kwargs: other)
+    monkeypatch.setattr(settings, "gemini_api_key", "key-2")
+    service = GeminiService()
+    service.initialize()
+    assert service.store_name == other.stores[0].name
+
+    # Its store is deleted, and the next start creates a new one
+    other.stores.clear()
+    service = GeminiService()
+    service.initialize()
+    assert service.store_name == other.stores[0].name
+    assert GeminiService()._cached_store_name() == other.stores[0].name
+
+
+def test_concurrent_first_requests_initialize_once(monkeypatch):
+    """Test requests arriving before initialization wait on one worker thread instead of one each."""
+    from src.api.gemini_service import GeminiService
+
+    calls = []
+    service = GeminiService()
+
+    def initialize():
+        calls.append(1)
+        time.sleep(0.05)
+        service.initialized = True
+
+    monkeypatch.setattr(service, "initialize", initialize)
+
+    async def run():
+        await asyncio.gather(*(service.ainitialize() for _ in range(10)))
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_ready_is_503_until_warmed_up(monkeypatch):
+    """Test /ready answers 503 while starting, and 200 once warmed up, while /health always answers."""
+    from fastapi.testclient import TestClient
+    from src.api import main
+
+    monkeypatch.setattr(main, "warmup", Warmup([]))
+    client = TestClient(main.app)
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "starting"
+    assert client.get("/health").status_code == 200
+
+    main.warmup.ready = True
+    main.warmup.seconds = 0.5
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "warmup_seconds": 0.5}
@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+
+import msgpack
+import pytest
+import zstandard
+from fastapi.testclient import TestClient
+
+from src.api.auth import get_user_id
+from src.api.config import settings
+from src.api.main import app
+from src.api.routes import context as context_routes
+from src.api.wire import WireMiddleware
+from src.tests.test_context_modes import _service
+
+_BODY = {"prompt": "reset a password", "provider": "openai", "model": "gpt-4", "mode": "retrieve_only"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(settings, "rate_limit_enabled", False)
+    monkeypatch.setattr(context_routes, "gemini_service", _service(monkeypatch, chunks=3, chunk_chars=800))
+    app.dependency_overrides[get_user_id] = lambda: "user-1"
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_msgpack_and_zstd_round_trip(client):
+    """Test a zstd-compressed MessagePack request gets a zstd-compressed MessagePack response."""
+    response = client.post(
+        "/api/v1/context/retrieve",
+        content=zstandard.ZstdCompressor().compress(msgpack.packb(_BODY)),
+        headers={
+            "Content-Type": "application/msgpack",
+            "Content-Encoding": "zstd",
+            "Accept": "application/msgpack",
+            "Accept-Encoding": "gzip, zstd",
+        },
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/msgpack"
+    assert response.headers["content-encoding"] == "zstd"
+    assert "Accept-Encoding" in response.headers["vary"]
+    body = msgpack.unpackb(response.content)
+    assert body["relevant_traces"][0]["trace_id"] == "fake-0"
+
+
+def test_json_responses_are_gzipped_when_large(client):
+    """Test gzip is used when zstd is not accepted, and small responses and plain requests are left alone."""
+    response = client.post(
+        "/api/v1/context/retrieve",
+        content=gzip.compress(msgpack.packb(_BODY)),
+        headers={"Content-Type": "application/msgpack", "Content-Encoding": "gzip", "Accept-Encoding": "gzip, zstd;q=0"},
+    )
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json()["relevant_traces"][0]["trace_id"] == "fake-0"
+
+    response = client.get("/health", headers={"Accept-Encoding": "gzip, zstd"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert client.get("/openapi.json").status_code == 200
+
+
+def test_undecodable_and_oversized_bodies_are_refused(client):
+    """Test malformed bodies get 400, unknown codings 415, and bodies inflating past the limit 413."""
+    headers = {"Content-Type": "application/msgpack"}
+    assert client.post("/api/v1/context/retrieve", content=b"\xc1", headers=headers).status_code == 400
+    headers["Content-Encoding"] = "zstd"
+    assert client.post("/api/v1/context/retrieve", content=b"not zstd", headers=headers).status_code == 400
+    headers["Content-Encoding"] = "br"
+    assert client.post("/api/v1/context/retrieve", content=b"", headers=headers).status_code == 415
+
+    # 64 MiB once decompressed, past the default wire_max_request_bytes
+    bomb = zstandard.ZstdCompressor().compress(msgpack.packb({**_BODY, "prompt": "a" * (64 * 1024 * 1024)}))
+    headers["Content-Encoding"] = "zstd"
+    response = client.post("/api/v1/context/retrieve", content=bomb, headers=headers)
+    assert response.status_code == 413
+
+
+def test_request_cut_short_is_not_dispatched():
+    """Test a client that disconnects mid-body gets no response, and the app never sees the partial body."""
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope)
+
+    messages = iter([
+        {"type": "http.request", "body": b"\x81", "more_body": True},
+        {"type": "http.disconnect"},
+    ])
+    sent = []
+
+    async def receive():
+        return next(messages)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": [(b"content-type", b"application/msgpack")]}
+    asyncio.run(WireMiddleware(app)(scope, receive, send))
+    assert calls == [] and sent == []
@@ -33,11 +33,288 @@ CREATE TABLE IF NOT EXISTS trace_metadata (
   success BOOLEAN,
   tokens_used INTEGER,
   latency_ms INTEGER,
+  status TEXT NOT NULL DEFAULT 'pending',  -- pending, indexed or failed
+  hit_count INTEGER NOT NULL DEFAULT 1,  -- times this trace (same content) was stored
+  last_seen_at TIMESTAMP DEFAULT NOW(),  -- when it was last stored; retention evicts by it
+  size_bytes INTEGER,  -- serialized size, for the retention size budget
+  document_name TEXT,  -- File Search document holding the trace, once indexed
+  upload_started_at TIMESTAMP DEFAULT NOW(),  -- when its latest upload began; a pending upload is leased from it
   created_at TIMESTAMP DEFAULT NOW()
 );
 
+-- Existing deployments: earlier traces were indexed before their row was written
+ALTER TABLE trace_metadata ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'indexed';
+ALTER TABLE trace_metadata ALTER COLUMN status SET DEFAULT 'pending';
+ALTER TABLE trace_metadata ADD COLUMN IF NOT EXISTS hit_count INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE trace_metadata ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP DEFAULT NOW();
+ALTER TABLE trace_metadata ADD COLUMN IF NOT EXISTS size_bytes INTEGER;
+ALTER TABLE trace_metadata ADD COLUMN IF NOT EXISTS document_name TEXT;
+ALTER TABLE trace_metadata ADD COLUMN IF NOT EXISTS upload_started_at TIMESTAMP DEFAULT NOW();
+
 -- Create indexes for trace_metadata
-CREATE INDEX IF NOT EXISTS idx_trace_metadata_user_id ON trace_metadata(user_id);
-CREATE INDEX IF NOT EXISTS idx_trace_metadata_trace_id ON trace_metadata(trace_id);
+-- A user's traces newest first, for keyset pagination (list_traces). Its user_id
+-- prefix also serves lookups by user, which had an index of their own.
+CREATE INDEX IF NOT EXISTS idx_trace_metadata_user_created ON trace_metadata(user_id, created_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_trace_metadata_user_id;
+-- Lets retried writes upsert on trace_id, and serves lookups by trace_id,
+-- which had a non-unique index of their own
+CREATE UNIQUE INDEX IF NOT EXISTS idx_trace_metadata_trace_id_unique ON trace_metadata(trace_id);
+DROP INDEX IF EXISTS idx_trace_metadata_trace_id;
 CREATE INDEX IF NOT EXISTS idx_trace_metadata_created_at ON trace_metadata(created_at);
+-- Retention walks each user's traces by when they were last seen (expired_traces)
+CREATE INDEX IF NOT EXISTS idx_trace_metadata_user_last_seen ON trace_metadata(user_id, last_seen_at DESC);
+CREATE INDEX IF NOT EXISTS idx_trace_metadata_document_name ON trace_metadata(document_name);
+
+
+-- user_stores table: the File Search store holding each user's traces
+CREATE TABLE IF NOT EXISTS user_stores (
+  user_id UUID PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+  store_name TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT NOW()
+);
+
+
+-- Trace analytics rollups: per user, provider and model, per hour and per day.
+-- Kept up to date by a trigger on trace_metadata inserts, so /traces/stats reads
+-- a few rows per bucket instead of scanning raw traces, and by record_traces for
+-- repeats of a stored trace. A retried upload is counted once. The rollups
+-- outlive raw rows deleted by retention.
+
+-- Latency histogram slots: below 50 ms, 50-100 ms, ... , 60 s and over.
+-- The bounds must match LATENCY_BOUNDS_MS in src/api/trace_stats.py.
+CREATE OR REPLACE FUNCTION trace_latency_histogram(latencies INTEGER[]) RETURNS INTEGER[] AS $$
+  SELECT array_agg(coalesce(counts.n, 0)::INTEGER ORDER BY slot)
+  FROM generate_series(1, 11) AS slot
+  LEFT JOIN (
+    SELECT width_bucket(latency, ARRAY[50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]) + 1 AS slot,
+           count(*) AS n
+    FROM unnest(latencies) AS latency
+    WHERE latency IS NOT NULL
+    GROUP BY 1
+  ) AS counts USING (slot)
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION add_histograms(a INTEGER[], b INTEGER[]) RETURNS INTEGER[] AS $$
+  SELECT array_agg(coalesce(x, 0) + coalesce(y, 0) ORDER BY i)
+  FROM unnest(a, b) WITH ORDINALITY AS t(x, y, i)
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE TABLE IF NOT EXISTS trace_stats_hourly (
+  user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+  bucket TIMESTAMP NOT NULL,
+  provider TEXT NOT NULL DEFAULT '',
+  model TEXT NOT NULL DEFAULT '',
+  traces BIGINT NOT NULL DEFAULT 0,
+  successes BIGINT NOT NULL DEFAULT 0,
+  tokens_used BIGINT NOT NULL DEFAULT 0,
+  latency_count BIGINT NOT NULL DEFAULT 0,  -- traces that reported a latency
+  latency_sum_ms BIGINT NOT NULL DEFAULT 0,
+  latency_max_ms INTEGER,
+  latency_histogram INTEGER[] NOT NULL,
+  PRIMARY KEY (user_id, bucket, provider, model)
+);
+
+CREATE TABLE IF NOT EXISTS trace_stats_daily (
+  user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+  bucket TIMESTAMP NOT NULL,
+  provider TEXT NOT NULL DEFAULT '',
+  model TEXT NOT NULL DEFAULT '',
+  traces BIGINT NOT NULL DEFAULT 0,
+  successes BIGINT NOT NULL DEFAULT 0,
+  tokens_used BIGINT NOT NULL DEFAULT 0,
+  latency_count BIGINT NOT NULL DEFAULT 0,
+  latency_sum_ms BIGINT NOT NULL DEFAULT 0,
+  latency_max_ms INTEGER,
+  latency_histogram INTEGER[] NOT NULL,
+  PRIMARY KEY (user_id, bucket, provider, model)
+);
+
+CREATE OR REPLACE FUNCTION rollup_trace(
+  p_user_id UUID, traced_at TIMESTAMP, p_provider TEXT, p_model TEXT,
+  p_success BOOLEAN, p_tokens_used INTEGER, p_latency_ms INTEGER
+) RETURNS void AS $$
+DECLARE
+  new_histogram INTEGER[] := trace_latency_histogram(ARRAY[p_latency_ms]);
+  new_latency_count INTEGER := CASE WHEN p_latency_ms IS NULL THEN 0 ELSE 1 END;
+BEGIN
+  INSERT INTO trace_stats_hourly AS s (
+    user_id, bucket, provider, model, traces, successes, tokens_used,
+    latency_count, latency_sum_ms, latency_max_ms, latency_histogram
+  ) VALUES (
+    p_user_id, date_trunc('hour', traced_at), coalesce(p_provider, ''), coalesce(p_model, ''),
+    1, CASE WHEN p_success THEN 1 ELSE 0 END, coalesce(p_tokens_used, 0),
+    new_latency_count, coalesce(p_latency_ms, 0), p_latency_ms, new_histogram
+  )
+  ON CONFLICT (user_id, bucket, provider, model) DO UPDATE SET
+    traces = s.traces + EXCLUDED.traces,
+    successes = s.successes + EXCLUDED.successes,
+    tokens_used = s.tokens_used + EXCLUDED.tokens_used,
+    latency_count = s.latency_count + EXCLUDED.latency_count,
+    latency_sum_ms = s.latency_sum_ms + EXCLUDED.latency_sum_ms,
+    latency_max_ms = GREATEST(s.latency_max_ms, EXCLUDED.latency_max_ms),
+    latency_histogram = add_histograms(s.latency_histogram, EXCLUDED.latency_histogram);
+
+  INSERT INTO trace_stats_daily AS s (
+    user_id, bucket, provider, model, traces, successes, tokens_used,
+    latency_count, latency_sum_ms, latency_max_ms, latency_histogram
+  ) VALUES (
+    p_user_id, date_trunc('day', traced_at), coalesce(p_provider, ''), coalesce(p_model, ''),
+    1, CASE WHEN p_success THEN 1 ELSE 0 END, coalesce(p_tokens_used, 0),
+    new_latency_count, coalesce(p_latency_ms, 0), p_latency_ms, new_histogram
+  )
+  ON CONFLICT (user_id, bucket, provider, model) DO UPDATE SET
+    traces = s.traces + EXCLUDED.traces,
+    successes = s.successes + EXCLUDED.successes,
+    tokens_used = s.tokens_used + EXCLUDED.tokens_used,
+    latency_count = s.latency_count + EXCLUDED.latency_count,
+    latency_sum_ms = s.latency_sum_ms + EXCLUDED.latency_sum_ms,
+    latency_max_ms = GREATEST(s.latency_max_ms, EXCLUDED.latency_max_ms),
+    latency_histogram = add_histograms(s.latency_histogram, EXCLUDED.latency_histogram);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rollup_trace_metadata() RETURNS trigger AS $$
+BEGIN
+  PERFORM rollup_trace(
+    NEW.user_id, coalesce(NEW.created_at, NOW()), NEW.provider, NEW.model,
+    NEW.success, NEW.tokens_used, NEW.latency_ms
+  );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trace_metadata_rollup ON trace_metadata;
+CREATE TRIGGER trace_metadata_rollup
+  AFTER INSERT ON trace_metadata
+  FOR EACH ROW EXECUTE FUNCTION rollup_trace_metadata();
+
+-- Trace deduplication. trace_ids are derived from a trace's content (see
+-- content_trace_id in src/api/trace_queue.py), so storing a trace again conflicts
+-- on trace_id. Records a user's traces, given as a JSON array of
+-- {trace_id, provider, model, success, tokens_used, latency_ms, size_bytes}, and
+-- returns the trace_ids to upload: new traces, and earlier copies whose upload
+-- failed, or is still pending p_pending_lease after it began (its writer died).
+-- A repeat of a stored trace instead increments its hit_count, refreshes
+-- last_seen_at and is counted in the rollups.
+DROP FUNCTION IF EXISTS record_traces(UUID, JSONB);
+CREATE OR REPLACE FUNCTION record_traces(p_user_id UUID, p_traces JSONB, p_pending_lease INTERVAL)
+RETURNS TABLE (trace_id TEXT) AS $$
+#variable_conflict use_column
+DECLARE
+  t RECORD;
+  previous TEXT;
+  started TIMESTAMP;
+BEGIN
+  -- One row at a time, so that repeats within a batch are counted too
+  FOR t IN SELECT * FROM jsonb_to_recordset(p_traces) AS x(
+    trace_id TEXT, provider TEXT, model TEXT, success BOOLEAN,
+    tokens_used INTEGER, latency_ms INTEGER, size_bytes INTEGER
+  ) LOOP
+    INSERT INTO trace_metadata (user_id, trace_id, provider, model, success, tokens_used, latency_ms, size_bytes)
+    VALUES (p_user_id, t.trace_id, t.provider, t.model, coalesce(t.success, TRUE), t.tokens_used, t.latency_ms, t.size_bytes)
+    ON CONFLICT (trace_id) DO NOTHING;
+    IF FOUND THEN
+      trace_id := t.trace_id;
+      RETURN NEXT;
+      CONTINUE;
+    END IF;
+
+    SELECT m.status, m.upload_started_at INTO previous, started FROM trace_metadata m
+    WHERE m.trace_id = t.trace_id AND m.user_id = p_user_id
+    FOR UPDATE;
+    IF previous = 'failed' OR (previous = 'pending' AND started < NOW() - p_pending_lease) THEN
+      -- The earlier upload never landed: upload again, without counting a repeat
+      UPDATE trace_metadata m SET status = 'pending', last_seen_at = NOW(), upload_started_at = NOW()
+      WHERE m.trace_id = t.trace_id;
+      trace_id := t.trace_id;
+      RETURN NEXT;
+    ELSIF previous IS NOT NULL THEN
+      UPDATE trace_metadata m SET hit_count = m.hit_count + 1, last_seen_at = NOW() WHERE m.trace_id = t.trace_id;
+      PERFORM rollup_trace(p_user_id, NOW(), t.provider, t.model, coalesce(t.success, TRUE), t.tokens_used, t.latency_ms);
+    END IF;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Trace retention. Traces past the limits, least recently seen first: those
+-- last seen longer than p_max_age ago, and those beyond a user's p_max_traces
+-- or p_max_bytes most recently seen. A NULL limit is not enforced. Each user's
+-- traces are walked on idx_trace_metadata_user_last_seen, and the count limit
+-- only reads past a user's first p_max_traces entries; the size limit reads
+-- all of a user's entries. Traces still being indexed are not expired, unless
+-- their upload began more than p_pending_lease ago and never finished. With
+-- p_require_document, indexed traces whose File Search document is not known
+-- (indexed before document_name was recorded) are kept, since their document
+-- could not be deleted with them. The rollups are kept.
+DROP FUNCTION IF EXISTS expired_traces(INTERVAL, BIGINT, BIGINT, INTEGER);
+CREATE OR REPLACE FUNCTION expired_traces(
+  p_max_age INTERVAL, p_max_traces BIGINT, p_max_bytes BIGINT, p_limit INTEGER,
+  p_pending_lease INTERVAL, p_require_document BOOLEAN
+) RETURNS TABLE (user_id UUID, trace_id TEXT, document_name TEXT) AS $$
+  SELECT e.user_id, e.trace_id, e.document_name
+  FROM users u
+  CROSS JOIN LATERAL (
+    SELECT m.user_id, m.trace_id, m.document_name, m.status, m.last_seen_at, m.upload_started_at
+    FROM trace_metadata m
+    WHERE m.user_id = u.id AND m.last_seen_at < NOW() - p_max_age
+    UNION
+    (
+      SELECT m.user_id, m.trace_id, m.document_name, m.status, m.last_seen_at, m.upload_started_at
+      FROM trace_metadata m
+      WHERE m.user_id = u.id AND p_max_traces IS NOT NULL
+      ORDER BY m.last_seen_at DESC, m.trace_id
+      OFFSET p_max_traces
+    )
+    UNION
+    SELECT r.user_id, r.trace_id, r.document_name, r.status, r.last_seen_at, r.upload_started_at
+    FROM (
+      SELECT m.*, sum(coalesce(m.size_bytes, 0)) OVER (ORDER BY m.last_seen_at DESC, m.trace_id) AS retained_bytes
+      FROM trace_metadata m
+      WHERE m.user_id = u.id AND p_max_bytes IS NOT NULL
+    ) AS r
+    WHERE r.retained_bytes > p_max_bytes
+  ) AS e
+  WHERE (e.status <> 'pending' OR e.upload_started_at < NOW() - p_pending_lease)
+    AND NOT (p_require_document AND e.status = 'indexed' AND e.document_name IS NULL)
+  ORDER BY e.last_seen_at, e.trace_id
+  LIMIT p_limit
+$$ LANGUAGE sql STABLE;
+
+-- Trace listing. A page of a user's traces, newest first and those without a
+-- created_at last: those after the trace at (p_created_at, p_id), or the first
+-- page when p_id is NULL. A NULL p_created_at is a cursor on a trace without a
+-- created_at. The row comparison lets Postgres start the scan of
+-- idx_trace_metadata_user_created at the cursor, so every page costs the same
+-- however deep it is; traces without a created_at are read in a scan of their own.
+CREATE OR REPLACE FUNCTION list_traces(p_user_id UUID, p_created_at TIMESTAMP, p_id UUID, p_limit INTEGER)
+RETURNS SETOF trace_metadata AS $$
+  SELECT * FROM (
+    (
+      SELECT * FROM trace_metadata
+      WHERE user_id = p_user_id AND created_at IS NOT NULL
+        AND (p_id IS NULL OR (p_created_at IS NOT NULL AND (created_at, id) < (p_created_at, p_id)))
+      ORDER BY created_at DESC, id DESC
+      LIMIT p_limit
+    )
+    UNION ALL
+    (
+      SELECT * FROM trace_metadata
+      WHERE user_id = p_user_id AND created_at IS NULL
+        AND (p_id IS NULL OR p_created_at IS NOT NULL OR id < p_id)
+      ORDER BY id DESC
+      LIMIT p_limit
+    )
+  ) AS page
+  ORDER BY created_at DESC NULLS LAST, id DESC
+  LIMIT p_limit
+$$ LANGUAGE sql STABLE;
 
+-- Existing deployments: backfill the rollups from rows written before the trigger
+-- existed. Run once, right after creating the trigger and before new traces arrive:
+-- INSERT INTO trace_stats_hourly
+-- SELECT user_id, date_trunc('hour', created_at), coalesce(provider, ''), coalesce(model, ''),
+--        count(*), count(*) FILTER (WHERE success), coalesce(sum(tokens_used), 0),
+--        count(latency_ms), coalesce(sum(latency_ms), 0), max(latency_ms),
+--        trace_latency_histogram(array_agg(latency_ms))
+-- FROM trace_metadata GROUP BY 1, 2, 3, 4;
+-- (and the same into trace_stats_daily with date_trunc('day', created_at))